@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+api_server.py
+分析結果（結合データ・馬リストの集計・グラフ）を JSON / PNG で返すローカルAPIサーバーです。
+他のツールから、PNG や CSV を読み取らずに同じ分析結果を使えます。
+
+エンドポイント（venue / date を省略すると settings.txt の 競馬場 / レース日）:
+  GET /api/races                               レース一覧（馬場・距離・頭数・走数）
+  GET /api/races/{R}                           レースの分析条件
+  GET /api/races/{R}/horses                    出走馬（馬ID・馬名）
+  GET /api/races/{R}/counts                    馬リストの集計（好走・凡走・近傍・適性）
+  GET /api/races/{R}/horses/{馬ID}/runs        馬の過去走（クッション値・含水率つき）
+  GET /api/races/{R}/chart.png                 全頭グラフ
+  GET /api/races/{R}/horses/{馬ID}/chart.png   個別グラフ（未生成なら生成）
+  GET /api/stats                               キャッシュの統計
+
+クエリ: venue=東京 date=2026.2.15 cushion=9.8 moisture=14.2 lookback=7 tol=0.5
+  cushion / moisture を省略すると main_analysis.py が出力したときの値を使う。
+  グラフは出力時の条件で描かれたもの（cushion / moisture は反映されない）。
+  data/ の過去走データはその日の出馬表と確かめられたときだけ使い、それ以外の日は
+  出力フォルダの {R}R_data.csv（出力時の過去走の範囲）から分析する。どちらもなければ 404。
+
+個別グラフはリクエストのスレッドで描く。render_horse_chart は pyplot の状態を使わず、
+同じグラフへの同時要求は1回の描画を待ち合わせる（応答キャッシュに頼らない）。
+
+応答には ETag が付き、If-None-Match が一致すれば 304 を返す（HEAD でも同じヘッダーを返す）。
+処理中の想定外のエラーは 500 と {"error": ...} を返す。
+元のファイル（過去走データ・含水率マスタ・出力）が更新されるまで結果はメモリに保持する。
+
+使い方:
+  python api_server.py [--port 8504]
+  curl 'http://127.0.0.1:8504/api/races/11/counts?venue=東京&date=2026.2.15'
+"""
+
+import os, re, json, math, hashlib, argparse, threading
+from collections import OrderedDict
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, unquote
+
+import pandas as pd
+
+from main_analysis import (
+    load_settings, load_cached, file_stamp, load_race_cached, load_moisture_history,
+    merge_data, add_today_moisture, add_condition_neighbors, detect_surface,
+    detect_target_dist, summarize_horses, score_race, apply_lookback, parse_lookback, horse_table,
+    lookback_label, load_race_meta, render_horse_chart, race_meta_path, race_file_path,
+    output_dir, race_file_sources, ChartCache, MOISTURE_CANDIDATES, VENUE_CODE, ALL_RACES,
+    race_data_path, load_race_render_data, build_condition_index,
+)
+
+DEFAULT_TARGET = {'cushion': 10.0, '芝': 14.7, 'ダート': 18.0}   # main_analysis と同じ既定値
+ANALYSIS_ENTRIES = 48   # 保持するレース分析の件数
+
+ROUTES = [
+    (re.compile(r'^/api/races$'),                                    'races'),
+    (re.compile(r'^/api/races/(\d{1,2})$'),                          'race'),
+    (re.compile(r'^/api/races/(\d{1,2})/horses$'),                   'horses'),
+    (re.compile(r'^/api/races/(\d{1,2})/counts$'),                   'counts'),
+    (re.compile(r'^/api/races/(\d{1,2})/horses/(-?\d+)/runs$'),      'runs'),
+    (re.compile(r'^/api/races/(\d{1,2})/chart\.png$'),               'race_chart'),
+    (re.compile(r'^/api/races/(\d{1,2})/horses/(-?\d+)/chart\.png$'), 'horse_chart'),
+]
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# ============================================================
+# 分析（main_analysis と同じ読み込み・結合）
+# ============================================================
+def source_stamp(venue_jp, date_str, race_no):
+    """レース分析の元になるファイルの更新時刻（変わったらキャッシュを使わない）"""
+    race_file = race_file_path(venue_jp, race_no)
+    out_dir = output_dir(venue_jp, date_str)
+    return file_stamp([*race_file_sources(race_file),
+                       race_meta_path(out_dir, race_no), race_data_path(out_dir, race_no),
+                       *MOISTURE_CANDIDATES])
+
+def is_card_of(race_df, race_date, meta, current):
+    """
+    data/ の過去走データ（競馬場・レース番号ごとに最後に取得した1日分）が race_date の出馬表か。
+    race_date 以降の走を含めば後の日のもの。その日の出力（meta）があれば出走馬が一致するか、
+    なければ settings.txt のレース日（current）のときだけその日のものとみなす。
+    """
+    dates = pd.to_datetime(race_df['race_date'], errors='coerce')
+    if (dates >= pd.Timestamp(race_date)).any():
+        return False
+    if meta is not None:
+        return set(horse_table(race_df)) == {int(h) for h, _ in meta['horses']}
+    return current
+
+def load_card(venue_jp, date_str, race_no, current_date=None):
+    """
+    date_str の出走馬の過去走データと {馬ID: 馬名}。見つからなければ (空, {})。
+    data/ の過去走データがその日のものでなければ、出力フォルダの {R}R_data.csv を使う。
+    """
+    race_date = datetime(*[int(x) for x in date_str.split('.')]).date()
+    out_dir = output_dir(venue_jp, date_str)
+    meta = load_race_meta(out_dir, race_no)
+    race_df = load_race_cached(race_file_path(venue_jp, race_no))
+    if not race_df.empty and is_card_of(race_df, race_date, meta, date_str == current_date):
+        return race_df, horse_table(race_df)
+    day_file = race_data_path(out_dir, race_no)
+    day_df = load_cached(day_file, [day_file], lambda: load_race_render_data(out_dir, race_no))
+    if day_df.empty:
+        return day_df, {}
+    horses = ({int(h): name for h, name in meta['horses']} if meta is not None
+              else horse_table(day_df))
+    return day_df, horses
+
+def day_index(venue_jp, date_str, lookback, surface, current_date=None):
+    """1日分（全レース）の過去走の ConditionIndex（analyze と同じ出馬表・過去走の範囲）"""
+    race_date = datetime(*[int(x) for x in date_str.split('.')]).date()
+    frames = []
+    for race_no in ALL_RACES:
+        race_df, _ = load_card(venue_jp, date_str, race_no, current_date)
+        if not race_df.empty:
+            frames.append(apply_lookback(race_df, parse_lookback(lookback), race_date))
+    moisture_df = load_cached('moisture', MOISTURE_CANDIDATES, load_moisture_history)
+    return build_condition_index(frames, moisture_df, surface)
+
+def analyze(venue_jp, date_str, race_no, cushion=None, moisture=None, lookback='7', tol=0.5,
+            current_date=None, index_for=None):
+    """
+    1レース分の結合データと馬ごとの集計。データがなければ None。
+    index_for(芝/ダート) は1日分の ConditionIndex を返す関数（類似馬場の列に使う）。
+    """
+    race_df, horses = load_card(venue_jp, date_str, race_no, current_date)
+    if race_df.empty:
+        return None
+    race_date = datetime(*[int(x) for x in date_str.split('.')]).date()
+    race_df = apply_lookback(race_df, parse_lookback(lookback), race_date)
+    surface = detect_surface(race_df)
+
+    # 条件の既定値は出力時（meta）の値
+    meta = load_race_meta(output_dir(venue_jp, date_str), race_no) or {}
+    cushion  = float(cushion)  if cushion  is not None else meta.get('cushion', DEFAULT_TARGET['cushion'])
+    moisture = float(moisture) if moisture is not None else meta.get('moisture', DEFAULT_TARGET[surface])
+
+    moisture_df = load_cached('moisture', MOISTURE_CANDIDATES, load_moisture_history)
+    moisture_df = add_today_moisture(moisture_df, race_date, venue_jp, cushion, moisture, moisture)
+    merged = merge_data(race_df, moisture_df, surface=surface)
+    index = index_for(surface) if index_for is not None else None
+    merged = add_condition_neighbors(merged, cushion, moisture, index=index, venue_jp=venue_jp)
+    target_dist = detect_target_dist(merged)
+
+    summary = summarize_horses(merged, list(horses), cushion, moisture, tol=tol)
+    scores  = score_race(merged, cushion, moisture, target_dist).set_index('horse_id')
+    knn = (merged.drop_duplicates('horse_id').set_index('horse_id')
+           if 'knn_runs' in merged.columns else pd.DataFrame())
+    counts = []
+    for hid, hname in horses.items():
+        row = {'horse_id': hid, 'horse_name': hname,
+               'runs': int(summary.at[hid, 'runs']),
+               'good': int(summary.at[hid, 'good']),
+               'bad':  int(summary.at[hid, 'bad'])}
+        if hid in knn.index:
+            for col in ('knn_top3', 'knn_runs', 'near_top3', 'near_runs'):
+                row[col] = int(knn.at[hid, col])
+        if hid in scores.index:
+            row['suitability']      = round(float(scores.at[hid, 'suitability']), 4)
+            row['suitability_rank'] = int(scores.at[hid, 'suitability_rank'])
+        counts.append(row)
+
+    return {
+        'condition': {
+            'venue': venue_jp, 'date': date_str, 'race_no': race_no, 'surface': surface,
+            'cushion': cushion, 'moisture': moisture, 'target_dist': target_dist,
+            'tol': tol, 'history': lookback_label(parse_lookback(lookback)),
+            'horses': len(horses), 'runs': int(len(merged)),
+            'matched': int(merged['cushion'].notna().sum()) if 'cushion' in merged.columns else 0,
+        },
+        'merged':      merged.drop(columns=['_dt', '_vc'], errors='ignore'),
+        'horses':      horses,
+        'counts':      counts,
+    }
+
+def records(df):
+    """DataFrame → JSON に出せる dict のリスト（日付は ISO 形式、NaN は null）"""
+    return json.loads(df.to_json(orient='records', force_ascii=False, date_format='iso'))
+
+# ============================================================
+# サーバー
+# ============================================================
+class ApiState:
+    """設定・分析キャッシュ・応答キャッシュ・統計（スレッド間で共有）"""
+    def __init__(self, cfg, response_bytes=64 * 1024 * 1024):
+        self.cfg = cfg
+        self.lock = threading.Lock()
+        self.analyses = OrderedDict()
+        self.responses = ChartCache(max_bytes=response_bytes)
+        self.stats = {'requests': 0, 'not_modified': 0, 'response_hits': 0,
+                      'analysis_hits': 0, 'analysis_misses': 0}
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def analysis(self, key, build):
+        """レース分析を LRU で保持する（key にはファイルの更新時刻を含める）"""
+        with self.lock:
+            hit = self.analyses.get(key)
+            if hit is not None:
+                self.analyses.move_to_end(key)
+                self.stats['analysis_hits'] += 1
+                return hit
+            self.stats['analysis_misses'] += 1
+        result = build()
+        with self.lock:
+            self.analyses[key] = result
+            while len(self.analyses) > ANALYSIS_ENTRIES:
+                self.analyses.popitem(last=False)
+        return result
+
+def query_params(state, query):
+    q = {k: v[-1] for k, v in parse_qs(query).items()}
+    venue = q.get('venue', state.cfg['競馬場'])
+    if venue not in VENUE_CODE:
+        raise ApiError(400, f"不明な競馬場: {venue}")
+    date_str = q.get('date', state.cfg['レース日'])
+    try:
+        datetime(*[int(x) for x in date_str.split('.')])
+        params = {
+            'cushion':  float(q['cushion'])  if 'cushion'  in q else None,
+            'moisture': float(q['moisture']) if 'moisture' in q else None,
+            'lookback': q.get('lookback', state.cfg['過去走の範囲']),
+            'tol':      float(q.get('tol', 0.5)),
+        }
+        # nan / inf は JSON に出せず、集計も成り立たない
+        if not all(math.isfinite(v) for v in (params['cushion'], params['moisture'],
+                                               params['tol']) if v is not None):
+            raise ValueError(q)
+    except (ValueError, TypeError):
+        raise ApiError(400, "date は 2026.2.15、cushion / moisture / tol は数値で指定してください")
+    return venue, date_str, params
+
+def make_handler(state):
+    class ApiHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self._handle(send_body=True)
+
+        def do_HEAD(self):
+            """GET と同じ応答のヘッダーだけ（ETag の確認用）"""
+            self._handle(send_body=False)
+
+        def _handle(self, send_body):
+            self.send_body = send_body
+            state.count('requests')
+            parts = urlsplit(self.path)
+            path = unquote(parts.path).rstrip('/')
+            if path == '/api/stats':
+                with state.lock:
+                    stats = dict(state.stats, analyses=len(state.analyses))
+                return self._send(200, 'application/json; charset=utf-8',
+                                  json.dumps(stats, ensure_ascii=False).encode('utf-8'))
+            try:
+                for pattern, name in ROUTES:
+                    m = pattern.match(path)
+                    if m:
+                        return self._respond(name, m.groups(), parts.query)
+                raise ApiError(404, f"not found: {path}")
+            except ApiError as e:
+                self._error(e.status, str(e))
+            except Exception as e:
+                # 壊れた・書き込み途中の出力ファイルなど。接続を切らずに 500 を返す
+                print(f"   {self.path}: {type(e).__name__}: {e}")
+                self._error(500, f"内部エラー: {type(e).__name__}: {e}")
+
+        def _error(self, status, message):
+            body = json.dumps({'error': message}, ensure_ascii=False).encode('utf-8')
+            self._send(status, 'application/json; charset=utf-8', body)
+
+        def _respond(self, name, groups, query):
+            venue, date_str, params = query_params(state, query)
+            race_nos = [int(groups[0])] if groups else ALL_RACES
+            if any(r not in ALL_RACES for r in race_nos):
+                raise ApiError(404, f"レース番号は1〜12です: {groups[0]}")
+            stamp = tuple(source_stamp(venue, date_str, r) for r in race_nos)
+            if name == 'race_chart':
+                stamp += (file_stamp([self._race_chart(venue, date_str, race_nos[0])]),)
+
+            # ETag は「リクエスト + 元ファイルの更新時刻」から決まる（同じなら同じ内容）
+            key = f"{self.path}|{stamp}"
+            etag = '"' + hashlib.md5(key.encode('utf-8')).hexdigest()[:20] + '"'
+            if self.headers.get('If-None-Match') == etag:
+                state.count('not_modified')
+                return self._send(304, None, b'', etag)
+            body = state.responses.get(key)
+            if body is not None:
+                state.count('response_hits')
+            else:
+                body = self._build(name, groups, venue, date_str, params, race_nos)
+                if name != 'horse_chart':   # 個別グラフは CHART_CACHE が保持し、描画も1回にまとめる
+                    state.responses.put(key, body)
+            ctype = 'image/png' if name.endswith('chart') else 'application/json; charset=utf-8'
+            self._send(200, ctype, body, etag)
+
+        def _analysis(self, venue, date_str, race_no, params):
+            key = (venue, date_str, race_no, tuple(sorted(params.items())),
+                   source_stamp(venue, date_str, race_no))
+            # 類似馬場の列は1日分のインデックス（芝・ダートごと）を全レースで共有して求める
+            index_for = lambda surface: state.analysis(
+                ('index', venue, date_str, params['lookback'], surface,
+                 tuple(source_stamp(venue, date_str, r) for r in ALL_RACES)),
+                lambda: day_index(venue, date_str, params['lookback'], surface,
+                                  state.cfg['レース日']))
+            result = state.analysis(key, lambda: analyze(
+                venue, date_str, race_no, current_date=state.cfg['レース日'],
+                index_for=index_for, **params))
+            if result is None:
+                raise ApiError(404, f"{venue} {date_str} {race_no}R の過去走データがありません")
+            return result
+
+        @staticmethod
+        def _race_chart(venue, date_str, race_no):
+            return f"{output_dir(venue, date_str)}/{race_no:02d}R_all.png"
+
+        def _build(self, name, groups, venue, date_str, params, race_nos):
+            race_no = race_nos[0]
+            if name == 'races':
+                races = []
+                for r in race_nos:
+                    try:
+                        races.append(self._analysis(venue, date_str, r, params)['condition'])
+                    except ApiError:
+                        continue
+                return self._json({'venue': venue, 'date': date_str, 'races': races})
+            if name == 'race_chart':
+                path = self._race_chart(venue, date_str, race_no)
+                if not os.path.isfile(path):
+                    raise ApiError(404, f"グラフがありません: {os.path.basename(path)}")
+                with open(path, 'rb') as f:
+                    return f.read()
+            if name == 'horse_chart':
+                data = render_horse_chart(output_dir(venue, date_str), race_no, int(groups[1]))
+                if data is None:
+                    raise ApiError(404, f"{race_no}R 馬ID {groups[1]} のグラフを作れません"
+                                        "（main_analysis.py の出力がありません）")
+                return data
+
+            result = self._analysis(venue, date_str, race_no, params)
+            if name == 'race':
+                return self._json(result['condition'])
+            if name == 'horses':
+                return self._json({'race_no': race_no, 'horses': [
+                    {'horse_id': hid, 'horse_name': name} for hid, name in result['horses'].items()]})
+            if name == 'counts':
+                return self._json({'condition': result['condition'], 'horses': result['counts']})
+            # runs
+            hid = int(groups[1])
+            if hid not in result['horses']:
+                raise ApiError(404, f"{race_no}R に馬ID {hid} の馬は出走していません")
+            merged = result['merged']
+            runs = merged[merged['horse_id'] == hid] if not merged.empty else merged
+            return self._json({'race_no': race_no, 'horse_id': hid,
+                               'horse_name': result['horses'][hid], 'runs': records(runs)})
+
+        @staticmethod
+        def _json(obj):
+            return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+        def _send(self, status, ctype, data, etag=None):
+            self.send_response(status)
+            if ctype:
+                self.send_header('Content-Type', ctype)
+            if etag:
+                self.send_header('ETag', etag)
+                self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            if self.send_body:
+                self.wfile.write(data)
+
+        def log_message(self, fmt, *args_):
+            pass
+
+    return ApiHandler
+
+def serve(port, cfg=None):
+    """サーバーを作って返す（serve_forever は呼び出し側で）"""
+    state = ApiState(cfg or load_settings())
+    return ThreadingHTTPServer(('127.0.0.1', port), make_handler(state))
+
+def main():
+    parser = argparse.ArgumentParser(description='分析結果の JSON API サーバー')
+    parser.add_argument('--port', type=int, default=8504)
+    args = parser.parse_args()
+    server = serve(args.port)
+    print(f"分析API: http://127.0.0.1:{args.port}/api/races  （終了: Ctrl+C）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
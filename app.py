@@ -10,9 +10,17 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
 import numpy as np
-import os, re, platform
+import os, re, time, platform
 from datetime import datetime
 
+from main_analysis import (summarize_horses, split_by_horse, add_condition_neighbors,
+                           ConditionIndex, NEAR_RADIUS,
+                           score_race, field_density, draw_density, FIELD_KEY,
+                           DENSITY_CUSHION, DENSITY_MOISTURE, load_race_file,
+                           parse_lookback, lookback_label, apply_lookback,
+                           horse_table, ensure_horse_ids)
+from condition_cube import ConditionCube, CUBE_FILE
+
 # ============================================================
 # ページ設定
 # ============================================================
@@ -108,6 +116,8 @@ def load_settings():
         'ダート含水率':  '18.0',
         'デモモード':    'True',
         'スクレイピング':'True',
+        '好走密度表示':  'False',
+        '過去走の範囲':  '7',
     }
     for fname in ['settings.txt', './settings.txt']:
         if os.path.exists(fname):
@@ -234,8 +244,10 @@ def load_moisture_history():
 # ============================================================
 @st.cache_data
 def load_race_data(venue_slug, race_no):
+    df = load_race_file(f"./data/race_data_{venue_slug}_{race_no}R.xlsx")
+    if len(df) > 0:
+        return df
     paths = [
-        f"./data/race_data_{venue_slug}_{race_no}R.xlsx",
         f"./race_data.xlsx",
     ]
     for p in paths:
@@ -243,7 +255,7 @@ def load_race_data(venue_slug, race_no):
             try:
                 df = pd.read_excel(p)
                 if len(df) > 0:
-                    return df
+                    return ensure_horse_ids(df)
             except:
                 pass
     return pd.DataFrame()
@@ -267,25 +279,27 @@ def merge_data(race_df, moisture_df):
 # 散布図描画
 # ============================================================
 def draw_scatter(plot_df, target_cushion, target_moisture, target_dist,
-                 highlight=None, title=""):
+                 highlight=None, title="", density=None):
     fig, ax = plt.subplots(figsize=(8, 6))
     fig.patch.set_facecolor('#f8f9fb')
     ax.set_facecolor('#f5f6f8')
+    if density is not None:
+        draw_density(ax, density)
 
     if not plot_df.empty:
         for _, row in plot_df.iterrows():
             x = row.get('cushion', np.nan)
             y = row.get('moisture', np.nan)
             if pd.isna(x) or pd.isna(y): continue
-            hn   = str(row.get('horse_name', ''))
+            hid  = row.get('horse_id', None)
             dist = row.get('distance', None)
             rank = row.get('rank', None)
             same = (dist == target_dist)
             good = (isinstance(rank,(int,float)) and not pd.isna(rank) and float(rank) <= 3)
 
-            if highlight and hn == highlight:
+            if highlight is not None and hid == highlight:
                 alpha, size, lw = 1.0, 320, 4.0
-            elif highlight:
+            elif highlight is not None:
                 alpha, size, lw = 0.08, 180, 2.0
             else:
                 alpha, size, lw = 0.85, 220, 2.5
@@ -336,23 +350,494 @@ def draw_scatter(plot_df, target_cushion, target_moisture, target_dist,
     return fig
 
 # ============================================================
-# 馬リスト集計
+# インタラクティブ散布図（ブラウザ側で描画）
 # ============================================================
-def build_horse_list(merged, horse_names, target_cushion, target_moisture, target_dist, tol=0.5):
+POINT_CLASSES = ['同距離 好走', '他距離 好走', '同距離 凡走', '他距離 凡走']
+
+def build_chart_points(plot_df, target_dist):
+    """ブラウザに送る点データ（1レース1回）。区分は draw_scatter と同じ判定"""
+    cols = ['horse_id', 'horse_name', 'cushion', 'moisture', 'distance', 'rank', 'race_date']
+    if plot_df.empty or 'cushion' not in plot_df.columns:
+        return pd.DataFrame(columns=cols + ['class'])
+    pts = plot_df[plot_df['cushion'].notna() & plot_df['moisture'].notna()]
+    pts = pts[[c for c in cols if c in pts.columns]].copy()
+    rank = pd.to_numeric(pts.get('rank'), errors='coerce')
+    good = (rank <= 3).to_numpy()
+    same = (pts.get('distance') == target_dist).to_numpy()
+    pts['class'] = np.select(
+        [good & same, good, same], POINT_CLASSES[:3], default=POINT_CLASSES[3]
+    )
+    pts['horse_name'] = pts['horse_name'].astype(str)
+    if 'race_date' in pts.columns:
+        pts['race_date'] = pts['race_date'].astype(str)
+    return pts.reset_index(drop=True)
+
+def build_density_cells(grid, step=2, key=FIELD_KEY):
+    """好走密度グリッドをブラウザ用のセル（走がある範囲のみ）に変換する。key = 馬ID / FIELD_KEY"""
+    g  = grid[::step, ::step]
+    cs = DENSITY_CUSHION[::step]
+    ms = DENSITY_MOISTURE[::step]
+    dc = (DENSITY_CUSHION[1]  - DENSITY_CUSHION[0])  * step / 2
+    dm = (DENSITY_MOISTURE[1] - DENSITY_MOISTURE[0]) * step / 2
+    yi, xi = np.nonzero(~np.isnan(g))
+    return [{'key': int(key), 'c0': float(cs[x] - dc), 'c1': float(cs[x] + dc),
+             'm0': float(ms[y] - dm), 'm1': float(ms[y] + dm),
+             'share': round(float(g[y, x]), 3)} for y, x in zip(yi, xi)]
+
+def build_list_rows(horses, counts):
+    """グラフ内の馬リスト（出馬表順）。counts は build_horse_list の行"""
     rows = []
-    for hname in horse_names:
-        h_df = merged[merged['horse_name']==hname] if not merged.empty else pd.DataFrame()
-        near = h_df[
-            h_df['cushion'].notna() & h_df['moisture'].notna() &
-            (abs(h_df['cushion']  - target_cushion)  <= tol) &
-            (abs(h_df['moisture'] - target_moisture) <= tol)
-        ] if not h_df.empty else pd.DataFrame()
-        good = int((near['rank'] <= 3).sum()) if not near.empty and 'rank' in near.columns else 0
-        bad  = int((near['rank'] >  3).sum()) if not near.empty and 'rank' in near.columns else 0
-        rows.append({'馬名': hname, '好走': good, '凡走': bad,
-                     '_df': h_df, '_merged': merged})
+    for i, (hid, hname) in enumerate(horses.items()):
+        c = counts.get(hid, {})
+        score = f"{c['適性']:.2f}" if c.get('適性') is not None else '-'
+        rows.append({'horse_id': int(hid), 'order': i,
+                     'label': f"{hname}  好{c.get('好走', 0)} 凡{c.get('凡走', 0)} 適{score}"})
     return rows
 
+def build_chart_spec(horses, counts, target_cushion, target_moisture, title="", densities=None):
+    """
+    Vega-Lite の仕様を組み立てる（散布図 + 馬リスト）。1レースにつき1回だけ送る。
+    馬の強調（点・リストの馬名のクリック / プルダウン）・ホバー・ズームはブラウザ側で処理し、
+    サーバーには戻らない。pick は散布図とリストで共有する選択（馬ID）。
+    horses は {馬ID: 馬名}、densities は {馬ID / FIELD_KEY: 密度グリッド}（選んだ馬の密度を表示）。
+    """
+    pick = {
+        'name': 'pick',
+        'select': {'type': 'point', 'fields': ['horse_id'], 'on': 'click',
+                   'clear': 'dblclick'},
+        'bind': {'input': 'select', 'name': '馬名 ',
+                 'options': [None] + list(horses),
+                 'labels': ['（全頭）'] + list(horses.values())},
+        'views': ['points', 'horse_list'],
+    }
+    picked = {'param': 'pick', 'empty': True}
+
+    points = {
+        'name': 'points',
+        'params': [{'name': 'zoom', 'select': 'interval', 'bind': 'scales'}],
+        'mark': {'type': 'point', 'size': 160, 'strokeWidth': 2.5, 'cursor': 'pointer'},
+        'encoding': {
+            'x': {'field': 'cushion',  'type': 'quantitative', 'title': 'Cushion Value',
+                  'scale': {'zero': False}},
+            'y': {'field': 'moisture', 'type': 'quantitative', 'title': 'Moisture (%)',
+                  'scale': {'zero': False}},
+            'color': {'field': 'class', 'type': 'nominal', 'title': None,
+                      'scale': {'domain': POINT_CLASSES,
+                                'range': ['#ef4444', '#ef4444', '#3b82f6', '#3b82f6']},
+                      'legend': {'orient': 'top-left'}},
+            'shape': {'field': 'class', 'type': 'nominal',
+                      'scale': {'domain': POINT_CLASSES,
+                                'range': ['circle', 'circle', 'circle', 'cross']}},
+            'fill': {'condition': {'test': f"datum['class'] == '{POINT_CLASSES[0]}'",
+                                   'value': '#ef4444'},
+                     'value': 'transparent'},
+            'opacity': {'condition': {**picked, 'value': 0.9}, 'value': 0.08},
+            'tooltip': [
+                {'field': 'horse_name', 'title': '馬名'},
+                {'field': 'race_date',  'title': '日付'},
+                {'field': 'distance',   'title': '距離'},
+                {'field': 'rank',       'title': '着順'},
+                {'field': 'cushion',    'title': 'クッション'},
+                {'field': 'moisture',   'title': '含水率'},
+            ],
+        },
+    }
+    target_rule = {'color': '#f59e0b', 'strokeDash': [6, 4], 'strokeWidth': 3}
+    background = []
+    cells = [c for key, grid in (densities or {}).items()
+             for c in build_density_cells(grid, key=key)]
+    if cells:
+        # 馬を選んでいなければレース全体、選んでいればその馬の密度
+        background.append({
+            'data': {'values': cells},
+            'transform': [{'filter': f"length(data('pick_store')) == 0 ? "
+                                     f"datum.key == {FIELD_KEY} : "
+                                     f"datum.key == data('pick_store')[0].values[0]"}],
+            'mark': {'type': 'rect', 'opacity': 0.35},
+            'encoding': {
+                'x': {'field': 'c0', 'type': 'quantitative'}, 'x2': {'field': 'c1'},
+                'y': {'field': 'm0', 'type': 'quantitative'}, 'y2': {'field': 'm1'},
+                'color': {'field': 'share', 'type': 'quantitative', 'title': '3着以内率',
+                          'scale': {'scheme': 'redblue', 'reverse': True, 'domain': [0, 1]}},
+            },
+        })
+    scatter = {
+        'height': 460,
+        'resolve': {'scale': {'color': 'independent'}},
+        'layer': background + [
+            points,
+            {'mark': {'type': 'rule', **target_rule},
+             'encoding': {'x': {'datum': target_cushion}}},
+            {'mark': {'type': 'rule', **target_rule},
+             'encoding': {'y': {'datum': target_moisture}}},
+            {'mark': {'type': 'point', 'size': 260, 'color': '#d97706',
+                      'strokeWidth': 3},
+             'encoding': {'x': {'datum': target_cushion},
+                          'y': {'datum': target_moisture}}},
+        ],
+    }
+    horse_list = {
+        'name': 'horse_list',
+        'data': {'values': build_list_rows(horses, counts)},
+        'width': 230,
+        'height': 460,
+        'title': {'text': '出走馬（クリックで強調）', 'fontSize': 12},
+        'mark': {'type': 'text', 'align': 'left', 'x': 4, 'cursor': 'pointer'},
+        'encoding': {
+            'y': {'field': 'order', 'type': 'ordinal', 'axis': None},
+            'text': {'field': 'label'},
+            'color': {'condition': {'param': 'pick', 'empty': False, 'value': '#b45309'},
+                      'value': '#1e293b'},
+            'size': {'condition': {'param': 'pick', 'empty': False, 'value': 15}, 'value': 13},
+            'opacity': {'condition': {**picked, 'value': 1.0}, 'value': 0.35},
+        },
+    }
+    return {
+        'title': title,
+        'params': [pick],
+        'hconcat': [scatter, horse_list],
+        'resolve': {'scale': {'color': 'independent'}},
+    }
+
+# ============================================================
+# 馬リスト集計
+# ============================================================
+def build_horse_list(merged, horses, target_cushion, target_moisture, target_dist, tol=0.5):
+    """horses は {馬ID: 馬名}。行は馬IDで引き、表示には馬名を使う"""
+    summary = summarize_horses(merged, list(horses), target_cushion, target_moisture, tol=tol)
+    rows = [{'馬ID': int(hid), '馬名': horses.get(hid, str(hid)), '好走': int(good), '凡走': int(bad)}
+            for hid, good, bad in zip(summary.index, summary['good'], summary['bad'])]
+    # 類似馬場の近傍走（add_condition_neighbors 済みの場合のみ）
+    if 'knn_runs' in merged.columns:
+        knn = merged.drop_duplicates('horse_id').set_index('horse_id')
+        for r in rows:
+            if r['馬ID'] in knn.index:
+                r['近傍好走'] = f"{int(knn.at[r['馬ID'], 'knn_top3'])}/{int(knn.at[r['馬ID'], 'knn_runs'])}"
+    # 馬場適性スコア
+    scores = score_race(merged, target_cushion, target_moisture, target_dist).set_index('horse_id')
+    for r in rows:
+        r['適性'] = round(float(scores.at[r['馬ID'], 'suitability']), 3) if r['馬ID'] in scores.index else None
+    return rows
+
+# ============================================================
+# レース分析キャッシュ（全セッション共有）
+# ============================================================
+@st.cache_resource(max_entries=8, ttl=60*60, show_spinner=False)
+def load_moisture_with_today(venue_jp, date_str, cushion, moisture_turf, moisture_dirt):
+    """含水率マスタに今日の値（未登録の場合のみ）を追記したもの"""
+    moisture_df = load_moisture_history()
+    today_date  = datetime(*[int(x) for x in date_str.split('.')]).date()
+    new_rows = pd.DataFrame([
+        {'date':today_date,'venue':venue_jp,'cushion':cushion,'moisture':moisture_turf},
+        {'date':today_date,'venue':venue_jp,'cushion':cushion,'moisture':moisture_dirt},
+    ])
+    if moisture_df.empty:
+        return new_rows
+    has_today = (
+        (moisture_df['date'].astype(str) == str(today_date)) &
+        (moisture_df['venue'].astype(str) == venue_jp)
+    ).any()
+    if has_today:
+        return moisture_df
+    return pd.concat([moisture_df, new_rows], ignore_index=True)
+
+@st.cache_resource(max_entries=8, ttl=60*60, show_spinner=False)
+def load_day_index(venue_jp, date_str, cushion, moisture_turf, moisture_dirt, lookback='7'):
+    """
+    1日分（全レース）の過去走の空間インデックス（ConditionIndex）。
+    analyze_race と同じ読み込み・結合で作り、レースを切り替えても作り直さない。
+    """
+    venue_slug = safe_name(venue_jp)
+    race_date  = datetime(*[int(x) for x in date_str.split('.')]).date()
+    frames = []
+    for rno in range(1, 13):
+        if os.path.exists(f"./data/race_data_{venue_slug}_{rno}R.xlsx"):
+            race_df = load_race_data(venue_slug, rno)
+            if not race_df.empty:
+                frames.append(apply_lookback(race_df, parse_lookback(lookback), race_date))
+    if not frames:
+        return ConditionIndex(pd.DataFrame())
+    moisture_df = load_moisture_with_today(venue_jp, date_str, cushion, moisture_turf, moisture_dirt)
+    return ConditionIndex(merge_data(pd.concat(frames, ignore_index=True), moisture_df))
+
+@st.cache_resource(max_entries=48, ttl=60*60, show_spinner=False)
+def analyze_race(venue_jp, date_str, race_no, cushion, moisture_turf, moisture_dirt,
+                 lookback='7', tol=0.5):
+    """
+    1レース分の分析結果（結合データ・出走馬・距離・馬ごとの好走/凡走数）。
+    実質的なキーは (競馬場, 日付, レース, クッション値, 含水率, 距離, 許容幅)。
+    結果は全セッションで共有されるため、呼び出し側で変更しないこと。
+    件数（max_entries）と経過時間（ttl）で破棄される。
+    """
+    race_df = load_race_data(safe_name(venue_jp), race_no)
+    if race_df.empty:
+        return None
+    race_date = datetime(*[int(x) for x in date_str.split('.')]).date()
+
+    # 出走馬 {馬ID: 馬名}（過去走の範囲を絞る前に取る）
+    horses  = horse_table(race_df)
+    race_df = apply_lookback(race_df, parse_lookback(lookback), race_date)
+
+    # 芝・ダート判定
+    surface = '芝'
+    if 'surface' in race_df.columns:
+        mode = race_df['surface'].mode()
+        if not mode.empty:
+            surface = mode.iloc[0]
+    moisture = moisture_dirt if surface == 'ダート' else moisture_turf
+
+    # データ結合
+    moisture_df = load_moisture_with_today(venue_jp, date_str, cushion, moisture_turf, moisture_dirt)
+    merged = merge_data(race_df, moisture_df)
+    index  = load_day_index(venue_jp, date_str, cushion, moisture_turf, moisture_dirt, lookback)
+    merged = add_condition_neighbors(merged, cushion, moisture, index=index, venue_jp=venue_jp)
+
+    # 距離取得
+    if not merged.empty and 'distance' in merged.columns:
+        dist_mode = merged['distance'].dropna().mode()
+        target_dist = int(dist_mode.iloc[0]) if not dist_mode.empty else 1600
+    else:
+        target_dist = 1600
+
+    counts = {
+        r['馬ID']: r for r in
+        build_horse_list(merged, horses, cushion, moisture, target_dist, tol=tol)
+    }
+    by_horse = split_by_horse(merged)
+    return {
+        'merged':      merged,
+        'horses':      horses,
+        'surface':     surface,
+        'moisture':    moisture,
+        'target_dist': target_dist,
+        'counts':      counts,
+        'by_horse':    by_horse,
+        'density':     field_density(merged, by_horse),
+        'history':     lookback_label(parse_lookback(lookback)),
+        'index':       index,
+    }
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def load_cube(mtime):
+    """馬場別集計キューブ（ファイル更新時刻が変わったら読み直す）"""
+    return ConditionCube.load(CUBE_FILE)
+
+def cube_mtime():
+    return os.path.getmtime(CUBE_FILE) if os.path.exists(CUBE_FILE) else 0.0
+
+def build_heatmap_spec(title):
+    return {
+        'title': title,
+        'height': 260,
+        'mark': {'type': 'rect', 'tooltip': True},
+        'encoding': {
+            'x': {'field': 'cushion',  'type': 'ordinal', 'title': 'クッション値'},
+            'y': {'field': 'moisture', 'type': 'ordinal', 'title': '含水率(%)', 'sort': 'descending'},
+            'color': {'field': 'rate', 'type': 'quantitative', 'title': '3着以内率',
+                      'scale': {'scheme': 'orangered', 'domain': [0, 1]}},
+            'tooltip': [
+                {'field': 'cushion',  'title': 'クッション値'},
+                {'field': 'moisture', 'title': '含水率'},
+                {'field': 'runs',     'title': '走数'},
+                {'field': 'top3',     'title': '3着以内'},
+                {'field': 'rate',     'title': '3着以内率', 'format': '.0%'},
+            ],
+        },
+    }
+
+# ============================================================
+# レース表示
+# ============================================================
+def render_race(race_no, venue_jp, date_str, cushion, moisture_turf, moisture_dirt,
+                chart_mode, show_density=False, lookback='7'):
+    analysis = analyze_race(venue_jp, date_str, race_no, cushion, moisture_turf, moisture_dirt,
+                            lookback)
+    if analysis is None:
+        st.warning(f"{race_no}R のデータがありません")
+        return
+
+    merged      = analysis['merged']
+    horses      = analysis['horses']
+    surface     = analysis['surface']
+    moisture    = analysis['moisture']
+    target_dist = analysis['target_dist']
+
+    # レース情報ヘッダー
+    st.markdown(
+        f'<div class="race-metric">{venue_jp} {race_no}R | {surface} {target_dist}m | '
+        f'C={cushion} M={moisture}%</div>',
+        unsafe_allow_html=True
+    )
+
+    densities = analysis['density'] if show_density else {}
+    if chart_mode == "インタラクティブ":
+        # 点データと仕様はレースを表示したときに1回だけ送る（馬の強調はブラウザ側で処理し、
+        # 下の race_panel の再実行では送り直さない）
+        t_chart = time.perf_counter()
+        points = build_chart_points(merged, target_dist)
+        spec = build_chart_spec(horses, analysis['counts'], cushion, moisture,
+                                title=f"{venue_jp} {race_no}R {surface} {target_dist}m",
+                                densities=densities)
+        st.vega_lite_chart(points, spec, use_container_width=True, key=f"chart_{race_no}")
+        st.caption(f"グラフ送信 {len(points)}点 / {(time.perf_counter() - t_chart) * 1000:.0f} ms"
+                   "（強調・ズームはブラウザ側で処理）")
+
+    race_panel(race_no, venue_jp, surface, merged, horses, analysis['counts'],
+               analysis['by_horse'], cushion, moisture, target_dist, chart_mode,
+               densities, analysis['history'], analysis['index'])
+
+def toggle_horse(sel_key, hid):
+    st.session_state[sel_key] = None if st.session_state.get(sel_key) == hid else hid
+
+@st.fragment
+def race_panel(race_no, venue_jp, surface, merged, horses, counts, by_horse,
+               cushion, moisture, target_dist, chart_mode, densities, history, index):
+    """
+    馬リスト・詳細表（画像表示のときは散布図も）。
+    馬の選択や検索ではこの部分だけを再実行する（スクリプト全体は再実行しない）。
+    インタラクティブ表示の散布図はこの外で1回だけ送るので、ここでの選択は詳細表だけを切り替える
+    （グラフの強調はグラフ内のクリックでブラウザ側が処理する）。
+    """
+    t_start = time.perf_counter()
+
+    # 馬名検索
+    search = st.text_input("🔍 馬名検索", key=f"search_{race_no}", placeholder="馬名を入力...")
+    filtered_horses = ([h for h, name in horses.items() if search.lower() in name.lower()]
+                       if search else list(horses))
+
+    # 馬選択状態（馬ID）
+    sel_key = f"selected_{race_no}"
+    if sel_key not in st.session_state:
+        st.session_state[sel_key] = None
+    selected_horse = st.session_state[sel_key]
+    selected_name  = horses.get(selected_horse, '')
+
+    interactive = chart_mode == "インタラクティブ"
+    if interactive:
+        col_list = st.container()
+    else:
+        # レイアウト：散布図（左）+ 馬リスト（右）
+        col_plot, col_list = st.columns([3, 2])
+        with col_plot:
+            title_str = f"{venue_jp} {race_no}R {surface} {target_dist}m"
+            if selected_horse is not None:
+                title_str += f"  【{selected_name}】"
+            density = densities.get(selected_horse if selected_horse is not None else FIELD_KEY)
+            fig = draw_scatter(merged, cushion, moisture, target_dist,
+                               highlight=selected_horse, title=title_str,
+                               density=density)
+            st.pyplot(fig)
+            plt.close(fig)
+
+    with col_list:
+        st.markdown("**出走馬リスト**（クリックで詳細表示）" if interactive else
+                    "**出走馬リスト**（クリックで個別表示）")
+
+        # 馬リスト構築
+        horse_rows = [counts[h] for h in filtered_horses]
+        order = st.radio("並び順", ["出馬表順", "適性順", "好走数順"], horizontal=True,
+                         key=f"order_{race_no}", label_visibility="collapsed")
+        if order == "適性順":
+            horse_rows = sorted(horse_rows, key=lambda r: -(r['適性'] or 0))
+        elif order == "好走数順":
+            horse_rows = sorted(horse_rows, key=lambda r: (-r['好走'], r['凡走']))
+
+        # TSVエクスポート
+        if horse_rows:
+            tsv_df = pd.DataFrame([{
+                '馬ID': r['馬ID'], '馬名': r['馬名'], '好走': r['好走'], '凡走': r['凡走'],
+                '近傍好走': r.get('近傍好走', ''), '適性': r['適性'],
+            } for r in horse_rows])
+            tsv_str = tsv_df.to_csv(sep='\t', index=False)
+            st.download_button(
+                label="📋 TSV出力",
+                data=tsv_str.encode('utf-8-sig'),
+                file_name=f"{venue_jp}_{race_no}R.tsv",
+                mime="text/tab-separated-values",
+                key=f"tsv_{race_no}"
+            )
+
+        # 馬カードリスト
+        for hr in horse_rows:
+            hid   = hr['馬ID']
+            hname = hr['馬名']
+            good  = hr['好走']
+            bad   = hr['凡走']
+            is_sel = (selected_horse == hid)
+            bg = "#fffbeb" if is_sel else "white"
+            border = "2px solid #f59e0b" if is_sel else "1px solid #e2e8f0"
+
+            col_a, col_b, col_c, col_d = st.columns([3, 1, 1, 1])
+            with col_a:
+                st.button(f"{'▶ ' if is_sel else ''}{hname}",
+                          key=f"btn_{race_no}_{hid}",
+                          use_container_width=True,
+                          on_click=toggle_horse, args=(sel_key, hid))
+            with col_b:
+                st.markdown(f'<span class="badge-good">好走 {good}</span>', unsafe_allow_html=True)
+            with col_c:
+                st.markdown(f'<span class="badge-bad">凡走 {bad}</span>', unsafe_allow_html=True)
+            with col_d:
+                score = f"{hr['適性']:.2f}" if hr['適性'] is not None else '-'
+                st.markdown(f'<span class="badge-score">適性 {score}</span>', unsafe_allow_html=True)
+
+        # 選択馬の個別グラフ（リスト下に表示）
+        if selected_horse is not None and not merged.empty:
+            st.divider()
+            st.markdown(f"**【{selected_name}】 {history}の詳細**")
+            h_df = by_horse.get(selected_horse, pd.DataFrame())
+            if not h_df.empty:
+                if 'knn_runs' in h_df.columns:
+                    st.caption(f"今回の馬場に近い{int(h_df['knn_runs'].iloc[0])}走: "
+                               f"好走 {int(h_df['knn_top3'].iloc[0])} / "
+                               f"馬場差{NEAR_RADIUS:.1f}以内 {int(h_df['near_runs'].iloc[0])}走: "
+                               f"好走 {int(h_df['near_top3'].iloc[0])}")
+                cols = ['race_date','venue','distance','rank','cushion','moisture']
+                names = ['日付','競馬場','距離','着順','クッション','含水率']
+                if 'cond_dist' in h_df.columns:
+                    h_df = h_df.sort_values('cond_dist')
+                    cols.append('cond_dist'); names.append('馬場差')
+                disp = h_df[cols].copy()
+                disp.columns = names
+                st.dataframe(disp.reset_index(drop=True), use_container_width=True)
+
+            # 含水率帯ごとの通算成績（集計キューブ）
+            cube = load_cube(cube_mtime())
+            lo, hi = st.slider("含水率の範囲 (%)", 5.0, 30.0,
+                               (max(5.0, np.floor(moisture) - 1), min(30.0, np.floor(moisture) + 1)),
+                               step=1.0, key=f"mrange_{race_no}")
+            runs, top3 = cube.horse_record(selected_horse, moisture=(lo, hi), surface=surface)
+            st.caption(f"{surface} 含水率{lo:.0f}〜{hi:.0f}%の通算: {runs}走 / 3着以内 {top3}")
+
+        # 類似馬場の半径検索（1日分のインデックス: 選択馬 / 競馬場 / 全体）
+        with st.expander("🔎 今回の馬場に近い過去走"):
+            scopes = {"全体": None, venue_jp: ('_vc', clean_venue(venue_jp))}
+            if selected_horse is not None:
+                scopes = {selected_name: ('horse_id', selected_horse), **scopes}
+            scope = st.radio("対象", list(scopes), horizontal=True, key=f"near_scope_{race_no}")
+            radius = st.slider("馬場差（1.0 = クッション値・含水率 ±0.5）", 0.5, 4.0,
+                               NEAR_RADIUS, step=0.5, key=f"near_radius_{race_no}")
+            near = index.radius(cushion, moisture, radius, by=scopes[scope])
+            top3 = int((pd.to_numeric(near['rank'], errors='coerce') <= 3).sum()) if len(near) else 0
+            st.caption(f"{len(near)}走 / 3着以内 {top3}（出走馬の{history}）")
+            if len(near):
+                disp = near[['horse_name', 'race_date', 'venue', 'distance', 'rank',
+                             'cushion', 'moisture', 'cond_dist']].head(100)
+                disp.columns = ['馬名', '日付', '競馬場', '距離', '着順', 'クッション', '含水率', '馬場差']
+                st.dataframe(disp.reset_index(drop=True), use_container_width=True)
+
+    with st.expander(f"🗺 {venue_jp}{surface}の馬場別 3着以内率（全体）"):
+        cube = load_cube(cube_mtime())
+        grid = cube.heatmap(surface=surface, venue=venue_jp)
+        if grid.empty:
+            st.caption("集計キューブがありません（main_analysis.py 実行時に作成されます）")
+        else:
+            st.vega_lite_chart(grid, build_heatmap_spec(f"{venue_jp} {surface}"),
+                               use_container_width=True, key=f"heat_{race_no}")
+
+    # サーバー側の処理時間のみ。クリックから描画までは benchmark.py --ui で測る
+    st.caption(f"⏱ サーバー処理 {(time.perf_counter() - t_start) * 1000:.0f} ms")
+
 # ============================================================
 # メインUI
 # ============================================================
@@ -378,6 +863,8 @@ def main():
                   border-radius:12px; font-size:0.8rem; font-weight:600; }
     .badge-bad  { background:#eff6ff; color:#2563eb; padding:2px 8px;
                   border-radius:12px; font-size:0.8rem; font-weight:600; }
+    .badge-score { background:#fffbeb; color:#b45309; padding:2px 8px;
+                   border-radius:12px; font-size:0.8rem; font-weight:600; }
     </style>
     """, unsafe_allow_html=True)
 
@@ -397,6 +884,13 @@ def main():
         cushion       = st.number_input("クッション値",     value=_to_float(cfg['クッション値'], 10.0), step=0.1, format="%.1f")
         moisture_turf = st.number_input("芝含水率 (%)",     value=_to_float(cfg['芝含水率'],     14.7), step=0.1, format="%.1f")
         moisture_dirt = st.number_input("ダート含水率 (%)", value=_to_float(cfg['ダート含水率'], 18.0), step=0.1, format="%.1f")
+        chart_mode    = st.radio("グラフ表示", ["インタラクティブ", "画像"], horizontal=True,
+                                 help="インタラクティブ: 馬の強調・ズームをブラウザ側で処理します")
+        show_density  = st.checkbox("好走密度を背景に表示",
+                                    value=cfg['好走密度表示'].lower() in ('true', '1', 'yes', 'はい'),
+                                    help="赤: 3着以内が多い馬場 / 青: 4着以下が多い馬場（馬を選ぶとその馬の密度）")
+        lookback      = st.text_input("過去走の範囲", value=cfg['過去走の範囲'],
+                                      help="7 = 近7走 / 365日 = 過去365日 / 全走（取得済みの範囲内）")
 
         st.divider()
         st.markdown("**凡例**")
@@ -406,28 +900,7 @@ def main():
         st.markdown("🔵× 他距離 凡走")
         st.markdown("⭐ 今回のターゲット")
 
-    # データ読み込み
-    venue_slug   = safe_name(venue_jp)
-    moisture_df  = load_moisture_history()
-    today_date   = datetime(*[int(x) for x in date_str.split('.')]).date()
-
-    # 今日のデータを追記
-    if not moisture_df.empty:
-        has_today = any(
-            str(r['date'])==str(today_date) and str(r['venue'])==venue_jp
-            for _, r in moisture_df.iterrows()
-        )
-        if not has_today:
-            new_rows = pd.DataFrame([
-                {'date':today_date,'venue':venue_jp,'cushion':cushion,'moisture':moisture_turf},
-                {'date':today_date,'venue':venue_jp,'cushion':cushion,'moisture':moisture_dirt},
-            ])
-            moisture_df = pd.concat([moisture_df, new_rows], ignore_index=True)
-    else:
-        moisture_df = pd.DataFrame([
-            {'date':today_date,'venue':venue_jp,'cushion':cushion,'moisture':moisture_turf},
-            {'date':today_date,'venue':venue_jp,'cushion':cushion,'moisture':moisture_dirt},
-        ])
+    venue_slug = safe_name(venue_jp)
 
     # 利用可能レース一覧を検出
     available_races = []
@@ -445,120 +918,12 @@ def main():
     st.markdown(f'<div class="main-title">🏇 {venue_jp}  {date_str}  C={cushion} / 芝{moisture_turf}% ダート{moisture_dirt}%</div>',
                 unsafe_allow_html=True)
 
-    # レース選択タブ
-    tab_labels = [f"{rno}R" for rno in available_races]
-    tabs = st.tabs(tab_labels)
-
-    for tab_idx, race_no in enumerate(available_races):
-        with tabs[tab_idx]:
-            race_df = load_race_data(venue_slug, race_no)
-            if race_df.empty:
-                st.warning(f"{race_no}R のデータがありません")
-                continue
-
-            # 馬名リスト取得
-            horse_names = race_df['horse_name'].unique().tolist() if 'horse_name' in race_df.columns else []
-
-            # 芝・ダート判定
-            surface = '芝'
-            if 'surface' in race_df.columns:
-                mode = race_df['surface'].mode()
-                if not mode.empty:
-                    surface = mode.iloc[0]
-            moisture = moisture_dirt if surface == 'ダート' else moisture_turf
-
-            # データ結合
-            merged = merge_data(race_df, moisture_df)
-
-            # 距離取得
-            if not merged.empty and 'distance' in merged.columns:
-                dist_mode = merged['distance'].dropna().mode()
-                target_dist = int(dist_mode.iloc[0]) if not dist_mode.empty else 1600
-            else:
-                target_dist = 1600
-
-            # レース情報ヘッダー
-            st.markdown(
-                f'<div class="race-metric">{venue_jp} {race_no}R | {surface} {target_dist}m | '
-                f'C={cushion} M={moisture}%</div>',
-                unsafe_allow_html=True
-            )
-
-            # 馬名検索
-            search = st.text_input("🔍 馬名検索", key=f"search_{race_no}", placeholder="馬名を入力...")
-            filtered_horses = [h for h in horse_names if search.lower() in h.lower()] if search else horse_names
-
-            # 馬選択状態
-            sel_key = f"selected_{race_no}"
-            if sel_key not in st.session_state:
-                st.session_state[sel_key] = None
-            selected_horse = st.session_state[sel_key]
-
-            # レイアウト：散布図（左）+ 馬リスト（右）
-            col_plot, col_list = st.columns([3, 2])
-
-            with col_plot:
-                title_str = f"{venue_jp} {race_no}R {surface} {target_dist}m"
-                if selected_horse:
-                    title_str += f"  【{selected_horse}】"
-                fig = draw_scatter(merged, cushion, moisture, target_dist,
-                                   highlight=selected_horse, title=title_str)
-                st.pyplot(fig)
-                plt.close()
-
-            with col_list:
-                st.markdown("**出走馬リスト**（クリックで個別表示）")
-
-                # 馬リスト構築
-                horse_rows = build_horse_list(merged, filtered_horses, cushion, moisture, target_dist)
-
-                # TSVエクスポート
-                if horse_rows:
-                    tsv_df = pd.DataFrame([{
-                        '馬名': r['馬名'], '好走': r['好走'], '凡走': r['凡走']
-                    } for r in horse_rows])
-                    tsv_str = tsv_df.to_csv(sep='\t', index=False)
-                    st.download_button(
-                        label="📋 TSV出力",
-                        data=tsv_str.encode('utf-8-sig'),
-                        file_name=f"{venue_jp}_{race_no}R.tsv",
-                        mime="text/tab-separated-values",
-                        key=f"tsv_{race_no}"
-                    )
-
-                # 馬カードリスト
-                for hr in horse_rows:
-                    hname = hr['馬名']
-                    good  = hr['好走']
-                    bad   = hr['凡走']
-                    is_sel = (selected_horse == hname)
-                    bg = "#fffbeb" if is_sel else "white"
-                    border = "2px solid #f59e0b" if is_sel else "1px solid #e2e8f0"
-
-                    col_a, col_b, col_c = st.columns([3, 1, 1])
-                    with col_a:
-                        if st.button(f"{'▶ ' if is_sel else ''}{hname}",
-                                     key=f"btn_{race_no}_{hname}",
-                                     use_container_width=True):
-                            if is_sel:
-                                st.session_state[sel_key] = None
-                            else:
-                                st.session_state[sel_key] = hname
-                            st.rerun()
-                    with col_b:
-                        st.markdown(f'<span class="badge-good">好走 {good}</span>', unsafe_allow_html=True)
-                    with col_c:
-                        st.markdown(f'<span class="badge-bad">凡走 {bad}</span>', unsafe_allow_html=True)
-
-                # 選択馬の個別グラフ（リスト下に表示）
-                if selected_horse and not merged.empty:
-                    st.divider()
-                    st.markdown(f"**【{selected_horse}】 近7走の詳細**")
-                    h_df = merged[merged['horse_name']==selected_horse]
-                    if not h_df.empty:
-                        disp = h_df[['race_date','venue','distance','rank','cushion','moisture']].copy()
-                        disp.columns = ['日付','競馬場','距離','着順','クッション','含水率']
-                        st.dataframe(disp.reset_index(drop=True), use_container_width=True)
+    # レース選択（表示中のレースだけを読み込み・描画する）
+    race_no = st.radio("レース", available_races, format_func=lambda r: f"{r}R",
+                       horizontal=True, key=f"race_{venue_slug}",
+                       label_visibility="collapsed")
+    render_race(race_no, venue_jp, date_str, cushion, moisture_turf, moisture_dirt,
+                chart_mode, show_density, lookback)
 
 if __name__ == '__main__':
     main()
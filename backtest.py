@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+backtest.py
+保存済みのレース日（./output/YYYY_MM_DD_競馬場/analysis_result_all.csv）を再生し、
+「似た馬場での好走」が実際に3着以内を予測できているかを検証します。
+
+各レースの馬場適性スコアは、そのレース日より前の走だけを使って
+main_analysis の merge_data / score_field（classify_point と同じ同距離判定）で計算します。
+着順は、後日保存された出走馬の過去走から取得します（結果が見つからない馬は集計対象外）。
+
+使い方:
+  python backtest.py --from 2025.1.1 --to 2025.12.31 [--workers 4] [--output ./output]
+"""
+
+import argparse, json, os, re, time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from main_analysis import (VENUE_EN, load_moisture_history, merge_data,
+                           score_field, ensure_horse_ids, horse_id_map,
+                           SUITABILITY_PRIOR)
+
+DAY_DIR_RE  = re.compile(r'^(\d{4})_(\d{2})_(\d{2})_(\w+)$')
+VENUE_JP    = {en: jp for jp, en in VENUE_EN.items()}
+RUN_COLS    = ['horse_id', 'horse_name', 'race_date', 'venue', 'race_name', 'distance', 'surface', 'rank']
+CARD_KEYS   = ['card_date', 'card_venue', 'race_no']
+CALIB_BINS  = np.linspace(0.0, 1.0, 11)
+
+def parse_date(text):
+    return datetime(*[int(x) for x in text.split('.')]).date()
+
+# ============================================================
+# 保存済みデータの読み込み
+# ============================================================
+def find_race_days(output_root):
+    """出力フォルダから (日付, 競馬場, CSVパス) の一覧を返す"""
+    days = []
+    if not os.path.isdir(output_root):
+        return days
+    for name in sorted(os.listdir(output_root)):
+        m = DAY_DIR_RE.match(name)
+        path = os.path.join(output_root, name, 'analysis_result_all.csv')
+        if not m or m.group(4) not in VENUE_JP or not os.path.exists(path):
+            continue
+        dt = datetime(int(m.group(1)), int(m.group(2)), int(m.group(3))).date()
+        days.append({'date': dt, 'venue': VENUE_JP[m.group(4)], 'path': path})
+    return days
+
+def load_store(days):
+    """
+    全レース日のCSVから
+      cards  : 出走表（レース日・競馬場・レース番号・馬ID・今回の条件）
+      runs   : 過去走アーカイブ（重複除去済み、結合前の列のみ）
+    を作る。馬は馬ID で突き合わせる（馬IDのない古いCSVは馬名から補う）。
+    """
+    raw = [(d, pd.read_csv(d['path'])) for d in days]
+    # 馬IDのない古いCSVの馬は、他の日のCSVで馬ID付きで出てくる同名馬に合わせる
+    known = horse_id_map(df for _, df in raw)
+    card_frames, run_frames = [], []
+    for d, df in raw:
+        df = ensure_horse_ids(df, known)
+        if df.empty or 'horse_id' not in df.columns:
+            continue
+        df['card_date']  = d['date']
+        df['card_venue'] = d['venue']
+        card_frames.append(df)
+        run_frames.append(df[[c for c in RUN_COLS if c in df.columns]])
+
+    if not card_frames:
+        return pd.DataFrame(), pd.DataFrame()
+
+    all_rows = pd.concat(card_frames, ignore_index=True)
+    runs = pd.concat(run_frames, ignore_index=True).drop_duplicates(
+        subset=['horse_id', 'race_date', 'venue', 'race_name'])
+    runs['race_date'] = pd.to_datetime(runs['race_date'], errors='coerce').dt.date
+    return all_rows, runs.reset_index(drop=True)
+
+def build_cards(all_rows, moisture_df):
+    """
+    レースごとの出走馬と今回の条件（馬場・クッション値・含水率・距離）。
+    CSV に target_* 列がない古い出力は main() と同じ規則で補う。
+    """
+    def _mode(s, default):
+        m = s.dropna().mode()
+        return m.iloc[0] if not m.empty else default
+
+    race_info = all_rows.groupby(CARD_KEYS, sort=False).agg(
+        surface=('surface', lambda s: _mode(s, '芝')),
+        dist_mode=('distance', lambda s: int(_mode(s, 1600))),
+    ).reset_index()
+
+    for col in ['target_cushion', 'target_moisture', 'target_dist']:
+        if col in all_rows.columns:
+            race_info = race_info.merge(
+                all_rows.groupby(CARD_KEYS)[col].first().reset_index(), on=CARD_KEYS, how='left')
+        else:
+            race_info[col] = np.nan
+    race_info['target_dist'] = race_info['target_dist'].fillna(race_info['dist_mode'])
+
+    # 今回の馬場を含水率マスタから補完
+    if race_info['target_cushion'].isna().any() and not moisture_df.empty:
+        m = moisture_df.copy()
+        m['card_date'] = pd.to_datetime(m['date'], errors='coerce').dt.date
+        m = m.rename(columns={'venue': 'card_venue'}).drop_duplicates(
+            ['card_date', 'card_venue', 'surface'])
+        race_info = race_info.merge(
+            m[['card_date', 'card_venue', 'surface', 'cushion', 'moisture']],
+            on=['card_date', 'card_venue', 'surface'], how='left')
+        race_info['target_cushion']  = race_info['target_cushion'].fillna(race_info['cushion'])
+        race_info['target_moisture'] = race_info['target_moisture'].fillna(race_info['moisture'])
+        race_info = race_info.drop(columns=['cushion', 'moisture'])
+
+    entrants = all_rows[CARD_KEYS + ['horse_id', 'horse_name']].drop_duplicates(
+        CARD_KEYS + ['horse_id'])
+    cards = entrants.merge(race_info.drop(columns='dist_mode'), on=CARD_KEYS, how='left')
+    return cards.dropna(subset=['target_cushion', 'target_moisture']).reset_index(drop=True)
+
+def attach_results(cards, runs):
+    """レース当日の着順を過去走アーカイブから引く"""
+    res = runs.rename(columns={'race_date': 'card_date', 'venue': 'card_venue',
+                               'rank': 'result_rank'})
+    res = res[['horse_id', 'card_date', 'card_venue', 'result_rank']].drop_duplicates(
+        ['horse_id', 'card_date', 'card_venue'])
+    out = cards.merge(res, on=['horse_id', 'card_date', 'card_venue'], how='left')
+    out['result_rank'] = pd.to_numeric(out['result_rank'], errors='coerce')
+    return out
+
+# ============================================================
+# スコア計算（レース日単位でまとめて / 並列）
+# ============================================================
+def score_chunk(cards, merged_by_surface):
+    """
+    cards（複数レース日分）の各出走馬について、レース日より前の走だけでスコアを計算する。
+    出走馬 × 過去走 をまとめて結合し、score_field で一括計算する。
+    """
+    group_cols = CARD_KEYS + ['horse_id']
+    scored = []
+    for surface, c in cards.groupby('surface'):
+        arch = merged_by_surface.get(surface)
+        if arch is None or arch.empty:
+            continue
+        pairs = c.merge(arch.drop(columns='horse_name', errors='ignore'),
+                        on='horse_id', how='inner')
+        pairs = pairs[pd.to_datetime(pairs['_dt']) < pd.to_datetime(pairs['card_date'])]
+        scored.append(score_field(pairs, group_cols=group_cols))
+    scores = (pd.concat(scored, ignore_index=True) if scored
+              else pd.DataFrame(columns=group_cols + ['suitability', 'weight', 'runs']))
+    out = cards.merge(scores[group_cols + ['suitability', 'weight', 'runs']],
+                      on=group_cols, how='left')
+    out['suitability'] = out['suitability'].fillna(SUITABILITY_PRIOR)
+    out['runs'] = out['runs'].fillna(0).astype(int)
+    return out
+
+def score_all(cards, merged_by_surface, workers=1):
+    if workers <= 1 or cards.empty:
+        return score_chunk(cards, merged_by_surface)
+    dates = np.array(sorted(cards['card_date'].unique()))
+    chunks = [cards[cards['card_date'].isin(part)] for part in np.array_split(dates, workers)]
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        parts = list(ex.map(score_chunk, chunks, [merged_by_surface] * len(chunks)))
+    return pd.concat(parts, ignore_index=True)
+
+# ============================================================
+# 評価
+# ============================================================
+def evaluate(scored):
+    """的中率・較正（スコア帯ごとの予測値と実際の3着以内率）を計算する"""
+    known = scored[scored['result_rank'].notna()].copy()
+    if known.empty:
+        return {'races': 0, 'entrants': 0}
+    known['top3'] = (known['result_rank'] <= 3).astype(float)
+    known['pick'] = known.groupby(CARD_KEYS)['suitability'].rank(
+        ascending=False, method='first').astype(int)
+    field = known.groupby(CARD_KEYS)['horse_id'].transform('size')
+
+    top = known[known['pick'] == 1]
+    top3_picks = known[known['pick'] <= 3]
+    known['bin'] = pd.cut(known['suitability'], CALIB_BINS, include_lowest=True)
+    calib = known.groupby('bin', observed=True).agg(
+        n=('top3', 'size'), predicted=('suitability', 'mean'), observed=('top3', 'mean'))
+
+    return {
+        'races':              int(len(top)),
+        'entrants':           int(len(known)),
+        'top_pick_top3_rate': float(top['top3'].mean()),
+        'top_pick_win_rate':  float((top['result_rank'] == 1).mean()),
+        'top3_picks_top3_rate': float(top3_picks['top3'].mean()),
+        'baseline_top3_rate': float((np.minimum(3, field) / field).groupby(
+            [known[k] for k in CARD_KEYS]).first().mean()),
+        'brier':              float(((known['suitability'] - known['top3']) ** 2).mean()),
+        'calibration': [
+            {'bin': str(b), 'n': int(r.n), 'predicted': float(r.predicted),
+             'observed': float(r.observed)}
+            for b, r in calib.iterrows()
+        ],
+    }
+
+# ============================================================
+# メイン
+# ============================================================
+def run_backtest(date_from, date_to, output_root='./output', workers=1):
+    t0 = time.perf_counter()
+    days = find_race_days(output_root)
+    all_rows, runs = load_store(days)
+    if all_rows.empty:
+        print("保存済みのレース日がありません")
+        return None, {}
+
+    moisture_df = load_moisture_history()
+    in_range = all_rows[(all_rows['card_date'] >= date_from) & (all_rows['card_date'] <= date_to)]
+    cards = attach_results(build_cards(in_range, moisture_df), runs)
+    merged_by_surface = {s: merge_data(runs, moisture_df, surface=s) for s in ['芝', 'ダート']}
+
+    scored = score_all(cards, merged_by_surface, workers=workers)
+    report = evaluate(scored)
+    report.update({
+        'from': str(date_from), 'to': str(date_to),
+        'race_days': int(scored['card_date'].nunique()) if not scored.empty else 0,
+        'archive_runs': int(len(runs)),
+        'elapsed_sec': round(time.perf_counter() - t0, 3),
+    })
+    return scored, report
+
+def main():
+    ap = argparse.ArgumentParser(description='保存済みレース日の馬場適性バックテスト')
+    ap.add_argument('--from', dest='date_from', required=True, help='開始日 (例: 2025.1.1)')
+    ap.add_argument('--to',   dest='date_to',   required=True, help='終了日 (例: 2025.12.31)')
+    ap.add_argument('--output', default='./output', help='レース日の出力フォルダ')
+    ap.add_argument('--workers', type=int, default=1, help='並列プロセス数')
+    args = ap.parse_args()
+
+    date_from, date_to = parse_date(args.date_from), parse_date(args.date_to)
+    scored, report = run_backtest(date_from, date_to, args.output, args.workers)
+    if scored is None:
+        return
+
+    out_dir = os.path.join(args.output, f"backtest_{date_from:%Y_%m_%d}_{date_to:%Y_%m_%d}")
+    os.makedirs(out_dir, exist_ok=True)
+    scored.to_csv(os.path.join(out_dir, 'backtest_entrants.csv'), index=False, encoding='utf-8-sig')
+    with open(os.path.join(out_dir, 'backtest_report.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+
+    print(f"\n{'='*60}")
+    print(f"バックテスト {date_from} 〜 {date_to}  ({report['race_days']}日 / {report.get('races', 0)}レース)")
+    if report.get('races'):
+        print(f"   1位評価馬の3着以内率 : {report['top_pick_top3_rate']:.1%}"
+              f"（ランダム {report['baseline_top3_rate']:.1%}）")
+        print(f"   1位評価馬の勝率      : {report['top_pick_win_rate']:.1%}")
+        print(f"   上位3頭の3着以内率   : {report['top3_picks_top3_rate']:.1%}")
+        print(f"   Brier スコア         : {report['brier']:.4f}")
+        print("   較正（スコア帯: 件数 / 予測 / 実際）")
+        for c in report['calibration']:
+            print(f"     {c['bin']:>14}: {c['n']:5d} / {c['predicted']:.2f} / {c['observed']:.2f}")
+    print(f"   処理時間: {report['elapsed_sec']}秒")
+    print(f"Output: {out_dir}/")
+    print(f"{'='*60}\n")
+
+if __name__ == '__main__':
+    main()
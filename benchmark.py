@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+benchmark.py
+合成データで主要処理の所要時間を計測し、結果をJSONに保存します（ネット接続不要）。
+
+計測対象:
+  含水率マスタ読み込み（シンプル形式 / JRAマルチヘッダー形式）、merge_data、
+  build_horse_list、draw_graph / draw_scatter、スクレイピング = False での main()
+
+規模:
+  small  : 3レース × 8頭 × 近7走
+  day    : 12レース × 16頭 × 近7走
+  season : 12レース × 16頭 × 50走（含水率マスタ5年分）
+
+--ui を付けると day 規模のワークスペースでダッシュボード（app.py）を起動し、
+Chrome（Selenium）でクリックしてから画面に描かれるまでの時間を測る（結果は day_ui）:
+  ui_race_switch          レースを切り替えて、散布図と馬リストが描かれるまで（スクリプト全体の再実行）
+  ui_card_click_to_paint  馬リストのカードを押して、詳細表が描かれるまで（race_panel だけの再実行）
+  ui_chart_pick_to_paint  グラフの馬を選んで、強調が描かれるまで（ブラウザ内の処理のみ）
+時間はブラウザ内で、操作の直前から条件を満たした次のフレームまでを performance.now() で測る。
+
+使い方:
+  python benchmark.py                                  # 全規模
+  python benchmark.py --scales small,day --repeat 5
+  python benchmark.py --scales day --ui                # クリックから描画まで（Chrome が必要）
+  python benchmark.py --compare ./output/benchmark_前回.json
+"""
+
+import os, io, sys, json, time, shutil, socket, argparse, platform, tempfile, subprocess
+import urllib.request
+from contextlib import redirect_stdout
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import main_analysis as ma
+
+SCALES = {
+    'small':  {'races': 3,  'horses': 8,  'runs': 7,  'history_years': 1},
+    'day':    {'races': 12, 'horses': 16, 'runs': 7,  'history_years': 2},
+    'season': {'races': 12, 'horses': 16, 'runs': 50, 'history_years': 5},
+}
+RACE_DATE   = date(2026, 2, 15)
+VENUE       = '東京'
+SLOWER_WARN = 1.2   # --compare でこれ以上遅くなった項目に印を付ける
+
+# ============================================================
+# 合成データ
+# ============================================================
+def make_moisture_history(rng, years):
+    """開催日（土日）× 主要4場の含水率マスタ（シンプル形式の列）"""
+    days = pd.date_range(RACE_DATE - timedelta(days=365 * years), RACE_DATE - timedelta(days=1))
+    days = days[days.dayofweek >= 5]
+    rows = []
+    for d in days:
+        for v in ['東京', '中山', '京都', '阪神']:
+            c = round(rng.uniform(8.0, 12.0), 1)
+            rows.append({'date': d.date(), 'venue': v, 'cushion': c,
+                         'moisture': round(rng.uniform(8.0, 22.0), 1), 'surface': '芝'})
+            rows.append({'date': d.date(), 'venue': v, 'cushion': c,
+                         'moisture': round(rng.uniform(6.0, 20.0), 1), 'surface': 'ダート'})
+    return pd.DataFrame(rows)
+
+def write_multiheader(moisture, path):
+    """
+    JRA公開データに近いマルチヘッダー形式で書き出す
+    （見出し3段 + データ行。load_moisture_history の列探索に合う配置）
+    """
+    wide = moisture.pivot_table(index=['date', 'venue'], columns='surface',
+                                values=['cushion', 'moisture'], aggfunc='first').reset_index()
+    header = [
+        ['年', '月日', '回', '日次', 'クッション値', '', '含水率', '含水率', '', '', '競馬場'],
+        ['', '', '', '', '', '', '芝', 'ダート', '', '', ''],
+        ['', '', '', '', '', '', 'ゴール前', 'ゴール前', '', '', ''],
+    ]
+    body = []
+    for _, row in wide.iterrows():
+        d = row[('date', '')]
+        body.append([d.year, f"{d.month}月{d.day}日", 1, 1, row[('cushion', '芝')], '',
+                     row[('moisture', '芝')], row[('moisture', 'ダート')], '', '',
+                     row[('venue', '')]])
+    pd.DataFrame(header + body).to_excel(path, index=False, header=False)
+
+def make_race_files(rng, moisture, scale, data_dir):
+    """1日分の過去走データ（race_data_Tokyo_{n}R.xlsx）"""
+    days = moisture[['date', 'venue']].drop_duplicates().to_numpy()
+    slug = ma.safe_name(VENUE)
+    for race_no in range(1, scale['races'] + 1):
+        surface = '芝' if race_no % 2 else 'ダート'
+        n = scale['horses'] * scale['runs']
+        pick = days[rng.integers(0, len(days), n)]
+        pd.DataFrame({
+            'race_no':    race_no,
+            'horse_id':   np.repeat(race_no * 1000 + np.arange(scale['horses']), scale['runs']),
+            'horse_name': np.repeat([f"ベンチ{race_no}_{h}" for h in range(scale['horses'])],
+                                    scale['runs']),
+            'race_date':  pick[:, 0],
+            'venue':      pick[:, 1],
+            'race_name':  [f"R{i}" for i in range(n)],
+            'distance':   rng.choice([1200, 1400, 1600, 1800, 2000], n),
+            'surface':    surface,
+            'rank':       rng.integers(1, 17, n),
+        }).to_excel(os.path.join(data_dir, f"race_data_{slug}_{race_no}R.xlsx"), index=False)
+
+def build_workspace(scale, seed=0):
+    """一時フォルダに 含水率.xlsx（シンプル形式）/ jra/含水率.xlsx / data/ を作る"""
+    rng = np.random.default_rng(seed)
+    root = tempfile.mkdtemp(prefix='bench_')
+    moisture = make_moisture_history(rng, scale['history_years'])
+    moisture.to_excel(os.path.join(root, ma.MOISTURE_FILE), index=False)
+    os.makedirs(os.path.join(root, 'jra'))
+    write_multiheader(moisture, os.path.join(root, 'jra', ma.MOISTURE_FILE))
+    os.makedirs(os.path.join(root, 'data'))
+    make_race_files(rng, moisture, scale, os.path.join(root, 'data'))
+    return root
+
+# ============================================================
+# 計測
+# ============================================================
+def summarize(secs):
+    return {'repeat': len(secs), 'min': round(min(secs), 5),
+            'median': round(float(np.median(secs)), 5), 'mean': round(float(np.mean(secs)), 5)}
+
+def measure(fn, repeat):
+    """fn を repeat 回実行した所要時間（標準出力は捨てる）"""
+    secs = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            fn()
+        secs.append(time.perf_counter() - t)
+    return summarize(secs)
+
+def run_scale(scale, repeat):
+    import app   # build_horse_list / draw_scatter（Streamlit 外では警告のみ）
+
+    root = build_workspace(scale)
+    cwd = os.getcwd()
+    results = {}
+    try:
+        os.chdir(os.path.join(root, 'jra'))
+        results['load_moisture_history_multiheader'] = measure(ma.load_moisture_history, repeat)
+        os.chdir(root)
+        results['load_moisture_history_simple'] = measure(ma.load_moisture_history, repeat)
+
+        with redirect_stdout(io.StringIO()):
+            moisture_df = ma.load_moisture_history()
+            race_df = ma.load_race_file(f"./data/race_data_{ma.safe_name(VENUE)}_1R.xlsx")
+            merged = ma.merge_data(race_df, moisture_df, surface='芝')
+        horses = ma.horse_table(race_df)
+        first  = next(iter(horses))
+        target = (10.0, 14.7, 1600)
+
+        results['merge_data'] = measure(
+            lambda: ma.merge_data(race_df, moisture_df, surface='芝'), repeat)
+        results['build_horse_list'] = measure(
+            lambda: app.build_horse_list(merged, horses, *target), repeat)
+        results['draw_graph_field'] = measure(
+            lambda: ma.draw_graph(merged, os.path.join(root, 'field.png'), 'bench', *target,
+                                  demo_overlay=True, demo_mode=True), repeat)
+        results['draw_graph_horse'] = measure(
+            lambda: ma.draw_graph(merged[merged['horse_id'] == first],
+                                  os.path.join(root, 'horse.png'), 'bench', *target,
+                                  highlight=first), repeat)
+        results['draw_scatter'] = measure(
+            lambda: plt.close(app.draw_scatter(merged, *target)), repeat)
+
+        # 全体（スクレイピングなし・個別グラフは遅延生成）
+        with redirect_stdout(io.StringIO()):
+            cfg = ma.load_settings()
+        cfg.update({'競馬場': VENUE, 'レース日': f"{RACE_DATE.year}.{RACE_DATE.month}.{RACE_DATE.day}",
+                    'クッション値': '10.0', '芝含水率': '14.7', 'ダート含水率': '18.0',
+                    'スクレイピング': 'False', '個別グラフ遅延生成': 'True'})
+        results['main_offline'] = measure(lambda: ma.main(cfg), 1)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(root, ignore_errors=True)
+    return {'params': scale, 'results': results}
+
+# ============================================================
+# ダッシュボードのクリックから描画まで（--ui）
+# ============================================================
+# action を実行してから predicate が真になったフレームまでのミリ秒（30秒で打ち切り = -1）。
+# chartSig() は散布図の canvas の画素のチェックサム（描き変わったかの判定用）
+PAINT_JS = r"""
+const [action, predicate, done] = arguments;
+const chartSig = () => {
+  const c = document.querySelector('[data-testid="stVegaLiteChart"] canvas');
+  if (!c || !c.width) return null;
+  const d = c.getContext('2d').getImageData(0, 0, c.width, c.height).data;
+  let s = 0;
+  for (let i = 0; i < d.length; i += 97) s = (s * 31 + d[i]) | 0;
+  return s;
+};
+const before = chartSig();
+const ok = new Function('before', 'chartSig', 'return (' + predicate + ');');
+const t0 = performance.now();
+new Function(action)();
+const tick = () => {
+  const ms = performance.now() - t0;
+  if (ok(before, chartSig)) requestAnimationFrame(() => done(performance.now() - t0));
+  else if (ms > 30000) done(-1);
+  else requestAnimationFrame(tick);
+};
+requestAnimationFrame(tick);
+"""
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_dashboard(root, port, timeout=60):
+    """root をカレントにして app.py を起動し、応答するまで待つ"""
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    proc = subprocess.Popen(
+        [sys.executable, '-m', 'streamlit', 'run', app_path, '--server.headless', 'true',
+         '--server.port', str(port), '--browser.gatherUsageStats', 'false'],
+        cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < timeout:
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/_stcore/health", timeout=2) as r:
+                if r.read().strip() == b'ok':
+                    return proc
+        except OSError:
+            time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError('ダッシュボードが起動しません')
+
+def click_to_paint(driver, action, predicate):
+    """PAINT_JS で1回測る（秒。打ち切りは None）"""
+    ms = driver.execute_async_script(PAINT_JS, action, predicate)
+    return ms / 1000 if ms is not None and ms >= 0 else None
+
+def run_ui(scale, repeat):
+    """12レースの1日分でレース切り替え・カード・グラフの選択のクリックから描画までを測る"""
+    root = build_workspace(scale)
+    with redirect_stdout(io.StringIO()):
+        cwd = os.getcwd()
+        os.chdir(root)
+        try:
+            ma.load_settings()   # 既定の settings.txt（東京 2026.2.15）を作る
+        finally:
+            os.chdir(cwd)
+    port = free_port()
+    proc = start_dashboard(root, port)
+    driver = None
+    times = {'ui_race_switch': [], 'ui_card_click_to_paint': [], 'ui_chart_pick_to_paint': []}
+    timeouts = 0
+    try:
+        driver = ma.make_driver('standard')
+        driver.set_window_size(1600, 1400)
+        driver.set_script_timeout(60)
+        driver.get(f"http://127.0.0.1:{port}/")
+        first_card = lambda r: f"document.querySelector('.st-key-btn_{r}_{r * 1000}')"
+        if click_to_paint(driver, '', f"{first_card(1)} && chartSig() !== null") is None:
+            raise RuntimeError('1R が表示されません')
+
+        for race_no in range(1, scale['races'] + 1):
+            if race_no > 1:
+                label = (f'//div[@data-testid="stRadio"]//label[normalize-space()="{race_no}R"]')
+                sec = click_to_paint(
+                    driver,
+                    f"document.evaluate('{label}', document, null, 9, null).singleNodeValue.click();",
+                    f"{first_card(race_no)} && chartSig() !== null && chartSig() !== before")
+                times['ui_race_switch'].append(sec)
+            for i in range(min(repeat, scale['horses'])):
+                hid = race_no * 1000 + i
+                name = f"ベンチ{race_no}_{i}"
+                times['ui_card_click_to_paint'].append(click_to_paint(
+                    driver,
+                    f"document.querySelector('.st-key-btn_{race_no}_{hid} button').click();",
+                    "[...document.querySelectorAll('[data-testid=\"stMarkdownContainer\"]')]"
+                    f".some(e => e.textContent.includes('【{name}】'))"))
+                # プルダウンは馬名・点のクリックと同じ選択（pick）を変える
+                times['ui_chart_pick_to_paint'].append(click_to_paint(
+                    driver,
+                    "const s = document.querySelector('[data-testid=\"stVegaLiteChart\"] "
+                    f".vega-bindings select'); s.selectedIndex = {i + 1};"
+                    " s.dispatchEvent(new Event('change', {bubbles: true}));"
+                    " s.dispatchEvent(new Event('input', {bubbles: true}));",
+                    "chartSig() !== before"))
+    finally:
+        if driver is not None:
+            driver.quit()
+        proc.terminate()
+        proc.wait(timeout=10)
+        shutil.rmtree(root, ignore_errors=True)
+
+    results = {}
+    for key, secs in times.items():
+        ok = [s for s in secs if s is not None]
+        timeouts += len(secs) - len(ok)
+        if ok:
+            results[key] = summarize(ok)
+    return {'params': dict(scale, ui=True, timeouts=timeouts), 'results': results}
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        commit = ''
+    return {
+        'timestamp':  datetime.now().isoformat(timespec='seconds'),
+        'commit':     commit,
+        'python':     platform.python_version(),
+        'platform':   platform.platform(),
+        'pandas':     pd.__version__,
+        'numpy':      np.__version__,
+        'matplotlib': matplotlib.__version__,
+    }
+
+def compare(current, previous):
+    """前回の結果との比較（median の比）を表示する"""
+    print(f"\n前回比較: {previous['env'].get('commit', '?')} → {current['env'].get('commit', '?')}")
+    for scale, cur in current['scales'].items():
+        prev = previous.get('scales', {}).get(scale)
+        if not prev:
+            continue
+        for key, r in cur['results'].items():
+            p = prev['results'].get(key)
+            if not p or not p['median']:
+                continue
+            ratio = r['median'] / p['median']
+            mark = '  ← 遅くなった' if ratio >= SLOWER_WARN else ''
+            print(f"   {scale:<7} {key:<36} {p['median']:8.3f}s → {r['median']:8.3f}s "
+                  f"(x{ratio:.2f}){mark}")
+
+def main():
+    parser = argparse.ArgumentParser(description='合成データによるベンチマーク')
+    parser.add_argument('--scales', default=','.join(SCALES), help='small,day,season')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None, help='結果JSON（省略時 ./output/benchmark_日時.json）')
+    parser.add_argument('--compare', default=None, help='比較する前回の結果JSON')
+    parser.add_argument('--ui', action='store_true',
+                        help='day 規模のダッシュボードでクリックから描画までを測る（Chrome が必要）')
+    args = parser.parse_args()
+
+    report = {'env': environment(), 'scales': {}}
+    for name in [s.strip() for s in args.scales.split(',') if s.strip()]:
+        if name not in SCALES:
+            print(f"不明な規模: {name}（{', '.join(SCALES)}）")
+            continue
+        print(f"\n{name} を計測中... {SCALES[name]}")
+        report['scales'][name] = run_scale(SCALES[name], args.repeat)
+        for key, r in report['scales'][name]['results'].items():
+            print(f"   {key:<36} median {r['median']:8.3f}s  min {r['min']:8.3f}s")
+
+    if args.ui:
+        print(f"\nday_ui を計測中...（ダッシュボード + Chrome）")
+        report['scales']['day_ui'] = run_ui(SCALES['day'], args.repeat)
+        for key, r in report['scales']['day_ui']['results'].items():
+            print(f"   {key:<36} median {r['median'] * 1000:8.1f}ms  "
+                  f"min {r['min'] * 1000:8.1f}ms  ({r['repeat']}回)")
+        if report['scales']['day_ui']['params']['timeouts']:
+            print(f"   打ち切り: {report['scales']['day_ui']['params']['timeouts']}回")
+
+    out = args.output or f"./output/benchmark_{datetime.now():%Y%m%d_%H%M%S}.json"
+    os.makedirs(os.path.dirname(out) or '.', exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=1)
+    print(f"\n結果: {out}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(report, json.load(f))
+
+if __name__ == '__main__':
+    main()
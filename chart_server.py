@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+chart_server.py
+出力フォルダのグラフをブラウザで閲覧するためのローカルサーバーです。
+個別グラフ遅延生成 = True で出力した場合、馬ごとのPNGは初めて開いたときに生成されます。
+
+使い方:
+  python chart_server.py ./output/2026_02_15_Tokyo [ポート番号]
+"""
+
+import os, re, sys, html
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote
+
+from main_analysis import render_horse_chart, load_race_meta, horse_chart_path
+
+CHART_RE = re.compile(r'^(\d{2})R_(-?\d+)\.png$')   # 個別グラフ = {R}R_{馬ID}.png
+
+def make_handler(out_dir):
+    class ChartHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            fname = os.path.basename(unquote(self.path.split('?')[0]))
+            if not fname:
+                return self._send_index()
+
+            path = os.path.join(out_dir, fname)
+            m = CHART_RE.match(fname)
+            if m:
+                data = render_horse_chart(out_dir, int(m.group(1)), int(m.group(2)))
+                if data is not None:
+                    return self._send(200, 'image/png', data)
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    data = f.read()
+                ctype = 'image/png' if fname.endswith('.png') else 'application/octet-stream'
+                return self._send(200, ctype, data)
+            self._send(404, 'text/plain; charset=utf-8', 'not found'.encode('utf-8'))
+
+        def _send_index(self):
+            links = []
+            for race_no in range(1, 13):
+                meta = load_race_meta(out_dir, race_no)
+                if meta is None:
+                    continue
+                links.append(f'<h3><a href="{race_no:02d}R_all.png">{race_no}R 全頭</a></h3>')
+                for hid, hname in meta['horses']:
+                    fname = os.path.basename(horse_chart_path(out_dir, race_no, hid))
+                    links.append(f'<a href="{fname}">{html.escape(hname)}</a><br>')
+            body = ('<html><meta charset="utf-8"><body>'
+                    + ''.join(links) + '</body></html>').encode('utf-8')
+            self._send(200, 'text/html; charset=utf-8', body)
+
+        def _send(self, status, ctype, data):
+            self.send_response(status)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    return ChartHandler
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return
+    out_dir = sys.argv[1].rstrip('/')
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8502
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(out_dir))
+    print(f"グラフ閲覧: http://127.0.0.1:{port}/  （終了: Ctrl+C）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
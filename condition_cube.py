@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+condition_cube.py
+過去走を「クッション値帯 × 含水率帯 × 芝/ダート × 競馬場 × 距離帯」に集計した
+走数・3着以内数のキューブ（馬ごと / 全体）を保持します。
+
+新しい過去走は add_runs() で差分だけ加算され（同じ走は二重に数えない）、
+「含水率12〜14%での成績」やヒートマップは集計済みのマスを足すだけで求まります。
+馬は馬ID（horse_id）で数えるので、別のレース・別の日に出走しても同じ馬として積み上がります。
+
+使い方:
+  python condition_cube.py ./output/2026_02_15_Tokyo/analysis_result_all.csv ...
+  python condition_cube.py ./data/race_data_Tokyo_1R.xlsx ...
+  （指定したCSV・過去走データの過去走をキューブに追加します。
+   クッション値・含水率は過去走それぞれの芝/ダートで含水率マスタから結合し直します）
+"""
+
+import os, sys
+import numpy as np
+import pandas as pd
+
+from main_analysis import (merge_data, clean_venue, ensure_horse_ids, horse_id_map,
+                           load_moisture_history)
+
+CUBE_FILE    = './data/condition_cube.pkl'
+CUSHION_BIN  = 0.5     # クッション値帯の幅
+MOISTURE_BIN = 1.0     # 含水率帯の幅（%）
+DIST_BANDS   = [0, 1400, 1800, 2200, 10000]
+DIST_LABELS  = ['~1400', '1401-1800', '1801-2200', '2201~']
+DIMS         = ['cushion_bin', 'moisture_bin', 'surface', 'venue', 'dist_band']
+RUN_KEY      = ['horse_id', 'race_date', 'venue', 'race_name']
+RUN_COLS     = RUN_KEY + ['horse_name', 'distance', 'surface', 'rank']   # 結合前の過去走の列
+HORSE_KEY    = 'horse_id'   # 保存するキューブの馬のキー（馬名キーの古いキューブは使わない）
+
+def _bin_range(rng, width):
+    """(下限, 上限) を含むビン番号の範囲。None は全範囲"""
+    if rng is None:
+        return None
+    lo, hi = rng
+    return int(np.floor(lo / width)), int(np.ceil(hi / width)) - 1
+
+class ConditionCube:
+    def __init__(self):
+        empty = pd.DataFrame(columns=['runs', 'top3'], dtype='int64')
+        self.horse = empty.set_index(pd.MultiIndex.from_tuples([], names=[HORSE_KEY] + DIMS))
+        self.track = empty.set_index(pd.MultiIndex.from_tuples([], names=DIMS))
+        self.seen  = set()
+
+    # ── 保存・読み込み ──────────────────────────────────
+    @classmethod
+    def load(cls, path=CUBE_FILE):
+        cube = cls()
+        if os.path.exists(path):
+            data = pd.read_pickle(path)
+            if data.get('key') != HORSE_KEY:
+                print(f"{path} は馬名で集計した古い形式のため作り直します"
+                      f"（python condition_cube.py で出力済みのCSVを追加できます）")
+                return cube
+            cube.horse, cube.track, cube.seen = data['horse'], data['track'], data['seen']
+        return cube
+
+    def save(self, path=CUBE_FILE):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        pd.to_pickle({'key': HORSE_KEY, 'horse': self.horse, 'track': self.track,
+                      'seen': self.seen}, path)
+
+    # ── 差分加算 ────────────────────────────────────────
+    def add_runs(self, runs):
+        """
+        過去走（cushion / moisture 結合済み）を加算する。既に数えた走は無視する。
+        戻り値: 新たに加算した走数
+        """
+        need = set(RUN_KEY) | {'cushion', 'moisture', 'surface', 'distance', 'rank'}
+        if runs.empty or not need.issubset(runs.columns):
+            return 0
+        c = pd.to_numeric(runs['cushion'],  errors='coerce')
+        m = pd.to_numeric(runs['moisture'], errors='coerce')
+        runs = runs[c.notna() & m.notna()]
+        keys = list(zip(*[runs[k].astype(str) for k in RUN_KEY]))
+        new = np.array([k not in self.seen for k in keys], dtype=bool)
+        # 同じバッチ内の重複も1回だけ数える
+        new &= ~pd.Series(keys, dtype=object).duplicated().to_numpy()
+        if not new.any():
+            return 0
+        runs = runs[new]
+
+        rank = pd.to_numeric(runs['rank'], errors='coerce')
+        binned = pd.DataFrame({
+            'horse_id':     runs['horse_id'].astype('int64').to_numpy(),
+            'cushion_bin':  np.floor(pd.to_numeric(runs['cushion']) / CUSHION_BIN).astype(int).to_numpy(),
+            'moisture_bin': np.floor(pd.to_numeric(runs['moisture']) / MOISTURE_BIN).astype(int).to_numpy(),
+            'surface':      runs['surface'].astype(str).to_numpy(),
+            'venue':        runs['venue'].apply(clean_venue).to_numpy(),
+            'dist_band':    pd.cut(pd.to_numeric(runs['distance'], errors='coerce'),
+                                   DIST_BANDS, labels=DIST_LABELS).astype(str).to_numpy(),
+            'runs':         1,
+            'top3':         (rank <= 3).astype(int).to_numpy(),
+        })
+        h = binned.groupby([HORSE_KEY] + DIMS)[['runs', 'top3']].sum()
+        t = binned.groupby(DIMS)[['runs', 'top3']].sum()
+        self.horse = self.horse.add(h, fill_value=0).astype('int64').sort_index()
+        self.track = self.track.add(t, fill_value=0).astype('int64').sort_index()
+        self.seen.update(k for k, n in zip(keys, new) if n)
+        return int(new.sum())
+
+    # ── 問い合わせ ──────────────────────────────────────
+    def _select(self, table, cushion=None, moisture=None, surface=None, venue=None,
+                dist_band=None):
+        if table.empty:
+            return table
+        idx = table.index
+        mask = np.ones(len(table), dtype=bool)
+        for level, rng, width in [('cushion_bin', cushion, CUSHION_BIN),
+                                  ('moisture_bin', moisture, MOISTURE_BIN)]:
+            b = _bin_range(rng, width)
+            if b is not None:
+                vals = idx.get_level_values(level)
+                mask &= (vals >= b[0]) & (vals <= b[1])
+        for level, val in [('surface', surface), ('venue', venue), ('dist_band', dist_band)]:
+            if val is not None:
+                mask &= idx.get_level_values(level) == val
+        return table[mask]
+
+    def _horse_table(self, horse_id):
+        """馬1頭分のマス（ソート済みインデックスなので二分探索で取り出せる）"""
+        try:
+            return self.horse.xs(int(horse_id), level=HORSE_KEY)
+        except KeyError:
+            return self.track.iloc[0:0]
+
+    def horse_record(self, horse_id, cushion=None, moisture=None, surface=None,
+                     venue=None, dist_band=None):
+        """
+        馬の成績（走数, 3着以内数）。cushion / moisture は (下限, 上限) で指定する。
+        例: horse_record(2021104321, moisture=(12, 14)) → 含水率12〜14%での成績
+        """
+        table = self._horse_table(horse_id)
+        sub = self._select(table, cushion, moisture, surface, venue, dist_band)
+        return int(sub['runs'].sum()), int(sub['top3'].sum())
+
+    def heatmap(self, horse_id=None, surface=None, venue=None, dist_band=None):
+        """
+        クッション値帯 × 含水率帯 ごとの走数・3着以内数・3着以内率（縦持ち）。
+        horse_id を省略すると全体（track-wide）。
+        """
+        table = self.track if horse_id is None else self._horse_table(horse_id)
+        sub = self._select(table, surface=surface, venue=venue, dist_band=dist_band)
+        grid = sub.groupby(level=['cushion_bin', 'moisture_bin'])[['runs', 'top3']].sum()
+        grid = grid.reset_index()
+        grid['cushion']  = grid['cushion_bin'] * CUSHION_BIN
+        grid['moisture'] = grid['moisture_bin'] * MOISTURE_BIN
+        grid['rate'] = grid['top3'] / grid['runs'].where(grid['runs'] > 0)
+        return grid
+
+def runs_with_conditions(race_df, moisture_df):
+    """過去走それぞれの芝/ダートに合わせてクッション値・含水率を結合する"""
+    if race_df.empty or 'surface' not in race_df.columns:
+        return pd.DataFrame()
+    parts = [merge_data(race_df[race_df['surface'] == s], moisture_df, surface=s)
+             for s in race_df['surface'].dropna().unique()]
+    parts = [p for p in parts if not p.empty]
+    return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
+def read_runs(path):
+    """
+    出力CSV・過去走データ（xlsx / parquet）から結合前の過去走の列だけを読む。
+    出力CSVの cushion / moisture は今回のレースの芝/ダートで結合した値なので使わない。
+    """
+    ext = os.path.splitext(path)[1].lower()
+    df = (pd.read_csv(path) if ext == '.csv' else
+          pd.read_parquet(path) if ext == '.parquet' else pd.read_excel(path))
+    df = df[[c for c in RUN_COLS if c in df.columns]].copy()
+    if 'race_date' in df.columns:
+        # main_analysis が加算する過去走と同じ形（日時）にそろえる（同じ走を二重に数えない）
+        df['race_date'] = pd.to_datetime(df['race_date'], errors='coerce')
+    return df
+
+def update_cube(runs, path=CUBE_FILE):
+    """保存済みキューブに過去走を加算して保存する"""
+    cube = ConditionCube.load(path)
+    added = cube.add_runs(runs)
+    if added:
+        cube.save(path)
+    return cube, added
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        return
+    cube = ConditionCube.load()
+    moisture_df = load_moisture_history()
+    frames = [(path, read_runs(path)) for path in sys.argv[1:]]
+    # 馬IDのない古いCSVの馬は、他のCSVで馬ID付きで出てくる同名馬に合わせる
+    known = horse_id_map(df for _, df in frames)
+    for path, df in frames:
+        runs = runs_with_conditions(ensure_horse_ids(df, known), moisture_df)
+        added = cube.add_runs(runs)
+        print(f"{path}: {added}走を追加")
+    cube.save()
+    print(f"キューブ: {len(cube.seen)}走 / {len(cube.track)}マス（全体） → {CUBE_FILE}")
+
+if __name__ == '__main__':
+    main()
@@ -6,16 +6,30 @@ Horse Racing Analysis System - Multi-Race Version
   - get_kaisai_day: race_idから直接開催日番号を安定取得
   - 含水率・クッション値をJRAサイトから自動取得
   - 芝・ダート含水率を自動切り替え
+
+使い方:
+  python main_analysis.py                          # settings.txt の設定で 1〜12R
+  python main_analysis.py --races 9-12 --phases merge,render --cushion 9.8
+  python main_analysis.py --phases scrape          # 取得だけ（結合・グラフは後で）
+  python main_analysis.py --races 11 --dry-run     # 実行せずに所要時間を見積もる
+  python main_analysis.py --watch --interval 600   # 馬場情報の更新に合わせて描き直す
+  python main_analysis.py --browser 軽量            # 画像・広告を読み込まない Chrome で取得
+  python main_analysis.py --fresh                  # 中断した実行を再開せず最初から
 """
 
 import pandas as pd
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 from matplotlib.lines import Line2D
 import numpy as np
-import os, time, re, platform
-from datetime import datetime
+import os, time, re, platform, json, threading, hashlib, zlib, sqlite3
+from collections import OrderedDict
+from contextlib import contextmanager
+import urllib.request, urllib.error
+from urllib.parse import urlsplit
+from datetime import datetime, timedelta
 
 # ============================================================
 # 定数
@@ -30,21 +44,25 @@ VENUE_EN = {
     '中京':'Chukyo','新潟':'Niigata','福島':'Fukushima',
     '小倉':'Kokura','函館':'Hakodate','札幌':'Sapporo',
 }
-# JRA馬場情報URL（競馬場別）
-VENUE_BABA_URL = {
-    '東京': 'https://www.jra.go.jp/keiba/baba/',
-    '中山': 'https://www.jra.go.jp/keiba/baba/index2.html',
-    '京都': 'https://www.jra.go.jp/keiba/baba/index2.html',
-    '阪神': 'https://www.jra.go.jp/keiba/baba/index2.html',
-    '中京': 'https://www.jra.go.jp/keiba/baba/index2.html',
-    '新潟': 'https://www.jra.go.jp/keiba/baba/index3.html',
-    '福島': 'https://www.jra.go.jp/keiba/baba/index3.html',
-    '小倉': 'https://www.jra.go.jp/keiba/baba/index3.html',
-    '函館': 'https://www.jra.go.jp/keiba/baba/index3.html',
-    '札幌': 'https://www.jra.go.jp/keiba/baba/index3.html',
+# 取得先の既定URL（settings.txt で replay_server.py などに差し替え可能）
+RACE_BASE_URL = 'https://race.netkeiba.com'
+BABA_BASE_URL = 'https://www.jra.go.jp'
+# JRA馬場情報ページ（競馬場別、BABA_BASE_URL からのパス）
+VENUE_BABA_PATH = {
+    '東京': '/keiba/baba/',
+    '中山': '/keiba/baba/index2.html',
+    '京都': '/keiba/baba/index2.html',
+    '阪神': '/keiba/baba/index2.html',
+    '中京': '/keiba/baba/index2.html',
+    '新潟': '/keiba/baba/index3.html',
+    '福島': '/keiba/baba/index3.html',
+    '小倉': '/keiba/baba/index3.html',
+    '函館': '/keiba/baba/index3.html',
+    '札幌': '/keiba/baba/index3.html',
 }
 VENUE_LIST = list(VENUE_EN.keys())
 MOISTURE_FILE = '含水率.xlsx'
+MOISTURE_CANDIDATES = [MOISTURE_FILE, './data/含水率.xlsx', './data/moisture_data.xlsx']
 
 DEMO_SAMPLES = [
     {'horse_name':'Sample_A','cushion':9.3,'moisture':7.4,'rank':2,'distance':1300},
@@ -80,6 +98,15 @@ def load_settings():
         'ダート含水率':   'auto',
         'デモモード':     'True',
         'スクレイピング': 'True',
+        '個別グラフ遅延生成': 'False',
+        '好走密度表示':   'False',
+        '過去走の範囲':   '7',
+        'レース情報URL':  RACE_BASE_URL,
+        '馬場情報URL':    BABA_BASE_URL,
+        'メモリ上限MB':   '0',
+        'メトリクス出力先': '',
+        '取得レート':     '1.0',
+        'ブラウザプロファイル': '標準',
     }
     settings_file = 'settings.txt'
     if not os.path.exists(settings_file):
@@ -106,6 +133,34 @@ def load_settings():
 # ============================================================
 デモモード = True
 スクレイピング = True
+
+# 個別グラフの遅延生成（True = 表示時に生成 / False = 一括生成）
+個別グラフ遅延生成 = False
+
+# グラフ背景に好走密度（True = 表示 / False = 非表示）
+好走密度表示 = False
+
+# 過去走の範囲（7 = 近7走 / 365日 = 過去365日 / 全走）
+過去走の範囲 = 7
+
+# 取得先（replay_server.py で試す場合: http://127.0.0.1:8503）
+レース情報URL = https://race.netkeiba.com
+馬場情報URL = https://www.jra.go.jp
+
+# メモリ上限（MB、0 = 制限なし）。超えている間は次の Chrome の起動を遅らせる（psutil が必要）
+メモリ上限MB = 0
+
+# メトリクス（Prometheus テキスト形式）の追加出力先フォルダ（空欄 = 出力フォルダのみ）
+# node_exporter の --collector.textfile.directory を指定すると収集される
+メトリクス出力先 =
+
+# 取得先ホストごとの最大取得回数（回/秒）。応答が遅いときや失敗が続くときは自動で下げる
+# （work_queue.py のワーカーはキューファイルで共有し、全ワーカーの合計がこの値になる）
+取得レート = 1.0
+
+# Chrome のプロファイル（標準 / 軽量）。軽量 = 画像・フォント・広告や計測タグを読み込まず、
+# DOM ができた時点で読み取りを始める。ページごとの転送量と時間は perf_report.json に出る
+ブラウザプロファイル = 標準
 """)
         print("settings.txt を新規作成しました")
 
@@ -126,9 +181,670 @@ def load_settings():
         print(f"settings.txt 読み込みエラー: {e}")
     return cfg
 
+# ============================================================
+# 処理時間の計測
+# ============================================================
+class RunTimer:
+    """
+    処理ごとの所要時間を記録し、集計レポート（JSON）を作る。
+      with TIMER.span('merge_data', '3R'): ...
+    スパンは入れ子にできる（例: draw_graph の中の png_write）。
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._spans = []
+        self._active = []   # 実行中のスパン名（リソース計測の帰属先）
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+        self._started = datetime.now().isoformat(timespec='seconds')
+
+    def add(self, stage, item, sec):
+        with self._lock:
+            self._spans.append((stage, str(item), sec))
+
+    @contextmanager
+    def span(self, stage, item=''):
+        t = time.perf_counter()
+        with self._lock:
+            self._active.append(stage)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active.remove(stage)
+            self.add(stage, item, time.perf_counter() - t)
+
+    def current_stage(self):
+        """いちばん内側の実行中スパン名（なければ 'other'）"""
+        with self._lock:
+            return self._active[-1] if self._active else 'other'
+
+    def sleep(self, sec, item=''):
+        """待機時間も 'sleep' として記録する"""
+        with self.span('sleep', item):
+            time.sleep(sec)
+
+    def report(self, top=10):
+        with self._lock:
+            spans = list(self._spans)
+        stages = {}
+        for stage in dict.fromkeys(s for s, _, _ in spans):
+            secs = np.array([sec for s, _, sec in spans if s == stage])
+            slow = sorted(((sec, item) for s, item, sec in spans if s == stage),
+                          reverse=True)[:3]
+            stages[stage] = {
+                'count': int(len(secs)),
+                'total': round(float(secs.sum()), 4),
+                'mean':  round(float(secs.mean()), 4),
+                'p50':   round(float(np.percentile(secs, 50)), 4),
+                'p90':   round(float(np.percentile(secs, 90)), 4),
+                'p99':   round(float(np.percentile(secs, 99)), 4),
+                'max':   round(float(secs.max()), 4),
+                'slowest': [{'item': item, 'sec': round(sec, 4)} for sec, item in slow],
+            }
+        slowest = sorted(spans, key=lambda x: -x[2])[:top]
+        return {
+            'started':  self._started,
+            'wall_sec': round(time.perf_counter() - self._t0, 3),
+            'stages':   stages,
+            'slowest':  [{'stage': s, 'item': i, 'sec': round(sec, 4)} for s, i, sec in slowest],
+        }
+
+    def save(self, path, extra=None):
+        rep = self.report()
+        rep.update(extra or {})
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(rep, f, ensure_ascii=False, indent=1)
+        return rep
+
+TIMER = RunTimer()
+
+# ============================================================
+# メモリ使用量の計測
+# ============================================================
+try:
+    import psutil
+except ImportError:   # psutil がなければ自プロセスのピークのみ（ブラウザ分は計測しない）
+    psutil = None
+
+def _self_rss_mb():
+    """psutil なしの場合の自プロセスRSS（Linux は現在値、それ以外はピーク値）"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / (1024 if platform.system() == 'Darwin' else 1)
+    except Exception:
+        return 0.0
+
+class ResourceMonitor:
+    """
+    バックグラウンドで Python プロセスと子プロセス（Chrome / chromedriver）の
+    RSS を一定間隔で記録する。TIMER の実行中スパンごとのピークも残す。
+    memory_cap_mb を指定すると、上限を超えている間は次の Chrome の起動を遅らせる
+    （Chrome は1つずつ起動するので、同時に動く数を制限するものではない）。
+    """
+    def __init__(self, interval=0.5, memory_cap_mb=0):
+        self.interval = interval
+        self.memory_cap_mb = memory_cap_mb
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.samples = 0
+        self.peak = {'python_mb': 0.0, 'browser_mb': 0.0, 'total_mb': 0.0}
+        self.stage_peak = {}
+        self.figure = {'max_canvas_mb': 0.0, 'max_rss_delta_mb': 0.0, 'item': ''}
+        self.throttle = {'waits': 0, 'wait_sec': 0.0}
+        self.max_browsers = 0
+
+    def sample(self):
+        """(Python RSS, 子プロセス RSS 合計, 子プロセス数) を MB で返す"""
+        if psutil is None:
+            return _self_rss_mb(), 0.0, 0
+        proc = psutil.Process()
+        py = proc.memory_info().rss / 2**20
+        kids, n = 0.0, 0
+        for child in proc.children(recursive=True):
+            try:
+                kids += child.memory_info().rss / 2**20
+                if 'chrom' in child.name().lower():
+                    n += 1
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        return py, kids, n
+
+    def record(self):
+        py, kids, n = self.sample()
+        total = py + kids
+        stage = TIMER.current_stage()
+        with self._lock:
+            self.samples += 1
+            self.peak['python_mb']  = max(self.peak['python_mb'], py)
+            self.peak['browser_mb'] = max(self.peak['browser_mb'], kids)
+            self.peak['total_mb']   = max(self.peak['total_mb'], total)
+            self.stage_peak[stage]  = max(self.stage_peak.get(stage, 0.0), total)
+            self.max_browsers = max(self.max_browsers, n)
+        return total
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.record()
+            except Exception:
+                pass
+
+    def start(self):
+        self.reset()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+        self.record()
+
+    def note_figure(self, item, canvas_mb, rss_delta_mb):
+        with self._lock:
+            if canvas_mb > self.figure['max_canvas_mb']:
+                self.figure.update(max_canvas_mb=round(canvas_mb, 1), item=item)
+            self.figure['max_rss_delta_mb'] = round(
+                max(self.figure['max_rss_delta_mb'], rss_delta_mb), 1)
+
+    def wait_for_headroom(self, timeout=60):
+        """
+        メモリ上限を超えている間、次の Chrome の起動を遅らせる（最長 timeout 秒。上限なしなら何もしない）。
+        描画中の図は各スレッドが自分で閉じるので、ここでは閉じない。
+        """
+        if not self.memory_cap_mb or psutil is None:
+            return
+        t0 = time.perf_counter()
+        waited = False
+        while self.record() > self.memory_cap_mb and time.perf_counter() - t0 < timeout:
+            if not waited:
+                print(f"      メモリ上限 {self.memory_cap_mb}MB 超過 → Chrome 起動待ち")
+                waited = True
+            time.sleep(1)
+        if waited:
+            with self._lock:
+                self.throttle['waits'] += 1
+                self.throttle['wait_sec'] = round(
+                    self.throttle['wait_sec'] + time.perf_counter() - t0, 2)
+
+    def report(self):
+        with self._lock:
+            return {
+                'psutil':        psutil is not None,
+                'samples':       self.samples,
+                'peak_mb':       {k: round(v, 1) for k, v in self.peak.items()},
+                'stage_peak_mb': {k: round(v, 1) for k, v in
+                                  sorted(self.stage_peak.items(), key=lambda x: -x[1])},
+                'max_browsers':  self.max_browsers,
+                'figure':        dict(self.figure),
+                'memory_cap_mb': self.memory_cap_mb,
+                'throttle':      dict(self.throttle),
+            }
+
+MONITOR = ResourceMonitor()
+
+# ============================================================
+# メトリクス（Prometheus テキスト / JSON Lines）
+# ============================================================
+METRIC_PREFIX = 'keiba_'
+METRIC_HELP = {
+    'pages_fetched_total':  ('counter',   '取得したページ数'),
+    'fetch_failures_total': ('counter',   'ページ取得の失敗数'),
+    'retries_total':        ('counter',   'リトライ回数'),
+    'driver_restarts_total':('counter',   'Chrome の再起動回数'),
+    'rows_parsed_total':    ('counter',   '読み取った過去走の行数'),
+    'horses_detected':      ('gauge',     '出馬表で検出した頭数'),
+    'merge_match_ratio':    ('gauge',     'merge_data で馬場情報が結合できた割合'),
+    'pages_per_second':     ('gauge',     'スクレイピング中のページ取得速度'),
+    'run_seconds':          ('gauge',     '1回の実行の所要時間'),
+    'fetch_rate':           ('gauge',     'ホストごとの取得レート（回/秒、応答時間で調整）'),
+    'fetch_decisions_total':('counter',   '取得ポリシーの判断（待機・バックオフ・ブレーカー等）'),
+    'bytes_transferred_total':('counter', 'ページ取得の転送バイト数（Chrome のパフォーマンスログ）'),
+    'fetch_seconds':        ('histogram', 'ページ取得（driver.get）の所要時間'),
+    'render_seconds':       ('histogram', 'draw_graph の所要時間'),
+}
+METRIC_BUCKETS = {
+    'fetch_seconds':  [0.25, 0.5, 1, 2, 5, 10, 30],
+    'render_seconds': [0.1, 0.25, 0.5, 1, 2, 5],
+}
+
+class Metrics:
+    """ラベル付きのカウンター・ゲージ・ヒストグラム（スレッドセーフ）"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._values = {}   # (name, labels) → 値 / ヒストグラムは [各バケット..., 合計, 件数]
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        buckets = METRIC_BUCKETS[name]
+        key = self._key(name, labels)
+        with self._lock:
+            h = self._values.setdefault(key, [0] * (len(buckets) + 2))
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def get(self, name, **labels):
+        with self._lock:
+            return self._values.get(self._key(name, labels), 0)
+
+    def total(self, name):
+        """ラベルを問わない合計（カウンター用）"""
+        with self._lock:
+            return sum(v for (n, _), v in self._values.items() if n == name)
+
+    def prometheus(self, const_labels=None):
+        """Prometheus テキスト形式（node_exporter の textfile collector 用）"""
+        const = tuple(sorted((const_labels or {}).items()))
+        def fmt(labels, extra=()):
+            items = const + labels + extra
+            if not items:
+                return ''
+            esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"')
+            return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in items) + '}'
+
+        with self._lock:
+            values = dict(self._values)
+        lines = []
+        for name, (mtype, help_text) in METRIC_HELP.items():
+            series = [(labels, v) for (n, labels), v in values.items() if n == name]
+            if not series:
+                continue
+            full = METRIC_PREFIX + name
+            lines.append(f"# HELP {full} {help_text}")
+            lines.append(f"# TYPE {full} {mtype}")
+            for labels, v in sorted(series):
+                if mtype != 'histogram':
+                    lines.append(f"{full}{fmt(labels)} {v}")
+                    continue
+                for le, cnt in zip(METRIC_BUCKETS[name], v):
+                    lines.append(f"{full}_bucket{fmt(labels, (('le', str(le)),))} {cnt}")
+                lines.append(f"{full}_bucket{fmt(labels, (('le', '+Inf'),))} {v[-1]}")
+                lines.append(f"{full}_sum{fmt(labels)} {round(v[-2], 6)}")
+                lines.append(f"{full}_count{fmt(labels)} {v[-1]}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """JSON 用: {名前: [{labels, value} or {labels, count, sum, buckets}]}"""
+        with self._lock:
+            values = dict(self._values)
+        out = {}
+        for (name, labels), v in sorted(values.items()):
+            entry = {'labels': dict(labels)}
+            if name in METRIC_BUCKETS:
+                entry.update(count=v[-1], sum=round(v[-2], 6),
+                             buckets=dict(zip(map(str, METRIC_BUCKETS[name]), v[:-2])))
+            else:
+                entry['value'] = v
+            out.setdefault(name, []).append(entry)
+        return out
+
+    def write_textfile(self, path, const_labels=None):
+        """一時ファイルに書いてから置き換える（収集側が書きかけを読まないように）"""
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.prometheus(const_labels))
+        os.replace(tmp, path)
+
+    def append_jsonl(self, path, **context):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        line = {'time': datetime.now().isoformat(timespec='seconds'), **context,
+                'metrics': self.snapshot()}
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(line, ensure_ascii=False) + '\n')
+
+METRICS = Metrics()
+
+# ============================================================
+# 取得ポリシー（レート制限・バックオフ・サーキットブレーカー）
+# ============================================================
+class SharedHostState:
+    """
+    FetchPolicy のホストごとの状態を SQLite のファイルに置く（work_queue.py の複数ワーカーで共有）。
+    1ホスト1行（状態は JSON）。読み書きは書き込みロックを先に取ったトランザクションで行う。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS fetch_hosts '
+                          '(host TEXT PRIMARY KEY, state TEXT NOT NULL)')
+
+    @contextmanager
+    def host(self, host, new):
+        """ホストの状態 dict（なければ new()）。ブロックを抜けるときに書き戻す"""
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute('SELECT state FROM fetch_hosts WHERE host = ?',
+                                    (host,)).fetchone()
+            h = json.loads(row[0]) if row else new()
+            yield h
+            self.conn.execute('INSERT OR REPLACE INTO fetch_hosts (host, state) VALUES (?, ?)',
+                              (host, json.dumps(h)))
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+
+class FetchPolicy:
+    """
+    全ページ取得で共有する取得ルール（スレッドセーフ、ホストごと）。
+      - トークンバケット: 1秒あたり rate 回まで（burst 回までは続けて取得可）
+      - 応答時間に合わせて rate を調整（遅ければ下げ、速ければ少しずつ戻す）
+      - 失敗時のリトライはジッター付き指数バックオフ
+      - 連続 breaker_failures 回失敗したホストは breaker_cooldown 秒止める
+        （その後は1件だけ試し、結果が出るまで他の取得は待つ）
+    configure(shared=ファイル) でホストの状態を SQLite に置くと、複数のプロセス
+    （work_queue.py のワーカー）で1つのバケット・ブレーカーを共有する。
+    判断はすべて log に記録し、log_path があれば JSON Lines で追記する。
+    """
+    def __init__(self, rate=1.0, burst=2, min_rate=0.1, slow_sec=4.0, fast_sec=1.5,
+                 backoff_base=2.0, backoff_max=60.0, breaker_failures=4, breaker_cooldown=60.0,
+                 trial_timeout=120.0):
+        self.base_rate        = rate
+        self.burst            = burst
+        self.min_rate         = min_rate
+        self.slow_sec         = slow_sec   # 応答時間の移動平均がこれを超えたら rate を下げる
+        self.fast_sec         = fast_sec   # これを下回っていれば rate を base_rate まで戻していく
+        self.backoff_base     = backoff_base
+        self.backoff_max      = backoff_max
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.trial_timeout    = trial_timeout   # 半開の試行が結果を返さないときに次を通すまでの秒数
+        self.log_path = None
+        self.shared   = None
+        self._lock  = threading.Lock()
+        self._rng   = np.random.default_rng()
+        self.reset()
+
+    def reset(self, rate=None, log_path=None):
+        """ホストごとの状態と記録を消す（log_path のファイルも空にする。共有もやめる）"""
+        with self._lock:
+            self.log   = []
+            self.hosts = {}
+            self.shared = None
+        self.configure(rate, log_path)
+        if log_path:
+            open(log_path, 'w', encoding='utf-8').close()
+
+    def configure(self, rate=None, log_path=None, shared=None):
+        """状態を保ったまま設定だけ変える。shared: ホストの状態を置く SQLite ファイル"""
+        with self._lock:
+            if rate is not None and rate > 0:
+                self.base_rate = rate
+                for h in self.hosts.values():
+                    h['rate'] = min(h['rate'], rate)
+            if log_path is not None:
+                self.log_path = log_path
+            if shared is not None and (self.shared is None or self.shared.path != shared):
+                self.shared = SharedHostState(shared)
+
+    def _new_host(self):
+        # 時刻は time.time()（共有するとプロセスをまたいで比べるため）
+        return {'rate': self.base_rate, 'tokens': float(self.burst), 'refill': time.time(),
+                'latency': None, 'failures': 0, 'open_until': 0.0, 'trial_until': 0.0,
+                'cooldown': self.breaker_cooldown}
+
+    @contextmanager
+    def _state(self, host):
+        """ホストの状態（ロック内）。共有していればファイル上の行を読み書きし、手元にも写す"""
+        with self._lock:
+            if self.shared is None:
+                if host not in self.hosts:
+                    self.hosts[host] = self._new_host()
+                yield self.hosts[host]
+            else:
+                with self.shared.host(host, self._new_host) as h:
+                    h['rate'] = min(h['rate'], self.base_rate)
+                    yield h
+                self.hosts[host] = h
+
+    def _decide(self, decision, target, **detail):
+        """判断を記録する（ロック内から呼ぶ）。target はホスト名、バックオフは取得の種類"""
+        entry = {'time': datetime.now().isoformat(timespec='milliseconds'),
+                 'decision': decision, 'target': target, **detail}
+        self.log.append(entry)
+        METRICS.inc('fetch_decisions_total', decision=decision)
+        if self.log_path:
+            try:
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            except OSError:
+                pass
+        if decision in ('circuit_open', 'circuit_close', 'backoff'):
+            print(f"      [取得ポリシー] {decision} {target} "
+                  + ' '.join(f"{k}={v}" for k, v in detail.items()))
+
+    def acquire(self, host):
+        """
+        取得してよくなるまで待つ（ブレーカーが開いていれば閉じるまで、トークンがなければ補充まで）。
+        止める時間が過ぎたら1件だけ試しに通し、その結果が record されるまで他は待たせる
+        （試した取得が trial_timeout 秒たっても結果を返さなければ、次の1件を通す）。
+        """
+        waited = 0.0
+        trial_wait = False
+        while True:
+            with self._state(host) as h:
+                now = time.time()
+                if h['open_until'] > now:
+                    wait = h['open_until'] - now
+                    self._decide('circuit_wait', host, wait=round(wait, 2))
+                elif h['failures'] >= self.breaker_failures and h['trial_until'] > now:
+                    wait = min(h['trial_until'] - now, 0.5)
+                    if not trial_wait:
+                        self._decide('trial_wait', host)
+                        trial_wait = True
+                elif h['failures'] >= self.breaker_failures:
+                    h['trial_until'] = now + self.trial_timeout
+                    self._decide('circuit_trial', host, failures=h['failures'])
+                    return waited
+                else:
+                    h['tokens'] = min(self.burst, h['tokens'] + (now - h['refill']) * h['rate'])
+                    h['refill'] = now
+                    if h['tokens'] >= 1:
+                        h['tokens'] -= 1
+                        if waited:
+                            self._decide('rate_wait', host, wait=round(waited, 3),
+                                         rate=round(h['rate'], 3))
+                        return waited
+                    wait = (1 - h['tokens']) / h['rate']
+            time.sleep(wait)
+            waited += wait
+            TIMER.add('rate_wait', host, wait)
+
+    def record(self, host, ok, seconds, reason=None):
+        """
+        取得結果を反映する（rate の調整とブレーカーの開閉）。
+        reason: 取れたが使えなかったページ（ブロック・制限ページ、検出0頭、空の表など）の理由
+        """
+        with self._state(host) as h:
+            if reason:
+                self._decide('unusable_page', host, reason=reason)
+            h['latency'] = seconds if h['latency'] is None else 0.7 * h['latency'] + 0.3 * seconds
+            old = h['rate']
+            if ok:
+                if h['failures'] >= self.breaker_failures:
+                    self._decide('circuit_close', host, latency=round(seconds, 2))
+                    h['cooldown'] = self.breaker_cooldown
+                h['failures'] = 0
+                h['trial_until'] = 0.0
+                if h['latency'] > self.slow_sec:
+                    h['rate'] = max(self.min_rate, h['rate'] * 0.75)
+                elif h['latency'] < self.fast_sec and h['rate'] < self.base_rate:
+                    h['rate'] = min(self.base_rate, h['rate'] + 0.1 * self.base_rate)
+            else:
+                h['failures'] += 1
+                h['rate'] = max(self.min_rate, h['rate'] * 0.5)
+                if h['failures'] >= self.breaker_failures:
+                    # 半開状態での失敗は止める時間を倍にする
+                    if h['failures'] > self.breaker_failures:
+                        h['cooldown'] = min(h['cooldown'] * 2, 10 * self.breaker_cooldown)
+                    h['open_until'] = time.time() + h['cooldown']
+                    h['trial_until'] = 0.0
+                    self._decide('circuit_open', host, failures=h['failures'],
+                                 cooldown=h['cooldown'])
+            if h['rate'] != old:
+                self._decide('rate_down' if h['rate'] < old else 'rate_up', host,
+                             rate=round(h['rate'], 3), latency=round(h['latency'], 2), ok=ok)
+            METRICS.set('fetch_rate', round(h['rate'], 4), host=host)
+
+    def backoff(self, attempt, kind, key=''):
+        """attempt 回目（1〜）のリトライ前の待ち時間: base * 2^(attempt-1) の 50〜100%"""
+        cap = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+        with self._lock:
+            wait = round(cap * (0.5 + 0.5 * self._rng.random()), 2)
+            self._decide('backoff', kind, attempt=attempt, wait=wait, item=str(key)[:80])
+        TIMER.sleep(wait, key)
+        return wait
+
+    def attempts(self, n, kind, key=''):
+        """リトライ付きのループ用: for attempt in FETCH_POLICY.attempts(3, 'shutuba', url)"""
+        for attempt in range(n):
+            if attempt:
+                METRICS.inc('retries_total', kind=kind)
+                self.backoff(attempt, kind, key)
+            yield attempt
+
+    def report(self):
+        with self._lock:
+            counts = {}
+            for e in self.log:
+                counts[e['decision']] = counts.get(e['decision'], 0) + 1
+            return {
+                'decisions': counts,
+                'hosts': {host: {'rate': round(h['rate'], 4),
+                                 'latency': round(h['latency'], 3) if h['latency'] else None,
+                                 'failures': h['failures']}
+                          for host, h in self.hosts.items()},
+            }
+
+FETCH_POLICY = FetchPolicy()
+
+# ブロック・アクセス制限のページ（Selenium では HTTP ステータスが見えないのでタイトルで判定）
+BLOCKED_TITLES = ('403', 'forbidden', 'access denied', 'too many requests',
+                  'アクセスが集中', 'アクセス制限')
+USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+              'AppleWebKit/537.36 Chrome/120.0.0.0 Safari/537.36')
+
+class UnusablePage(Exception):
+    """ページは取れたが中身が使えない（取得ポリシーには失敗として記録済み）"""
+
+def blocked_reason(driver):
+    title = str(getattr(driver, 'title', '') or '').lower()
+    return f"ブロック・制限ページ（{title[:40]}）" if any(t in title for t in BLOCKED_TITLES) else None
+
+def fetch_page(driver, url, kind, item=None, settle=0, check=None):
+    """
+    driver.get に取得ポリシー（レート制限・ブレーカー）と時間計測・メトリクスを付けたもの
+    （kind: race_list / baba / shutuba / horse）。
+    settle 秒待って（JavaScript の描画待ち）から check(driver) で中身を確かめ、
+    使えない理由（文字列）が返ったら失敗として記録して UnusablePage を送出する。
+    ブロック・制限ページは check がなくても失敗とする。
+    """
+    host = urlsplit(url).netloc
+    FETCH_POLICY.acquire(host)
+    BROWSER.before_get(driver)
+    t = time.perf_counter()
+    try:
+        with TIMER.span('page_get', item or url):
+            driver.get(url)
+    except Exception:
+        FETCH_POLICY.record(host, False, time.perf_counter() - t)
+        METRICS.inc('fetch_failures_total', kind=kind)
+        raise
+    finally:
+        METRICS.observe('fetch_seconds', time.perf_counter() - t, kind=kind)
+    sec = time.perf_counter() - t
+    METRICS.inc('pages_fetched_total', kind=kind)
+    BROWSER.after_get(driver, kind, sec)
+    if settle:
+        TIMER.sleep(settle, item or url)
+    reason = blocked_reason(driver) or (check(driver) if check else None)
+    FETCH_POLICY.record(host, not reason, sec, reason=reason)
+    if reason:
+        METRICS.inc('fetch_failures_total', kind=kind)
+        raise UnusablePage(reason)
+
+def fetch_text(url, kind, headers=None, timeout=30):
+    """
+    ブラウザを使わない HTTP GET に fetch_page と同じ取得ポリシーと計測を付けたもの。
+    headers に If-None-Match / If-Modified-Since を渡した条件付き取得では 304 も成功として扱う。
+    戻り値: (ステータス, 応答ヘッダー, 本文の文字列。304 は '')
+    """
+    host = urlsplit(url).netloc
+    FETCH_POLICY.acquire(host)
+    req = urllib.request.Request(url, headers={'User-Agent': USER_AGENT, **(headers or {})})
+    t = time.perf_counter()
+    try:
+        with TIMER.span('page_get', url):
+            try:
+                with urllib.request.urlopen(req, timeout=timeout) as r:
+                    status, head, body = r.status, r.headers, r.read()
+            except urllib.error.HTTPError as e:
+                if e.code != 304:
+                    raise
+                status, head, body = 304, e.headers, b''
+    except Exception as e:
+        reason = f"HTTP {e.code}" if isinstance(e, urllib.error.HTTPError) else None
+        FETCH_POLICY.record(host, False, time.perf_counter() - t, reason=reason)
+        METRICS.inc('fetch_failures_total', kind=kind)
+        raise
+    finally:
+        METRICS.observe('fetch_seconds', time.perf_counter() - t, kind=kind)
+    FETCH_POLICY.record(host, True, time.perf_counter() - t)
+    METRICS.inc('pages_fetched_total', kind=kind)
+    charset = head.get_content_charset()
+    if charset is None:
+        meta = re.search(rb'charset=["\']?([\w-]+)', body[:4096])
+        charset = meta.group(1).decode('ascii') if meta else 'utf-8'
+    return status, head, body.decode(charset, errors='replace')
+
 # ============================================================
 # ユーティリティ
 # ============================================================
+def date_slug_of(date_str):
+    """'2026.2.15' → '2026_02_15'"""
+    parts = date_str.split('.')
+    return f"{parts[0]}_{int(parts[1]):02d}_{int(parts[2]):02d}"
+
+def output_dir(venue_jp, date_str):
+    return f"./output/{date_slug_of(date_str)}_{safe_name(venue_jp)}"
+
+def race_file_path(venue_jp, race_no):
+    return f"./data/race_data_{safe_name(venue_jp)}_{race_no}R.xlsx"
+
 def safe_name(text):
     if str(text) in VENUE_EN:
         return VENUE_EN[str(text)]
@@ -167,36 +883,266 @@ def safe_name(text):
     res = re.sub(r'_+', '_', res).strip('_')
     return res or 'horse'
 
+# 馬は netkeiba の馬ID（/horse/<id>/ の数字）で識別する。馬名は表示用の属性
+HORSE_ID_RE = re.compile(r'/horse/(\d+)')
+
+def horse_id_of(url):
+    """馬ページのURL → 馬ID（int）。取れなければ None"""
+    m = HORSE_ID_RE.search(str(url or ''))
+    return int(m.group(1)) if m else None
+
+def name_horse_id(name):
+    """馬IDのない古いデータ用の代わりのID（馬名から決まる負の整数。netkeiba の馬IDとは重ならない）"""
+    return -(zlib.crc32(str(name).encode('utf-8')) + 1)
+
+def horse_id_map(frames):
+    """
+    馬IDのある行から {馬名: 馬ID} を作る（netkeiba の馬IDだけ。代わりのIDは使わない）。
+    同じ馬名に複数の馬IDがある場合はどちらか決められないので入れない。
+    """
+    pairs = []
+    for df in frames:
+        if df.empty or 'horse_id' not in df.columns or 'horse_name' not in df.columns:
+            continue
+        ids = pd.to_numeric(df['horse_id'], errors='coerce')
+        pairs.append(pd.DataFrame({'name': df['horse_name'].astype(str), 'id': ids})[ids > 0])
+    if not pairs:
+        return {}
+    pairs = pd.concat(pairs, ignore_index=True).drop_duplicates()
+    pairs = pairs[~pairs['name'].duplicated(keep=False)]
+    return dict(zip(pairs['name'], pairs['id'].astype('int64')))
+
+def ensure_horse_ids(df, known=None):
+    """
+    horse_id 列（int64）を保証する。馬IDのない行は
+      1. 同じ馬名が馬ID付きで出てくる行（df 自身と known の {馬名: 馬ID}）の馬ID
+      2. それでもなければ馬名から name_horse_id
+    で補う（古いCSVと新しいCSVを混ぜても同じ馬が別の馬にならないように）。
+    """
+    if df.empty or 'horse_name' not in df.columns:
+        return df
+    ids = (pd.to_numeric(df['horse_id'], errors='coerce') if 'horse_id' in df.columns
+           else pd.Series(np.nan, index=df.index))
+    if ids.isna().any():
+        names = df['horse_name'].astype(str)
+        mapping = {**horse_id_map([df]), **(known or {})}
+        ids = ids.fillna(names.map(mapping)).fillna(names.map(name_horse_id))
+    return df.assign(horse_id=ids.astype('int64'))
+
+def horse_table(df):
+    """出現順の {馬ID: 馬名}"""
+    if df.empty or 'horse_id' not in df.columns:
+        return {}
+    first = df.drop_duplicates('horse_id')
+    names = first['horse_name'] if 'horse_name' in first.columns else first['horse_id']
+    return dict(zip(first['horse_id'].astype(int).tolist(), names.astype(str).tolist()))
+
+def parse_setting_number(text, key, default, minimum=0.0, above=False):
+    """
+    settings.txt / --set の数値項目を float にする。空欄は既定値。
+    数値でない・minimum 未満（above=True なら以下）の値は表示して既定値を使う（実行は止めない）。
+    """
+    t = str(text if text is not None else '').strip()
+    if not t:
+        return default
+    try:
+        value = float(t)
+    except ValueError:
+        value = None
+    if value is None or not np.isfinite(value) or value < minimum or (above and value == minimum):
+        print(f"   {key} '{text}' を解釈できません → {default} を使用")
+        return default
+    return value
+
 def clean_venue(text):
     for v in VENUE_LIST:
         if v in str(text):
             return v
     return ''
 
-def make_driver():
+# ============================================================
+# Chrome の起動プロファイルと転送量の記録
+# ============================================================
+BROWSER_PROFILES = {'standard': '標準', 'lean': '軽量'}
+BROWSER_STATS_FILE = './output/browser_profile_stats.json'
+
+# 軽量プロファイルで読み込まないURL（画像・フォント・広告・計測タグ）
+LEAN_BLOCKED_URLS = [
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.svg', '*.ico', '*.bmp',
+    '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot', '*.mp4', '*.webm',
+    '*googletagmanager.com*', '*google-analytics.com*', '*googlesyndication.com*',
+    '*doubleclick.net*', '*googleadservices.com*', '*adservice.google.*',
+    '*amazon-adsystem.com*', '*criteo.*', '*facebook.net*', '*facebook.com/tr*',
+    '*twitter.com/i/*', '*platform.twitter.com*', '*yimg.jp/images/listing*',
+    '*yads.yahoo.co.jp*', '*ads.yahoo.co.jp*', '*microad.jp*', '*i-mobile.co.jp*',
+    '*adingo.jp*', '*fout.jp*', '*socdm.com*', '*impact-ad.jp*', '*ad-stir.com*',
+    '*taboola.com*', '*outbrain.com*', '*clarity.ms*', '*hotjar.com*',
+]
+
+def parse_browser_profile(text):
+    """'標準' / 'standard' → 'standard'、'軽量' / 'lean' → 'lean'"""
+    text = str(text).strip().lower()
+    for key, label in BROWSER_PROFILES.items():
+        if text in (key, label):
+            return key
+    raise ValueError(f"ブラウザプロファイルは {' / '.join(BROWSER_PROFILES.values())} で指定してください: {text}")
+
+class BrowserUsage:
+    """
+    使用する Chrome のプロファイルと、プロファイル × ページ種類ごとの
+    取得ページ数・転送バイト数（Chrome のパフォーマンスログ）・取得時間を記録する。
+    """
+    def __init__(self):
+        self.profile = 'standard'
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, profile=None):
+        with self._lock:
+            if profile is not None:
+                self.profile = profile
+            self._stats = {}   # (profile, kind) → [ページ数, バイト数, 秒]
+
+    def options(self, opts, profile):
+        """ChromeOptions にプロファイルの設定を足す"""
+        # 転送量をパフォーマンスログから数える（両プロファイル共通）
+        opts.set_capability('goog:loggingPrefs', {'performance': 'ALL'})
+        if profile == 'lean':
+            opts.page_load_strategy = 'eager'   # DOM ができた時点で driver.get を返す
+            opts.add_argument('--window-size=1280,800')
+            opts.add_argument('--blink-settings=imagesEnabled=false')
+            opts.add_argument('--disable-extensions')
+            opts.add_argument('--disable-remote-fonts')
+            opts.add_argument('--mute-audio')
+            opts.add_experimental_option('prefs', {
+                'profile.managed_default_content_settings.images': 2,
+                'profile.default_content_setting_values.notifications': 2,
+            })
+        else:
+            opts.add_argument('--window-size=1920,1080')
+
+    def setup(self, driver, profile):
+        """起動直後の driver に設定する（軽量: 不要なURLを遮断）"""
+        driver._keiba_profile = profile
+        driver._keiba_last = None
+        if profile == 'lean':
+            try:
+                driver.execute_cdp_cmd('Network.enable', {})
+                driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': LEAN_BLOCKED_URLS})
+            except Exception as e:
+                print(f"   URL遮断の設定に失敗: {e}")
+
+    @staticmethod
+    def _drain_bytes(driver):
+        """前回以降のパフォーマンスログから転送バイト数を合計する（取れなければ 0）"""
+        try:
+            entries = driver.get_log('performance')
+        except Exception:
+            return 0
+        total = 0
+        for e in entries:
+            try:
+                msg = json.loads(e['message'])['message']
+            except (KeyError, ValueError, TypeError):
+                continue
+            if msg.get('method') == 'Network.loadingFinished':
+                total += msg.get('params', {}).get('encodedDataLength', 0) or 0
+        return int(total)
+
+    def _add(self, key, pages, nbytes, sec):
+        with self._lock:
+            s = self._stats.setdefault(key, [0, 0, 0.0])
+            s[0] += pages
+            s[1] += nbytes
+            s[2] += sec
+
+    def before_get(self, driver):
+        """前のページの描画待ちの間に届いた分は、前のページに足す"""
+        last = getattr(driver, '_keiba_last', None)
+        late = self._drain_bytes(driver)
+        if last is not None and late:
+            self._add(last, 0, late, 0.0)
+
+    def after_get(self, driver, kind, sec):
+        key = (getattr(driver, '_keiba_profile', self.profile), kind)
+        nbytes = self._drain_bytes(driver)
+        self._add(key, 1, nbytes, sec)
+        driver._keiba_last = key
+        METRICS.inc('bytes_transferred_total', nbytes, profile=key[0], kind=kind)
+
+    @staticmethod
+    def _summary(pages, nbytes, sec):
+        return {'pages': pages, 'bytes': nbytes, 'sec': round(sec, 3),
+                'kb_per_page':  round(nbytes / 1024 / pages, 1) if pages else None,
+                'sec_per_page': round(sec / pages, 3) if pages else None}
+
+    def report(self):
+        """{プロファイル: {合計, kinds: {ページ種類: ...}}}"""
+        with self._lock:
+            stats = dict(self._stats)
+        out = {}
+        for (profile, kind), (pages, nbytes, sec) in sorted(stats.items()):
+            p = out.setdefault(profile, {'total': [0, 0, 0.0], 'kinds': {}})
+            p['kinds'][kind] = self._summary(pages, nbytes, sec)
+            p['total'] = [a + b for a, b in zip(p['total'], (pages, nbytes, sec))]
+        for p in out.values():
+            p['total'] = self._summary(*p['total'])
+        return {'profile': self.profile, 'profiles': out}
+
+    def save_history(self, path=BROWSER_STATS_FILE):
+        """今回の分をプロファイル別の累計に足して保存し、累計を返す（両プロファイルの比較用）"""
+        with self._lock:
+            stats = dict(self._stats)
+        if not stats:
+            return None
+        history = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    history = json.load(f)
+            except (OSError, ValueError):
+                history = {}
+        for (profile, kind), (pages, nbytes, sec) in stats.items():
+            h = history.setdefault(profile, {}).setdefault(kind, {'pages': 0, 'bytes': 0, 'sec': 0.0})
+            h['pages'] += pages
+            h['bytes'] += nbytes
+            h['sec'] = round(h['sec'] + sec, 3)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(history, f, ensure_ascii=False, indent=1)
+        return {profile: self._summary(*[sum(k[c] for k in kinds.values())
+                                         for c in ('pages', 'bytes', 'sec')])
+                for profile, kinds in history.items()}
+
+BROWSER = BrowserUsage()
+
+def make_driver(profile=None):
+    """Chrome を起動する。profile: 'standard' / 'lean'（省略時は BROWSER.profile）"""
     from selenium import webdriver
     from selenium.webdriver.chrome.service import Service
     from selenium.webdriver.chrome.options import Options
     from webdriver_manager.chrome import ChromeDriverManager
+    profile = profile or BROWSER.profile
     opts = Options()
     opts.add_argument('--headless')
     opts.add_argument('--no-sandbox')
     opts.add_argument('--disable-dev-shm-usage')
     opts.add_argument('--disable-gpu')
-    opts.add_argument('--window-size=1920,1080')
     opts.add_argument('--lang=ja')
-    opts.add_argument(
-        'user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
-        'AppleWebKit/537.36 Chrome/120.0.0.0 Safari/537.36'
-    )
-    return webdriver.Chrome(
-        service=Service(ChromeDriverManager().install()), options=opts
-    )
+    opts.add_argument(f'user-agent={USER_AGENT}')
+    BROWSER.options(opts, profile)
+    MONITOR.wait_for_headroom()
+    with TIMER.span('chrome_start', profile):
+        driver = webdriver.Chrome(
+            service=Service(ChromeDriverManager().install()), options=opts
+        )
+    BROWSER.setup(driver, profile)
+    return driver
 
 # ============================================================
 # 【修正①】開催日番号取得（安定版）
 # ============================================================
-def get_kaisai_day(year, month, day, venue_jp):
+def get_kaisai_day(year, month, day, venue_jp, base_url=RACE_BASE_URL):
     """
     netkeibaのレース一覧ページからrace_idを直接取得し
     開催日番号（race_id の 9〜10文字目）を返す。
@@ -207,29 +1153,29 @@ def get_kaisai_day(year, month, day, venue_jp):
 
     print(f"\n   開催日番号を取得中 ({date_str} / {venue_jp})...")
 
-    for attempt in range(2):
+    url = f"{base_url.rstrip('/')}/top/race_list.html?kaisai_date={date_str}"
+
+    def venue_race_ids(driver):
+        # race_id: YYYY(4)+競馬場(2)+回次(2)+日目(2)+R番号(2)
+        ids = []
+        for lnk in driver.find_elements(By.CSS_SELECTOR, 'a[href*="race_id="]'):
+            m = re.search(r'race_id=(\d{12})', lnk.get_attribute('href') or '')
+            if m and m.group(1)[4:6] == vcode:
+                ids.append(m.group(1))
+        return ids
+
+    for attempt in FETCH_POLICY.attempts(2, 'race_list', url):
         driver = None
         try:
             from selenium.webdriver.common.by import By
             driver = make_driver()
-            url = f"https://race.netkeiba.com/top/race_list.html?kaisai_date={date_str}"
-            driver.get(url)
-            time.sleep(5 + attempt * 3)
-
-            links = driver.find_elements(By.CSS_SELECTOR, 'a[href*="race_id="]')
-            for lnk in links:
-                href = lnk.get_attribute('href') or ''
-                m = re.search(r'race_id=(\d{12})', href)
-                if m:
-                    rid = m.group(1)
-                    # race_id: YYYY(4)+競馬場(2)+回次(2)+日目(2)+R番号(2)
-                    if rid[4:6] == vcode:
-                        kaisai_day = rid[8:10]
-                        driver.quit()
-                        print(f"   開催日番号: {kaisai_day}日目")
-                        return kaisai_day
+            fetch_page(driver, url, 'race_list', settle=5,
+                       check=lambda d: None if venue_race_ids(d)
+                       else f"{venue_jp}のrace_idが見つかりません（試行{attempt+1}）")
+            kaisai_day = venue_race_ids(driver)[0][8:10]
             driver.quit()
-            print(f"   {venue_jp}のrace_idが見つかりません（試行{attempt+1}）")
+            print(f"   開催日番号: {kaisai_day}日目")
+            return kaisai_day
         except Exception as e:
             print(f"   開催日番号取得エラー: {e}")
             if driver:
@@ -242,7 +1188,55 @@ def get_kaisai_day(year, month, day, venue_jp):
 # ============================================================
 # 【修正②】JRA馬場情報から含水率・クッション値を自動取得
 # ============================================================
-def scrape_baba_info(venue_jp):
+def parse_baba_page(page_text):
+    """
+    JRA馬場情報ページのソースからクッション値・芝含水率・ダート含水率を読む（読めない値は None）。
+    JRAページは数値をテキストノードとして描画するため、ページソースから正規表現で抽出する
+    """
+    result = {'cushion': None, 'moisture_turf': None, 'moisture_dirt': None}
+    # クッション値: id="cushion_data"内の小数値
+    # 例: <div style="left: 46%;">9.4</di
+    cushion_m = re.search(
+        r'id=.cushion_data.[^>]*>.*?(\d+\.\d+)', page_text, re.DOTALL
+    )
+    # フォールバック: 「クッション値」直後の小数
+    if not cushion_m:
+        cushion_m = re.search(
+            r'クッション値[^<]{0,300}?(\d+\.\d+)', page_text, re.DOTALL
+        )
+    if cushion_m:
+        val = float(cushion_m.group(1))
+        if 4.0 <= val <= 20.0:
+            result['cushion'] = val
+
+    # 芝含水率: id="turf_line" のゴール前（最初の%値）を使用
+    # 例: <tr id="turf_line"><th>芝</th><td class="gm">11.3%</td>...
+    turf_m = re.search(
+        r'id=.turf_line.[^>]*>.*?(\d+(?:\.\d+)?)\s*%',
+        page_text, re.DOTALL
+    )
+    if turf_m:
+        val = float(turf_m.group(1))
+        if 1.0 <= val <= 60.0:
+            result['moisture_turf'] = val
+
+    # ダート含水率: id="dirt_line" のゴール前（最初の%値）を使用
+    # 例: <tr id="dirt_line"><th>ダート</th><td class="gm">5.5%</td>...
+    dirt_m = re.search(
+        r'id=.dirt_line.[^>]*>.*?(\d+(?:\.\d+)?)\s*%',
+        page_text, re.DOTALL
+    )
+    if dirt_m:
+        val = float(dirt_m.group(1))
+        if 1.0 <= val <= 60.0:
+            result['moisture_dirt'] = val
+
+    return result
+
+def baba_page_url(venue_jp, base_url=BABA_BASE_URL):
+    return base_url.rstrip('/') + VENUE_BABA_PATH.get(venue_jp, '/keiba/baba/')
+
+def scrape_baba_info(venue_jp, base_url=BABA_BASE_URL):
     """
     JRA馬場情報ページから芝含水率・ダート含水率・クッション値を取得。
     戻り値: {'cushion': float or None,
@@ -250,65 +1244,30 @@ def scrape_baba_info(venue_jp):
              'moisture_dirt': float or None}
     """
     result = {'cushion': None, 'moisture_turf': None, 'moisture_dirt': None}
-    url = VENUE_BABA_URL.get(venue_jp, 'https://www.jra.go.jp/keiba/baba/')
+    url = baba_page_url(venue_jp, base_url)
 
     print(f"\n   JRA馬場情報を取得中: {venue_jp}")
     print(f"   URL: {url}")
 
     driver = None
     try:
-        from selenium.webdriver.common.by import By
         driver = make_driver()
-        driver.get(url)
-        time.sleep(8)  # JavaScriptの描画を待つ
+        # JavaScriptの描画を待ってから、値が1つも読めないページは失敗として記録
+        fetch_page(driver, url, 'baba', settle=8,
+                   check=lambda d: None if any(v is not None for v in
+                                               parse_baba_page(d.page_source).values())
+                   else '馬場情報の値を読み取れません')
 
         page_text = driver.page_source
         driver.quit()
         driver = None
-
-        # ── テキスト全体から数値を収集 ──
-        # JRAページは数値をテキストノードとして描画するため
-        # ページソースから正規表現で抽出する
-
-        # クッション値: id="cushion_data"内の小数値
-        # 例: <div style="left: 46%;">9.4</di
-        cushion_m = re.search(
-            r'id=.cushion_data.[^>]*>.*?(\d+\.\d+)', page_text, re.DOTALL
-        )
-        # フォールバック: 「クッション値」直後の小数
-        if not cushion_m:
-            cushion_m = re.search(
-                r'クッション値[^<]{0,300}?(\d+\.\d+)', page_text, re.DOTALL
-            )
-        if cushion_m:
-            val = float(cushion_m.group(1))
-            if 4.0 <= val <= 20.0:
-                result['cushion'] = val
-                print(f"   クッション値: {val}")
-
-        # 芝含水率: id="turf_line" のゴール前（最初の%値）を使用
-        # 例: <tr id="turf_line"><th>芝</th><td class="gm">11.3%</td>...
-        turf_m = re.search(
-            r'id=.turf_line.[^>]*>.*?(\d+(?:\.\d+)?)\s*%',
-            page_text, re.DOTALL
-        )
-        if turf_m:
-            val = float(turf_m.group(1))
-            if 1.0 <= val <= 60.0:
-                result['moisture_turf'] = val
-                print(f"   芝含水率: {val}%")
-
-        # ダート含水率: id="dirt_line" のゴール前（最初の%値）を使用
-        # 例: <tr id="dirt_line"><th>ダート</th><td class="gm">5.5%</td>...
-        dirt_m = re.search(
-            r'id=.dirt_line.[^>]*>.*?(\d+(?:\.\d+)?)\s*%',
-            page_text, re.DOTALL
-        )
-        if dirt_m:
-            val = float(dirt_m.group(1))
-            if 1.0 <= val <= 60.0:
-                result['moisture_dirt'] = val
-                print(f"   ダート含水率: {val}%")
+        result = parse_baba_page(page_text)
+        if result['cushion'] is not None:
+            print(f"   クッション値: {result['cushion']}")
+        if result['moisture_turf'] is not None:
+            print(f"   芝含水率: {result['moisture_turf']}%")
+        if result['moisture_dirt'] is not None:
+            print(f"   ダート含水率: {result['moisture_dirt']}%")
 
         # 取得失敗時のフォールバックログ
         if result['moisture_turf'] is None:
@@ -324,90 +1283,184 @@ def scrape_baba_info(venue_jp):
 
     return result
 
+class BabaWatcher:
+    """
+    ウォッチモードでの馬場情報ページの確認（確認のたびに Chrome を起動しない）。
+    まずブラウザを使わない HTTP GET で読む。2回目からは ETag / Last-Modified による条件付き取得で、
+    304（変化なし）なら前回の値を返す。HTTP で値が読めないページ（JavaScript で描画される）なら、
+    Chrome を1つだけ起動してウォッチが終わるまで使い続ける（close() で終了）。
+    """
+    def __init__(self, venue_jp, base_url=BABA_BASE_URL):
+        self.url = baba_page_url(venue_jp, base_url)
+        self.use_http = True
+        self.validators = {}
+        self.last = None
+        self.driver = None
+
+    def poll(self):
+        """最新の値 {'cushion', 'moisture_turf', 'moisture_dirt'}（読めない値は None）"""
+        if self.use_http:
+            try:
+                values = self._poll_http()
+            except Exception as e:
+                print(f"   馬場情報取得失敗: {e}")
+                return {'cushion': None, 'moisture_turf': None, 'moisture_dirt': None}
+            if any(v is not None for v in values.values()):
+                return values
+            print("   HTTP では馬場情報の値を読めないため、以降は Chrome で確認します")
+            self.use_http = False
+        return self._poll_browser()
+
+    def _poll_http(self):
+        status, head, text = fetch_text(self.url, 'baba', headers=self.validators)
+        if status == 304 and self.last is not None:
+            return dict(self.last)
+        self.validators = {req: head[res] for res, req in (('ETag', 'If-None-Match'),
+                                                           ('Last-Modified', 'If-Modified-Since'))
+                           if head.get(res)}
+        self.last = parse_baba_page(text)
+        return dict(self.last)
+
+    def _poll_browser(self):
+        try:
+            if self.driver is None:
+                self.driver = make_driver()
+            fetch_page(self.driver, self.url, 'baba', settle=8,
+                       check=lambda d: None if any(v is not None for v in
+                                                   parse_baba_page(d.page_source).values())
+                       else '馬場情報の値を読み取れません')
+            return parse_baba_page(self.driver.page_source)
+        except Exception as e:
+            print(f"   馬場情報取得失敗: {e}")
+            self.close()   # 次の確認で起動し直す
+            return {'cushion': None, 'moisture_turf': None, 'moisture_dirt': None}
+
+    def close(self):
+        if self.driver is not None:
+            try: self.driver.quit()
+            except Exception: pass
+            self.driver = None
+
 # ============================================================
 # スクレイピング：1レース分の出走馬データ取得
 # ============================================================
-def scrape_one_race(race_url, venue_jp, race_no, race_date_str):
+RESULT_ROWS = 'table.db_h_race_results tbody tr, table.Race_Table tbody tr'   # 馬の戦績表の行
+
+def scrape_one_race(race_url, venue_jp, race_no, race_date_str, lookback=(7, None),
+                    checkpoint=None):
     """
     1レース分の出走馬データを取得する。
     Chrome を1インスタンスだけ起動して全頭のページを順番に取得する（高速化）。
+    lookback = (最大走数, 最大日数)。None はその条件で打ち切らない。
+    checkpoint を渡すと出馬表と1頭ごとの過去走を記録し、記録済みの分は取得しない。
+    戻り値: ({馬ID: 馬名}（出馬表順）, 過去走データ)
     """
+    max_runs, max_days = lookback
+    oldest = None
+    if max_days is not None:
+        oldest = (datetime(*[int(x) for x in race_date_str.split('.')])
+                  - timedelta(days=max_days)).date()
     print(f"\n   {venue_jp}{race_no}R 出走馬取得中...")
 
     from selenium.webdriver.common.by import By
 
     driver = None
+    horse_links = {}   # 馬ID → (馬名, URL)
+    done_horses = {}
+    all_rows    = []
+    if checkpoint is not None:
+        shutuba = checkpoint.find('shutuba', race_no)
+        if shutuba:
+            horse_links = {hid: (name, url) for hid, name, url in shutuba['horses']}
+            done_horses = checkpoint.horses(race_no)
+            print(f"      出馬表は記録済み: {len(horse_links)}頭（取得済み {len(done_horses)}頭）")
     try:
-        driver = make_driver()
-
         # ── ① 出馬表ページから馬名とURLを収集 ──────────────
-        horse_links = {}
-        for attempt in range(3):
-            wait_sec = 8 + attempt * 5
-            try:
-                driver.get(race_url)
-                time.sleep(wait_sec)
-
-                # URLをキーにして収集（同一URLの重複を防ぐ）
-                url_to_names = {}
-                for css in ['td.HorseName a', 'span.Horse_Name a', 'a[href*="/horse/"]']:
-                    elems = driver.find_elements(By.CSS_SELECTOR, css)
-                    for e in elems:
-                        name = e.text.strip()
-                        href = e.get_attribute('href') or ''
-                        base_url = href.split('?')[0].rstrip('/')
-                        if name and '/horse/' in href and len(name) >= 2:
-                            if base_url not in url_to_names:
-                                url_to_names[base_url] = []
-                            url_to_names[base_url].append((name, href))
-                    if url_to_names:
-                        break
+        if not horse_links:
+            driver = make_driver()
+            for attempt in FETCH_POLICY.attempts(3, 'shutuba', race_url):
+                try:
+                    # JavaScriptの描画を待ち、馬のリンクが1つもなければ失敗として記録
+                    fetch_page(driver, race_url, 'shutuba', settle=8,
+                               check=lambda d: None if d.find_elements(
+                                   By.CSS_SELECTOR, 'a[href*="/horse/"]')
+                               else f"検出0頭 ({attempt+1}/3)")
+
+                    # URLをキーにして収集（同一URLの重複を防ぐ）
+                    url_to_names = {}
+                    for css in ['td.HorseName a', 'span.Horse_Name a', 'a[href*="/horse/"]']:
+                        elems = driver.find_elements(By.CSS_SELECTOR, css)
+                        for e in elems:
+                            name = e.text.strip()
+                            href = e.get_attribute('href') or ''
+                            base_url = href.split('?')[0].rstrip('/')
+                            if name and '/horse/' in href and len(name) >= 2:
+                                if base_url not in url_to_names:
+                                    url_to_names[base_url] = []
+                                url_to_names[base_url].append((name, href))
+                        if url_to_names:
+                            break
 
-                # 各URLから最も適切な馬名を選択
-                # 優先順位：数字で始まらない名前 > 最短の名前
-                for base_url, candidates in url_to_names.items():
-                    best_name, best_href = None, None
-                    for name, href in candidates:
-                        if re.match(r'^\d', name):
-                            continue
-                        if best_name is None or len(name) < len(best_name):
-                            best_name, best_href = name, href
-                    # 全候補が数字始まりだった場合は数字部分を除去して使う
-                    if best_name is None and candidates:
-                        raw, href = candidates[0]
-                        best_name = re.sub(r'^\d+\s*', '', raw).strip() or raw
-                        best_href = href
-                    if best_name:
-                        horse_links[best_name] = best_href
-
-                if horse_links:
-                    print(f"      {len(horse_links)}頭検出")
-                    break
-                print(f"      検出0頭、リトライ ({attempt+1}/3)...")
-            except Exception as e:
-                print(f"      出馬表取得エラー: {e}")
+                    # 各URLから最も適切な馬名を選択（馬はURLの馬IDで識別し、馬名は表示用）
+                    # 優先順位：数字で始まらない名前 > 最短の名前
+                    for base_url, candidates in url_to_names.items():
+                        best_name, best_href = None, None
+                        for name, href in candidates:
+                            if re.match(r'^\d', name):
+                                continue
+                            if best_name is None or len(name) < len(best_name):
+                                best_name, best_href = name, href
+                        # 全候補が数字始まりだった場合は数字部分を除去して使う
+                        if best_name is None and candidates:
+                            raw, href = candidates[0]
+                            best_name = re.sub(r'^\d+\s*', '', raw).strip() or raw
+                            best_href = href
+                        if best_name:
+                            hid = horse_id_of(base_url)
+                            if hid is None:
+                                hid = name_horse_id(best_name)
+                            horse_links[hid] = (best_name, best_href)
+
+                    METRICS.set('horses_detected', len(horse_links), race=race_no)
+                    if horse_links:
+                        print(f"      {len(horse_links)}頭検出")
+                        if checkpoint is not None:
+                            checkpoint.record('shutuba', race=race_no,
+                                              horses=[[hid, name, url] for hid, (name, url)
+                                                      in horse_links.items()])
+                        break
+                    print(f"      検出0頭、リトライ ({attempt+1}/3)...")
+                except Exception as e:
+                    print(f"      出馬表取得エラー: {e}")
 
         if not horse_links:
             print(f"      出走馬取得失敗（レース未登録の可能性）")
             driver.quit()
-            return [], pd.DataFrame()
+            return {}, pd.DataFrame()
 
         # ── ② 同じChromeで各馬のページを順番に取得 ─────────
-        all_rows = []
-        for idx, (horse_name, h_url) in enumerate(horse_links.items(), 1):
-            for attempt in range(2):
+        for idx, (horse_id, (horse_name, h_url)) in enumerate(horse_links.items(), 1):
+            if horse_id in done_horses:
+                all_rows.extend(done_horses[horse_id])
+                print(f"      [{idx}/{len(horse_links)}] {horse_name}: "
+                      f"{len(done_horses[horse_id])}走（記録済み）")
+                continue
+            if driver is None:
+                driver = make_driver()
+            for attempt in FETCH_POLICY.attempts(2, 'horse', horse_name):
+                first_row = len(all_rows)
                 try:
-                    driver.get(h_url)
                     # 2頭目以降は待機時間を短くする（ページキャッシュが効くため）
-                    time.sleep(2 if idx > 1 else 3)
+                    # 戦績の表が空なら1回目は失敗として記録して取り直す（2回目も空なら新馬とみなす）
+                    fetch_page(driver, h_url, 'horse', horse_name, settle=2 if idx > 1 else 3,
+                               check=(lambda d: None if d.find_elements(By.CSS_SELECTOR, RESULT_ROWS)
+                                      else '戦績の表が空') if attempt == 0 else None)
 
-                    rows = driver.find_elements(
-                        By.CSS_SELECTOR,
-                        'table.db_h_race_results tbody tr, table.Race_Table tbody tr'
-                    )
+                    t_parse = time.perf_counter()
+                    rows = driver.find_elements(By.CSS_SELECTOR, RESULT_ROWS)
                     past_count = 0
                     for rrow in rows:
-                        if past_count >= 7:
+                        if max_runs is not None and past_count >= max_runs:
                             break
                         try:
                             cells = rrow.find_elements(By.TAG_NAME, 'td')
@@ -421,6 +1474,9 @@ def scrape_one_race(race_url, venue_jp, race_no, race_date_str):
                                 int(date_m.group(2)),
                                 int(date_m.group(3))
                             ).date()
+                            # 戦績表は新しい順なので、範囲外の日付が出たら打ち切り
+                            if oldest is not None and race_dt < oldest:
+                                break
                             venue_raw   = cells[1].text.strip() if len(cells) > 1 else ''
                             venue_clean = clean_venue(venue_raw)
                             race_nm     = cells[4].text.strip() if len(cells) > 4 else ''
@@ -448,6 +1504,7 @@ def scrape_one_race(race_url, venue_jp, race_no, race_date_str):
 
                             all_rows.append({
                                 'race_no':    race_no,
+                                'horse_id':   horse_id,
                                 'horse_name': horse_name,
                                 'race_date':  race_dt,
                                 'venue':      venue_clean,
@@ -460,7 +1517,12 @@ def scrape_one_race(race_url, venue_jp, race_no, race_date_str):
                         except Exception:
                             continue
 
+                    TIMER.add('parse', horse_name, time.perf_counter() - t_parse)
+                    METRICS.inc('rows_parsed_total', past_count)
                     print(f"      [{idx}/{len(horse_links)}] {horse_name}: {past_count}走取得")
+                    if checkpoint is not None:
+                        checkpoint.record('horse', race=race_no, horse_id=horse_id,
+                                          name=horse_name, rows=all_rows[first_row:])
                     break  # 成功したら次の馬へ
 
                 except Exception as e:
@@ -471,6 +1533,7 @@ def scrape_one_race(race_url, venue_jp, race_no, race_date_str):
                             driver.quit()
                         except Exception:
                             pass
+                        METRICS.inc('driver_restarts_total')
                         driver = make_driver()
 
     except Exception as e:
@@ -483,17 +1546,16 @@ def scrape_one_race(race_url, venue_jp, race_no, race_date_str):
             except Exception:
                 pass
 
-    return list(horse_links.keys()) if 'horse_links' in dir() else [], \
-           pd.DataFrame(all_rows) if all_rows else pd.DataFrame()
+    horses = {hid: name for hid, (name, _) in horse_links.items()}
+    return horses, pd.DataFrame(all_rows) if all_rows else pd.DataFrame()
 
 # ============================================================
 # 含水率マスタ読み込み
 # ============================================================
 def load_moisture_history():
     print("\n含水率履歴を読み込み中...")
-    candidates = [MOISTURE_FILE, './data/含水率.xlsx', './data/moisture_data.xlsx']
     filepath = None
-    for c in candidates:
+    for c in MOISTURE_CANDIDATES:
         if os.path.exists(c):
             filepath = c
             print(f"   ファイル: {filepath}")
@@ -660,6 +1722,589 @@ def merge_data(race_df, moisture_df, surface='芝'):
         print(f"   マッチング: {matched}/{len(merged)} ({matched/len(merged)*100:.1f}%)")
     return merged
 
+def add_today_moisture(moisture_df, today_date, venue_jp, cushion, moisture_turf, moisture_dirt):
+    """今日の芝・ダートの値を含水率マスタに追記する（同じ日・場・馬場の行がなければ）"""
+    new_rows = []
+    for surf, mval in [('芝', moisture_turf), ('ダート', moisture_dirt)]:
+        has = False
+        if not moisture_df.empty:
+            surface = (moisture_df['surface'].astype(str) if 'surface' in moisture_df.columns
+                       else pd.Series('', index=moisture_df.index))
+            has = bool((
+                (moisture_df['date'].astype(str) == str(today_date)) &
+                (moisture_df['venue'].astype(str) == venue_jp) &
+                (surface == surf)
+            ).any())
+        if not has:
+            new_rows.append({
+                'date': today_date, 'venue': venue_jp,
+                'cushion': cushion, 'moisture': mval, 'surface': surf
+            })
+    if not new_rows:
+        return moisture_df
+    return pd.concat([moisture_df, pd.DataFrame(new_rows)], ignore_index=True)
+
+def detect_surface(race_df):
+    """出走馬の過去走で最も多い馬場（芝 / ダート）を今回の馬場とみなす"""
+    if 'surface' in race_df.columns:
+        mode = race_df['surface'].mode()
+        if not mode.empty:
+            return mode.iloc[0]
+    return '芝'
+
+def detect_target_dist(merged):
+    """過去走で最も多い距離を今回の距離とみなす（不明なら 1600m）"""
+    if not merged.empty and 'distance' in merged.columns:
+        mode_d = merged['distance'].dropna().mode()
+        if not mode_d.empty:
+            return int(mode_d[0])
+    return 1600
+
+# ============================================================
+# 過去走の範囲（ルックバック）と保存形式
+# ============================================================
+def parse_lookback(text):
+    """
+    設定値を (最大走数, 最大日数) に変換する。
+      '7' / '7走' → (7, None)   '365日' → (None, 365)   '全走' → (None, None)
+    """
+    t = str(text).strip().lower()
+    if t in ('', '全走', '全て', 'すべて', 'all'):
+        return (None, None)
+    m = re.match(r'^(\d+)\s*(日|d|days?)$', t)
+    if m:
+        return (None, int(m.group(1)))
+    m = re.match(r'^(\d+)\s*(走)?$', t)
+    if m and int(m.group(1)) > 0:
+        return (int(m.group(1)), None)
+    print(f"   過去走の範囲 '{text}' を解釈できません → 近7走")
+    return (7, None)
+
+def lookback_label(lookback):
+    max_runs, max_days = lookback
+    if max_runs is not None:
+        return f"近{max_runs}走"
+    if max_days is not None:
+        return f"過去{max_days}日"
+    return "全走"
+
+def apply_lookback(race_df, lookback, ref_date=None):
+    """
+    馬ごとに新しい順で範囲内の走だけを残す。
+    馬ごとのコピーは作らず、順位付けした行番号で一度に絞り込む。
+    """
+    max_runs, max_days = lookback
+    if race_df.empty or (max_runs is None and max_days is None):
+        return race_df
+    if 'race_date' not in race_df.columns or 'horse_id' not in race_df.columns:
+        return race_df
+    dt = pd.to_datetime(race_df['race_date'], errors='coerce')
+    keep = np.ones(len(race_df), dtype=bool)
+    if max_days is not None and ref_date is not None:
+        keep &= (dt >= pd.Timestamp(ref_date) - pd.Timedelta(days=max_days)).to_numpy()
+    if max_runs is not None:
+        nth = dt[keep].groupby(race_df['horse_id'][keep], sort=False).rank(
+            method='first', ascending=False)
+        keep[np.flatnonzero(keep)[(nth > max_runs).to_numpy()]] = False
+    return race_df[keep] if not keep.all() else race_df
+
+def compact_runs(race_df):
+    """
+    過去走データの列型を小さくする（競馬場・芝ダートはカテゴリ、数値は float32）。
+    馬IDのない古いファイルは horse_id を馬名から補う。
+    """
+    df = ensure_horse_ids(race_df.copy())
+    for col in ['distance', 'rank']:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('float32')
+    for col in ['venue', 'surface']:
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    if 'race_date' in df.columns:
+        df['race_date'] = pd.to_datetime(df['race_date'], errors='coerce')
+    return df
+
+def _parquet_path(race_file):
+    return os.path.splitext(race_file)[0] + '.parquet'
+
+def save_race_file(race_df, race_file):
+    """
+    過去走データを保存する。Excel（閲覧用）に加えて、pyarrow があれば
+    列指向の parquet も書き出し、次回以降の読み込みはそちらを使う。
+    """
+    race_df.to_excel(race_file, index=False)
+    try:
+        compact_runs(race_df).to_parquet(_parquet_path(race_file), index=False)
+    except ImportError:
+        pass
+
+def load_race_file(race_file, write_parquet=True):
+    """
+    save_race_file で保存した過去走データを読む（parquet が新しければ優先）。
+    write_parquet=False なら Excel しかなくても parquet を作らない（ファイルを書かない）
+    """
+    pq = _parquet_path(race_file)
+    if os.path.exists(pq) and (not os.path.exists(race_file)
+                               or os.path.getmtime(pq) >= os.path.getmtime(race_file)):
+        try:
+            return ensure_horse_ids(pd.read_parquet(pq))
+        except ImportError:
+            pass
+    if not os.path.exists(race_file):
+        return pd.DataFrame()
+    df = compact_runs(pd.read_excel(race_file))
+    if not write_parquet:
+        return df
+    # Excel しかない場合は parquet を作っておく（次回から高速に読める）
+    try:
+        df.to_parquet(pq, index=False)
+    except (ImportError, OSError):
+        pass
+    return df
+
+# 読み込み済みデータ（ファイルの更新時刻が変わるまで再利用。ウォッチモードの再計算用）
+_FRAME_CACHE = {}
+
+def file_stamp(paths):
+    """ファイルごとの (パス, 更新時刻)。存在しないファイルは含めない"""
+    return tuple((p, os.path.getmtime(p)) for p in paths if os.path.exists(p))
+
+def load_cached(key, paths, loader):
+    """paths のどれかが更新されるまで loader() の結果を使い回す（コピーを返す）"""
+    stamp = file_stamp(paths)
+    hit = _FRAME_CACHE.get(key)
+    if hit is None or hit[0] != stamp:
+        hit = _FRAME_CACHE[key] = (stamp, loader())
+    return hit[1].copy()
+
+def race_file_sources(race_file):
+    """過去走データの実体（Excel と parquet）"""
+    return [race_file, _parquet_path(race_file)]
+
+def load_race_cached(race_file):
+    return load_cached(race_file, race_file_sources(race_file), lambda: load_race_file(race_file))
+
+# ============================================================
+# 馬ごとの集計（1パス）
+# ============================================================
+def split_by_horse(merged):
+    """結合データを馬IDごとの部分DataFrameに1回の groupby で分割する"""
+    if merged.empty or 'horse_id' not in merged.columns:
+        return {}
+    return {int(hid): h_df for hid, h_df in merged.groupby('horse_id', sort=False)}
+
+def summarize_horses(merged, horse_ids=None, target_cushion=10.0,
+                     target_moisture=14.7, tol=0.5, rank_cutoff=3):
+    """
+    全馬分の集計を1パスで計算する。
+    戻り値: horse_id をインデックスとする DataFrame
+            runs = 走数, good / bad = 今回の馬場 ±tol 以内での rank_cutoff 着以内 / それ以外
+    horse_ids を渡すとその順に並べ、データのない馬は0で埋める。
+    """
+    cols = ['runs', 'good', 'bad']
+    if merged.empty or 'horse_id' not in merged.columns:
+        index = pd.Index(list(horse_ids or []), name='horse_id', dtype='int64')
+        return pd.DataFrame(0, index=index, columns=cols)
+
+    codes, uniques = pd.factorize(merged['horse_id'])
+    n = len(uniques)
+    valid = codes >= 0
+
+    def _col(name):
+        if name not in merged.columns:
+            return np.full(len(merged), np.nan)
+        return pd.to_numeric(merged[name], errors='coerce').to_numpy(dtype=float)
+
+    c, m, rank = _col('cushion'), _col('moisture'), _col('rank')
+    near = (np.abs(c - target_cushion) <= tol) & (np.abs(m - target_moisture) <= tol)
+    good = near & (rank <= rank_cutoff)
+    bad  = near & (rank >  rank_cutoff)
+
+    out = pd.DataFrame({
+        'runs': np.bincount(codes[valid], minlength=n),
+        'good': np.bincount(codes[valid], weights=good[valid], minlength=n).astype(int),
+        'bad':  np.bincount(codes[valid], weights=bad[valid],  minlength=n).astype(int),
+    }, index=pd.Index(uniques, name='horse_id'))
+    if horse_ids is not None:
+        out = out.reindex(list(horse_ids), fill_value=0)
+    return out
+
+# ============================================================
+# 類似馬場検索（空間インデックス）
+# ============================================================
+# 軸の正規化幅（クッション値, 含水率）。距離1.0 = 従来の ±0.5 の枠の端
+CONDITION_SCALE = (0.5, 0.5)
+NEIGHBOR_K = 5
+NEAR_RADIUS = 1.0   # 半径検索の既定（正規化距離）
+
+class ConditionIndex:
+    """
+    過去走の (クッション値, 含水率) に対するグリッドバケット方式の空間インデックス。
+    軸を scale で割って正規化し、1マス = cell の格子に振り分ける。
+    knn() / radius() は近いマスから順に調べるので全件走査しない。
+    by=('horse_id', 馬ID) や by=('_vc', 競馬場) で絞り込んだ検索もできる（絞り込み用の
+    インデックスは初回に作って使い回す）。
+    1日分の過去走（build_condition_index）で1回作り、同じ日のレース間で共有する。
+    """
+    def __init__(self, runs, scale=CONDITION_SCALE, cell=1.0):
+        if runs.empty or 'cushion' not in runs.columns or 'moisture' not in runs.columns:
+            runs = pd.DataFrame(columns=['cushion', 'moisture'])
+        c = pd.to_numeric(runs['cushion'],  errors='coerce').to_numpy(dtype=float)
+        m = pd.to_numeric(runs['moisture'], errors='coerce').to_numpy(dtype=float)
+        ok = ~(np.isnan(c) | np.isnan(m))
+        self.runs  = runs[ok].reset_index(drop=True)
+        self.scale = scale
+        self.cell  = cell
+        self.cm    = np.column_stack([c[ok], m[ok]])
+        self.xy    = self.cm / np.asarray(scale, dtype=float)
+        self.rank  = (pd.to_numeric(self.runs['rank'], errors='coerce').to_numpy(dtype=float)
+                      if 'rank' in self.runs.columns else np.full(len(self.runs), np.nan))
+        self._sub  = {}
+        self._groups = {}
+
+        cells = np.floor(self.xy / cell).astype(np.int64)
+        if len(cells):
+            self._buckets = pd.Series(np.arange(len(cells))).groupby(
+                [cells[:, 0], cells[:, 1]]).indices
+            self._lo, self._hi = cells.min(axis=0), cells.max(axis=0)
+        else:
+            self._buckets = {}
+            self._lo = self._hi = np.zeros(2, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.runs)
+
+    def groups(self, column):
+        """{column の値: self.runs 内の位置}（初回作成後は再利用）"""
+        if column not in self._groups:
+            self._groups[column] = (
+                self.runs.groupby(column, sort=False).indices
+                if column in self.runs.columns else {}
+            )
+        return self._groups[column]
+
+    def subset(self, column, value):
+        """column == value の過去走だけのインデックス（初回作成後は再利用）"""
+        key = (column, value)
+        if key not in self._sub:
+            pos = self.groups(column).get(value, np.array([], dtype=np.int64))
+            self._sub[key] = ConditionIndex(self.runs.iloc[pos], self.scale, self.cell)
+        return self._sub[key]
+
+    def distance(self, pos, cushion, moisture):
+        """pos の過去走の目標からの正規化距離（condition_distance と同じ式）"""
+        c, m = self.cm[pos, 0], self.cm[pos, 1]
+        return np.hypot((c - cushion) / self.scale[0], (m - moisture) / self.scale[1])
+
+    def _target(self, cushion, moisture):
+        return np.array([cushion / self.scale[0], moisture / self.scale[1]])
+
+    def _ring(self, center, r):
+        """中心マスからチェビシェフ距離 r のマスに入っている過去走の位置"""
+        cx, cy = center
+        if r == 0:
+            keys = [(cx, cy)]
+        else:
+            keys  = [(cx + dx, cy + s) for dx in range(-r, r + 1) for s in (-r, r)]
+            keys += [(cx + s, cy + dy) for s in (-r, r) for dy in range(-r + 1, r)]
+        found = [self._buckets[k] for k in keys if k in self._buckets]
+        return np.concatenate(found) if found else np.array([], dtype=np.int64)
+
+    def _result(self, pos, dist):
+        out = self.runs.iloc[pos].copy()
+        out['cond_dist'] = dist
+        return out
+
+    def knn_positions(self, cushion, moisture, k=NEIGHBOR_K):
+        """knn() の配列版: (self.runs 内の位置, 正規化距離) を近い順に返す"""
+        empty = (np.array([], dtype=np.int64), np.array([]))
+        if len(self) == 0 or k <= 0:
+            return empty
+        t = self._target(cushion, moisture)
+        center = tuple(np.floor(t / self.cell).astype(np.int64))
+        max_r = int(max(np.abs(np.subtract(center, self._lo)).max(),
+                        np.abs(np.subtract(center, self._hi)).max()))
+        pos, dist, n_found = [], [], 0
+        for r in range(max_r + 1):
+            p = self._ring(center, r)
+            if len(p):
+                pos.append(p)
+                dist.append(self.distance(p, cushion, moisture))
+                n_found += len(p)
+            # 未調査のマスの点は少なくとも r*cell 離れている
+            if n_found >= k:
+                all_d = np.concatenate(dist)
+                if np.partition(all_d, k - 1)[k - 1] <= r * self.cell:
+                    break
+        if not pos:
+            return empty
+        pos, dist = np.concatenate(pos), np.concatenate(dist)
+        keep = np.argpartition(dist, k - 1)[:k] if len(dist) > k else np.arange(len(dist))
+        keep = keep[np.argsort(dist[keep], kind='stable')]
+        return pos[keep], dist[keep]
+
+    def radius_positions(self, cushion, moisture, r=NEAR_RADIUS):
+        """radius() の配列版: (self.runs 内の位置, 正規化距離) を近い順に返す"""
+        t = self._target(cushion, moisture)
+        lo = np.floor((t - r) / self.cell).astype(np.int64)
+        hi = np.floor((t + r) / self.cell).astype(np.int64)
+        found = [
+            self._buckets[(x, y)]
+            for x in range(lo[0], hi[0] + 1) for y in range(lo[1], hi[1] + 1)
+            if (x, y) in self._buckets
+        ]
+        if not found:
+            return np.array([], dtype=np.int64), np.array([])
+        pos = np.concatenate(found)
+        dist = self.distance(pos, cushion, moisture)
+        hit = dist <= r
+        order = np.argsort(dist[hit], kind='stable')
+        return pos[hit][order], dist[hit][order]
+
+    def knn(self, cushion, moisture, k=NEIGHBOR_K, by=None):
+        """目標の馬場に近い順に k 走を返す（cond_dist 列 = 正規化距離）"""
+        index = self.subset(*by) if by is not None else self
+        return index._result(*index.knn_positions(cushion, moisture, k))
+
+    def radius(self, cushion, moisture, r=NEAR_RADIUS, by=None):
+        """目標の馬場から正規化距離 r 以内の過去走を近い順に返す"""
+        index = self.subset(*by) if by is not None else self
+        return index._result(*index.radius_positions(cushion, moisture, r))
+
+    def radius_record(self, cushion, moisture, r=NEAR_RADIUS, by=None):
+        """目標の馬場から正規化距離 r 以内の (走数, 3着以内数)"""
+        index = self.subset(*by) if by is not None else self
+        pos, _ = index.radius_positions(cushion, moisture, r)
+        return len(pos), int((index.rank[pos] <= 3).sum())
+
+    # ── グループ（馬など）ごとの集計 ─────────────────────
+    def _group_rows(self, column, values):
+        """column が values のいずれかである過去走の (位置, values 内の番号)"""
+        groups = self.groups(column)
+        found = [(groups[v], i) for i, v in enumerate(values) if v in groups]
+        if not found:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        return (np.concatenate([p for p, _ in found]),
+                np.concatenate([np.full(len(p), i) for p, i in found]))
+
+    def group_knn(self, column, values, cushion, moisture, k=NEIGHBOR_K):
+        """
+        values のそれぞれ（馬IDなど）について、目標の馬場に近い k 走の
+        件数（knn_runs）・3着以内の数（knn_top3）・平均距離（knn_mean_dist）。
+        1頭あたり数走なので、該当する走をまとめて（グループ, 距離）で1回並べ替える。
+        """
+        values = list(values)
+        n = len(values)
+        pos, codes = self._group_rows(column, values)
+        d = self.distance(pos, cushion, moisture)
+        order = np.lexsort((d, codes))                  # グループごとに近い順（同距離は元の順）
+        c_sorted = codes[order]
+        first = np.searchsorted(c_sorted, c_sorted)     # 各行が属するグループの先頭位置
+        near = order[np.arange(len(order)) - first < k]
+
+        runs = np.bincount(codes[near], minlength=n)
+        top3 = np.bincount(codes[near], weights=(self.rank[pos][near] <= 3), minlength=n).astype(int)
+        sum_d = np.bincount(codes[near], weights=d[near], minlength=n)
+        mean_d = np.divide(sum_d, runs, out=np.full(n, np.nan), where=runs > 0)
+        return pd.DataFrame({'knn_runs': runs, 'knn_top3': top3, 'knn_mean_dist': mean_d},
+                            index=values)
+
+    def group_radius(self, column, values, cushion, moisture, r=NEAR_RADIUS):
+        """values のそれぞれについて、距離 r 以内の走数（near_runs）・3着以内の数（near_top3）"""
+        values = list(values)
+        pos, codes = self._group_rows(column, values)
+        hit = self.distance(pos, cushion, moisture) <= r
+        return pd.DataFrame({
+            'near_runs': np.bincount(codes[hit], minlength=len(values)),
+            'near_top3': np.bincount(codes[hit], weights=(self.rank[pos][hit] <= 3),
+                                     minlength=len(values)).astype(int),
+        }, index=values)
+
+def build_condition_index(race_dfs, moisture_df, surface='芝'):
+    """
+    1日分の過去走（レースごとの race_df のリスト）を surface の含水率で結合した ConditionIndex。
+    同じ馬が複数のレースに出ていれば、その馬の過去走はまとめて1頭分として検索される。
+    """
+    frames = [df for df in race_dfs if not df.empty]
+    runs = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    return ConditionIndex(merge_data(runs, moisture_df, surface=surface))
+
+def condition_distance(df, target_cushion, target_moisture, scale=CONDITION_SCALE):
+    """各過去走の、今回の馬場からの正規化距離（欠損は NaN）"""
+    c = pd.to_numeric(df['cushion'],  errors='coerce').to_numpy(dtype=float)
+    m = pd.to_numeric(df['moisture'], errors='coerce').to_numpy(dtype=float)
+    return np.hypot((c - target_cushion) / scale[0], (m - target_moisture) / scale[1])
+
+def add_condition_neighbors(merged, target_cushion, target_moisture, k=NEIGHBOR_K,
+                            index=None, venue_jp=None, radius=NEAR_RADIUS):
+    """
+    結合データに類似馬場の列を追加する。
+    index は1日分の ConditionIndex（省略時はこの merged だけで作る）。
+      cond_dist       : その走の今回の馬場からの正規化距離
+      knn_runs        : 馬ごとの近傍 k 走の件数（k 未満の馬もいる）
+      knn_top3        : 近傍 k 走のうち3着以内の数
+      knn_mean_dist   : 近傍 k 走の平均距離
+      near_runs       : 馬ごとの、距離 radius 以内の走数
+      near_top3       : そのうち3着以内の数
+      venue_near_runs : index の全馬の venue_jp での、距離 radius 以内の走数（venue_jp 指定時）
+      venue_near_top3 : そのうち3着以内の数
+    """
+    if merged.empty or 'cushion' not in merged.columns:
+        return merged
+    out = merged.copy()
+    out['cond_dist'] = condition_distance(out, target_cushion, target_moisture)
+    index = index if index is not None else ConditionIndex(out)
+    horse_ids = out['horse_id'].unique()
+    stats = index.group_knn('horse_id', horse_ids, target_cushion, target_moisture, k).join(
+        index.group_radius('horse_id', horse_ids, target_cushion, target_moisture, radius))
+    for col in stats.columns:
+        out[col] = out['horse_id'].map(stats[col])
+    if venue_jp is not None:
+        out['venue_near_runs'], out['venue_near_top3'] = index.radius_record(
+            target_cushion, target_moisture, radius, by=('_vc', clean_venue(venue_jp)))
+    return out
+
+# ============================================================
+# 馬場適性スコア
+# ============================================================
+SUITABILITY_BANDWIDTH = 1.0    # ガウス重みの幅（正規化距離）
+SAME_DIST_WEIGHT      = 2.0    # 同距離（classify_point の「同」）の走に掛ける重み
+SUITABILITY_PRIOR     = 0.25   # 過去走がないときの3着以内率
+SUITABILITY_PRIOR_W   = 1.0    # 事前値の重み（走数が少ない馬ほど事前値に寄る）
+
+def score_field(runs, group_cols=('race_no', 'horse_id'),
+                bandwidth=SUITABILITY_BANDWIDTH, same_dist_weight=SAME_DIST_WEIGHT,
+                prior=SUITABILITY_PRIOR, prior_weight=SUITABILITY_PRIOR_W,
+                scale=CONDITION_SCALE):
+    """
+    馬場適性スコアを1日分（複数レース）まとめてベクトル計算する。
+    runs には過去走の列（cushion, moisture, distance, rank）に加えて、
+    各行の今回の条件 target_cushion / target_moisture / target_dist 列が必要。
+    各過去走に「今回の馬場との距離によるガウス重み × 同距離重み」を付け、
+    3着以内の重み付き割合（事前値で平滑化）を suitability とする。
+    戻り値: group_cols ごとの suitability, weight（実効走数）, runs, near_top3
+            （runs に horse_name 列があれば表示用に付ける）
+    """
+    cols = list(group_cols) + ['suitability', 'weight', 'runs', 'near_top3']
+    if runs.empty:
+        return pd.DataFrame(columns=cols)
+
+    def _col(name):
+        if name not in runs.columns:
+            return np.full(len(runs), np.nan)
+        return pd.to_numeric(runs[name], errors='coerce').to_numpy(dtype=float)
+
+    d = np.hypot((_col('cushion')  - _col('target_cushion'))  / scale[0],
+                 (_col('moisture') - _col('target_moisture')) / scale[1])
+    rank = _col('rank')
+    w = np.exp(-0.5 * (d / bandwidth) ** 2)
+    w = np.where(_col('distance') == _col('target_dist'), w * same_dist_weight, w)
+    w = np.where(np.isnan(w) | np.isnan(rank), 0.0, w)
+    good = rank <= 3
+
+    codes = runs.groupby(list(group_cols), sort=False, dropna=False).ngroup().to_numpy()
+    n = codes.max() + 1
+    _, first = np.unique(codes, return_index=True)
+    wsum = np.bincount(codes, weights=w, minlength=n)
+    gsum = np.bincount(codes, weights=w * good, minlength=n)
+
+    out = runs[list(group_cols)].iloc[first].reset_index(drop=True)
+    if 'horse_name' in runs.columns and 'horse_name' not in group_cols:
+        out['horse_name'] = runs['horse_name'].iloc[first].to_numpy()
+    out['suitability'] = (gsum + prior * prior_weight) / (wsum + prior_weight)
+    out['weight']      = wsum
+    out['runs']        = np.bincount(codes, minlength=n)
+    out['near_top3']   = np.bincount(codes, weights=(d <= 1.0) & good, minlength=n).astype(int)
+    return out
+
+def rank_field(scores, race_col='race_no'):
+    """レースごとに suitability の高い順に順位（suitability_rank）を付けて並べる"""
+    if scores.empty:
+        return scores.assign(suitability_rank=pd.Series(dtype=int))
+    out = scores.copy()
+    out['suitability_rank'] = (
+        out.groupby(race_col)['suitability'].rank(ascending=False, method='min').astype(int)
+    )
+    return out.sort_values([race_col, 'suitability_rank']).reset_index(drop=True)
+
+def score_race(merged, target_cushion, target_moisture, target_dist, **kwargs):
+    """1レース分の馬場適性スコア（馬IDごと、高い順）"""
+    if merged.empty or 'horse_id' not in merged.columns:
+        return pd.DataFrame(columns=['horse_id', 'horse_name', 'suitability', 'weight', 'runs',
+                                     'near_top3', 'suitability_rank'])
+    runs = merged.assign(target_cushion=target_cushion, target_moisture=target_moisture,
+                         target_dist=target_dist, _race=0)
+    scores = score_field(runs, group_cols=('_race', 'horse_id'), **kwargs)
+    return rank_field(scores, race_col='_race').drop(columns='_race')
+
+# ============================================================
+# 好走密度（カーネル推定）
+# ============================================================
+# 全馬共通の固定グリッド（クッション値 × 含水率）
+DENSITY_CUSHION   = np.round(np.arange(6.0, 13.0001, 0.1), 2)
+DENSITY_MOISTURE  = np.round(np.arange(5.0, 30.0001, 0.25), 2)
+DENSITY_BANDWIDTH = (0.4, 1.0)   # (クッション値, 含水率) のカーネル幅
+DENSITY_MIN       = 0.05         # 走の密度がこれ未満のマスは空白（データなし）
+FIELD_KEY         = 0            # レース全体の密度のキー（馬IDに 0 はない）
+
+def performance_density(runs):
+    """
+    (含水率, クッション値) グリッド上の「3着以内の割合」を返す。
+    全走と3着以内の走それぞれのガウスカーネル和の比で、走がない場所は NaN。
+    """
+    if runs.empty or not {'cushion', 'moisture', 'rank'}.issubset(runs.columns):
+        return None
+    c = pd.to_numeric(runs['cushion'],  errors='coerce').to_numpy(float)
+    m = pd.to_numeric(runs['moisture'], errors='coerce').to_numpy(float)
+    rank = pd.to_numeric(runs['rank'], errors='coerce').to_numpy(float)
+    ok = ~(np.isnan(c) | np.isnan(m) | np.isnan(rank))
+    if not ok.any():
+        return None
+    c, m, good = c[ok], m[ok], (rank[ok] <= 3).astype(float)
+    hx, hy = DENSITY_BANDWIDTH
+    kx = np.exp(-0.5 * ((DENSITY_CUSHION[:, None]  - c[None, :]) / hx) ** 2)
+    ky = np.exp(-0.5 * ((DENSITY_MOISTURE[:, None] - m[None, :]) / hy) ** 2)
+    total = ky @ kx.T
+    top3  = (ky * good) @ kx.T
+    with np.errstate(invalid='ignore', divide='ignore'):
+        share = np.where(total >= DENSITY_MIN, top3 / total, np.nan)
+    return share.astype(np.float32)
+
+def density_key(key, runs):
+    """馬ID（または FIELD_KEY）と走データの内容から作るキャッシュキー（データが変われば別キー）"""
+    cols = [c for c in ['cushion', 'moisture', 'rank'] if c in runs.columns]
+    arr = np.column_stack([pd.to_numeric(runs[c], errors='coerce').to_numpy(float) for c in cols])
+    return ('density', int(key), hashlib.sha1(arr.tobytes()).hexdigest())
+
+def cached_density(horse_id, runs, cache=None):
+    cache = DENSITY_CACHE if cache is None else cache
+    key = density_key(horse_id, runs)
+    grid = cache.get(key)
+    if grid is None:
+        grid = performance_density(runs)
+        if grid is not None:
+            cache.put(key, grid)
+    return grid
+
+def field_density(merged, by_horse=None, cache=None):
+    """レース全体（FIELD_KEY）と各馬の好走密度。馬ごとにキャッシュする"""
+    if merged.empty or 'horse_id' not in merged.columns:
+        return {}
+    by_horse = split_by_horse(merged) if by_horse is None else by_horse
+    grids = {FIELD_KEY: cached_density(FIELD_KEY, merged, cache)}
+    for hid, h_df in by_horse.items():
+        grids[hid] = cached_density(hid, h_df, cache)
+    return {k: g for k, g in grids.items() if g is not None}
+
+def draw_density(ax, grid, alpha=0.35):
+    """好走密度を背景に描く（赤: 3着以内が多い / 青: 4着以下が多い）"""
+    ax.imshow(
+        grid, origin='lower', aspect='auto', cmap='RdBu_r', vmin=0, vmax=1,
+        alpha=alpha, interpolation='bilinear', zorder=0,
+        extent=[DENSITY_CUSHION[0], DENSITY_CUSHION[-1],
+                DENSITY_MOISTURE[0], DENSITY_MOISTURE[-1]],
+    )
+
 # ============================================================
 # グラフ描画
 # ============================================================
@@ -674,7 +2319,14 @@ def classify_point(row, target_dist):
         return 'blue_circle' if same else 'blue_cross'
 
 def draw_graph(plot_df, out_path, title_str, target_cushion, target_moisture,
-               target_dist, highlight=None, demo_overlay=False, demo_mode=True):
+               target_dist, highlight=None, demo_overlay=False, demo_mode=True,
+               density=None):
+    """
+    highlight: 強調する馬の馬ID
+    pyplot の「現在の図」を使わず Figure を直接作るので、複数スレッドから同時に呼べる
+    （chart_server / api_server はリクエストごとのスレッドで個別グラフを描く）。
+    """
+    t_draw = time.perf_counter()
     all_pts = plot_df.copy() if not plot_df.empty else pd.DataFrame()
     if demo_overlay and demo_mode:
         ddf = pd.DataFrame(DEMO_SAMPLES)
@@ -685,41 +2337,58 @@ def draw_graph(plot_df, out_path, title_str, target_cushion, target_moisture,
     if 'is_demo' not in all_pts.columns:
         all_pts['is_demo'] = False
 
-    fig, ax = plt.subplots(figsize=(16, 10))
+    fig = Figure(figsize=(16, 10))
+    ax = fig.subplots()
     fig.patch.set_facecolor('#e1e4ea')
     ax.set_facecolor('#f5f6f8')
+    if density is not None:
+        draw_density(ax, density)
 
-    for _, row in all_pts.iterrows():
-        x = row.get('cushion', np.nan)
-        y = row.get('moisture', np.nan)
-        if pd.isna(x) or pd.isna(y):
-            continue
-        hn      = str(row.get('horse_name', ''))
-        is_demo = bool(row.get('is_demo', False))
-        pt      = classify_point(row, target_dist)
-
-        if highlight:
-            if hn == highlight:
-                alpha, size, lw = 1.0, 380, 4.5
-            else:
-                alpha, size, lw = (0.3 if is_demo else 0.04), 220, 2.5
+    # 点の区分（classify_point と同じ判定）と強調ごとにまとめて描く
+    # 走数が多くても scatter の呼び出しは十数回で済む
+    if {'cushion', 'moisture'}.issubset(all_pts.columns):
+        pts = all_pts[all_pts['cushion'].notna() & all_pts['moisture'].notna()]
+    else:
+        pts = all_pts.iloc[0:0]
+    if not pts.empty:
+        rank = pd.to_numeric(pts.get('rank'), errors='coerce').to_numpy()
+        good = rank <= 3
+        same = (pts['distance'] == target_dist).to_numpy() if 'distance' in pts.columns \
+            else np.zeros(len(pts), dtype=bool)
+        kind = np.select([good & same, good, same],
+                         ['red_double', 'red_circle', 'blue_circle'], default='blue_cross')
+        is_demo = pts['is_demo'].fillna(False).astype(bool).to_numpy()
+        if highlight is not None:
+            is_hl = (pts['horse_id'] == highlight).to_numpy() \
+                if 'horse_id' in pts.columns else np.zeros(len(pts), dtype=bool)
+            style = np.where(is_hl, 0, np.where(is_demo, 1, 2))
+            styles = {0: (1.0, 380, 4.5), 1: (0.3, 220, 2.5), 2: (0.04, 220, 2.5)}
         else:
-            alpha, size, lw = (0.5 if is_demo else 0.9), 300, 3.5
-
-        if pt == 'red_double':
-            ax.scatter(x, y, s=size*0.8, facecolors='#ef4444', edgecolors='#dc2626',
-                       alpha=alpha, linewidths=lw, zorder=3)
-            ax.scatter(x, y, s=size*2.5, facecolors='none', edgecolors='#ef4444',
-                       alpha=alpha, linewidths=lw, zorder=3)
-        elif pt == 'red_circle':
-            ax.scatter(x, y, s=size*1.2, facecolors='none', edgecolors='#ef4444',
-                       alpha=alpha, linewidths=lw, zorder=3)
-        elif pt == 'blue_circle':
-            ax.scatter(x, y, s=size*1.2, facecolors='none', edgecolors='#3b82f6',
-                       alpha=alpha, linewidths=lw, zorder=3)
-        elif pt == 'blue_cross':
-            ax.scatter(x, y, s=size*1.3, marker='x', c='#3b82f6',
-                       alpha=alpha, linewidths=lw+1, zorder=3)
+            style = np.where(is_demo, 1, 2)
+            styles = {1: (0.5, 300, 3.5), 2: (0.9, 300, 3.5)}
+        xs = pts['cushion'].to_numpy(float)
+        ys = pts['moisture'].to_numpy(float)
+
+        for st_id, (alpha, size, lw) in styles.items():
+            for pt in ['red_double', 'red_circle', 'blue_circle', 'blue_cross']:
+                sel = (style == st_id) & (kind == pt)
+                if not sel.any():
+                    continue
+                x, y = xs[sel], ys[sel]
+                if pt == 'red_double':
+                    ax.scatter(x, y, s=size*0.8, facecolors='#ef4444', edgecolors='#dc2626',
+                               alpha=alpha, linewidths=lw, zorder=3)
+                    ax.scatter(x, y, s=size*2.5, facecolors='none', edgecolors='#ef4444',
+                               alpha=alpha, linewidths=lw, zorder=3)
+                elif pt == 'red_circle':
+                    ax.scatter(x, y, s=size*1.2, facecolors='none', edgecolors='#ef4444',
+                               alpha=alpha, linewidths=lw, zorder=3)
+                elif pt == 'blue_circle':
+                    ax.scatter(x, y, s=size*1.2, facecolors='none', edgecolors='#3b82f6',
+                               alpha=alpha, linewidths=lw, zorder=3)
+                else:
+                    ax.scatter(x, y, s=size*1.3, marker='x', c='#3b82f6',
+                               alpha=alpha, linewidths=lw+1, zorder=3)
 
     ax.axvline(x=target_cushion, color='#f59e0b', linewidth=4, linestyle='--',
                alpha=0.85, zorder=4)
@@ -767,223 +2436,942 @@ def draw_graph(plot_df, out_path, title_str, target_cushion, target_moisture,
         sp.set_edgecolor('#94a3b8')
         sp.set_linewidth(2)
 
-    plt.tight_layout()
+    fig.tight_layout()
     os.makedirs(os.path.dirname(out_path) if os.path.dirname(out_path) else '.', exist_ok=True)
-    plt.savefig(out_path, dpi=300, bbox_inches='tight', facecolor='#f8f9fb')
-    plt.close()
+    rss_before = MONITOR.record()
+    with TIMER.span('png_write', os.path.basename(out_path)):
+        fig.savefig(out_path, dpi=300, bbox_inches='tight', facecolor='#f8f9fb')
+    w, h = fig.get_size_inches() * 300
+    MONITOR.note_figure(os.path.basename(out_path), w * h * 4 / 2**20,
+                        MONITOR.record() - rss_before)
+    sec = time.perf_counter() - t_draw
+    TIMER.add('draw_graph', os.path.basename(out_path), sec)
+    METRICS.observe('render_seconds', sec)
     print(f"      {os.path.basename(out_path)}")
 
+# ============================================================
+# 個別グラフの遅延生成
+# ============================================================
+class ChartCache:
+    """
+    生成済みPNGのバイト列を保持するLRUキャッシュ。
+    合計サイズが max_bytes を超えたら古いものから破棄する。
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    @contextmanager
+    def key_lock(self, key):
+        """
+        キーごとのロック（同じグラフの同時要求で1回だけ描画するため）。
+        使っているスレッドがいなくなったら消す（グラフの数だけロックが残らない）。
+        """
+        with self._lock:
+            lock, users = self._key_locks.get(key, (None, 0))
+            self._key_locks[key] = (lock or threading.Lock(), users + 1)
+            lock = self._key_locks[key][0]
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                lock, users = self._key_locks[key]
+                if users == 1:
+                    del self._key_locks[key]
+                else:
+                    self._key_locks[key] = (lock, users - 1)
+
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    @staticmethod
+    def _nbytes(data):
+        return data.nbytes if isinstance(data, np.ndarray) else len(data)
+
+    def discard(self, key):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= self._nbytes(old)
+
+    def put(self, key, data):
+        if self._nbytes(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._size -= self._nbytes(old)
+            self._items[key] = data
+            self._size += self._nbytes(data)
+            while self._size > self.max_bytes:
+                _, dropped = self._items.popitem(last=False)
+                self._size -= self._nbytes(dropped)
+
+CHART_CACHE   = ChartCache()
+DENSITY_CACHE = ChartCache(max_bytes=32 * 1024 * 1024)   # 好走密度グリッド（numpy配列）
+
+def race_data_path(out_dir, race_no):
+    return f"{out_dir}/{race_no:02d}R_data.csv"
+
+def race_meta_path(out_dir, race_no):
+    return f"{out_dir}/{race_no:02d}R_meta.json"
+
+def horse_chart_path(out_dir, race_no, horse_id):
+    return f"{out_dir}/{race_no:02d}R_{int(horse_id)}.png"
+
+def save_race_render_data(out_dir, race_no, merged, horses, race_label,
+                          target_cushion, target_moisture, target_dist, density=False):
+    """個別グラフを後から描画するための結合データと描画条件を保存する"""
+    merged.to_csv(race_data_path(out_dir, race_no), index=False, encoding='utf-8-sig')
+    meta = {
+        'race_no':     race_no,
+        'label':       race_label,
+        'cushion':     target_cushion,
+        'moisture':    target_moisture,
+        'target_dist': target_dist,
+        'horses':      [[int(h), str(name)] for h, name in horses.items()],
+        'density':     bool(density),
+    }
+    with open(race_meta_path(out_dir, race_no), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=1)
+
+def load_race_render_data(out_dir, race_no):
+    """
+    save_race_render_data で保存したその日の結合データを、過去走データの列だけで読み直す。
+    出力時の過去走の範囲で絞られた走のみ。ファイルがなければ空の DataFrame
+    """
+    path = race_data_path(out_dir, race_no)
+    if not os.path.exists(path):
+        return pd.DataFrame()
+    use = {'race_no', 'horse_id', 'horse_name', 'race_date', 'venue', 'race_name',
+           'distance', 'surface', 'rank'}
+    return compact_runs(pd.read_csv(path, usecols=lambda c: c in use))
+
+def load_race_meta(out_dir, race_no):
+    """描画条件。meta['horses'] = [[馬ID, 馬名], ...]（出馬表順）"""
+    path = race_meta_path(out_dir, race_no)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if 'horses' not in meta:   # 馬名だけを持つ以前の出力
+        meta['horses'] = [[name_horse_id(h), h] for h in meta.pop('horse_names', [])]
+    return meta
+
+def render_horse_chart(out_dir, race_no, horse_id, cache=CHART_CACHE):
+    """
+    個別グラフのPNGバイト列を返す。
+    未生成なら保存済みデータから描画してファイルに書き出し、以後はキャッシュから返す。
+    キャッシュのキーは PNG・描画条件・結合データの更新時刻を含むので、別のプロセスで
+    main_analysis.py を再実行してグラフが描き直し・削除されたら古いバイト列は返さない。
+    描画に必要なデータがない（出走していない馬を含む）場合は None を返す。
+    """
+    horse_id = int(horse_id)
+    path = horse_chart_path(out_dir, race_no, horse_id)
+    sources = [path, race_meta_path(out_dir, race_no), race_data_path(out_dir, race_no)]
+    data = cache.get((path, file_stamp(sources)))
+    if data is not None:
+        return data
+
+    # 同じグラフへの同時要求は先に来た1件が描画し、残りはその結果を待って使う
+    with cache.key_lock(path):
+        data = cache.get((path, file_stamp(sources)))
+        if data is None:
+            data = _render_horse_chart_file(out_dir, race_no, horse_id, path)
+            if data is not None:
+                # 描画後の更新時刻（PNG を書いた時刻を含む）で保持する
+                cache.put((path, file_stamp(sources)), data)
+    return data
+
+def _render_horse_chart_file(out_dir, race_no, horse_id, path):
+    """PNGがなければ保存済みデータから描画し、ファイルのバイト列を返す（描けなければ None）"""
+    if not os.path.exists(path):
+        meta = load_race_meta(out_dir, race_no)
+        data_file = race_data_path(out_dir, race_no)
+        if meta is None or not os.path.exists(data_file):
+            return None
+        hname = dict((int(h), name) for h, name in meta['horses']).get(horse_id)
+        if hname is None:
+            return None
+        # 描画に使う列だけを読む（過去走が多くてもメモリを抑える）
+        use = {'horse_id', 'horse_name', 'cushion', 'moisture', 'distance', 'rank'}
+        merged = ensure_horse_ids(pd.read_csv(data_file, usecols=lambda c: c in use))
+        h_df = (
+            merged[merged['horse_id'] == horse_id]
+            if 'horse_id' in merged.columns else pd.DataFrame()
+        )
+        draw_graph(
+            h_df, path, f"{meta['label']}\n【{hname}】",
+            meta['cushion'], meta['moisture'], meta['target_dist'],
+            highlight=horse_id, demo_overlay=False, demo_mode=False,
+            density=cached_density(horse_id, h_df) if meta.get('density') else None
+        )
+
+    with open(path, 'rb') as f:
+        return f.read()
+
+def render_race(out_dir, race_no, merged, horses, race_label, cushion, moisture,
+                target_dist, demo_mode, lazy_charts, show_density):
+    """1レース分のグラフ（全体 + 個別）と遅延生成用のデータを書き出す。horses = {馬ID: 馬名}"""
+    by_horse  = split_by_horse(merged)
+    densities = field_density(merged, by_horse) if show_density else {}
+    draw_graph(
+        merged, f"{out_dir}/{race_no:02d}R_all.png",
+        race_label, cushion, moisture, target_dist,
+        demo_overlay=True, demo_mode=demo_mode,
+        density=densities.get(FIELD_KEY)
+    )
+    with TIMER.span('file_write', race_data_path(out_dir, race_no)):
+        save_race_render_data(
+            out_dir, race_no, merged, horses, race_label,
+            cushion, moisture, target_dist, density=show_density
+        )
+    if lazy_charts:
+        # 描画条件が変わっている場合があるので、前回の個別グラフは捨てて表示時に描き直す
+        # （キャッシュ済みのバイト列は PNG の更新時刻が変わるので使われなくなる）
+        for hid in horses:
+            path = horse_chart_path(out_dir, race_no, hid)
+            if os.path.exists(path):
+                os.remove(path)
+        print(f"      個別グラフ {len(horses)}頭分は表示時に生成します")
+    else:
+        for hid, hname in horses.items():
+            h_df = by_horse.get(hid, pd.DataFrame())
+            draw_graph(
+                h_df, horse_chart_path(out_dir, race_no, hid),
+                f"{race_label}\n【{hname}】",
+                cushion, moisture, target_dist,
+                highlight=hid, demo_overlay=False, demo_mode=False,
+                density=densities.get(hid)
+            )
+
+# ============================================================
+# 1日分の処理の部品（main とワークキューで共用）
+# ============================================================
+# (設定項目, scrape_baba_info のキー, 既定値, 単位)
+TRACK_KEYS = [('クッション値', 'cushion',       10.0, ''),
+              ('芝含水率',     'moisture_turf', 14.7, '%'),
+              ('ダート含水率', 'moisture_dirt', 18.0, '%')]
+
+def needs_baba_scrape(cfg):
+    """auto が1つでもあればJRAサイトから自動取得する"""
+    return any(cfg[key].strip().lower() == 'auto' for key, _, _, _ in TRACK_KEYS)
+
+def fetch_baba(cfg):
+    venue_jp = cfg['競馬場']
+    print("\nJRAサイトから馬場情報を自動取得中...")
+    with TIMER.span('scrape_baba_info', venue_jp):
+        return scrape_baba_info(venue_jp, cfg['馬場情報URL'].rstrip('/'))
+
+def resolve_track_values(cfg, fetch=True, baba=None):
+    """
+    (クッション値, 芝含水率, ダート含水率) を決める。
+    auto の項目は馬場情報の値（baba を渡さなければ fetch=True のとき取得）、
+    取れなければ手動値、それもなければ既定値を使う。
+    """
+    if baba is None and fetch and needs_baba_scrape(cfg):
+        baba = fetch_baba(cfg)
+    baba = baba or {}
+
+    values = []
+    for key, baba_key, default, unit in TRACK_KEYS:
+        text = cfg[key].strip()
+        value = None
+        if text.lower() == 'auto' and (fetch or baba):
+            value = baba.get(baba_key)
+            if value is None:
+                print(f"   {key}: 自動取得失敗")
+        if value is None:
+            try:
+                value = float(text)
+            except Exception:
+                value = default
+                print(f"   {key}: 手動値なし → デフォルト {value}{unit} を使用")
+        values.append(value)
+
+    print(f"\n使用する馬場情報:")
+    print(f"   クッション値  : {values[0]}")
+    print(f"   芝含水率      : {values[1]}%")
+    print(f"   ダート含水率  : {values[2]}%")
+    return tuple(values)
+
+def load_day_moisture(venue_jp, today_date, cushion, moisture_turf, moisture_dirt):
+    """含水率マスタ（読み込み済みなら再利用）に今日の芝・ダートの値を追記したもの"""
+    with TIMER.span('load_moisture_history'):
+        moisture_df = load_cached('moisture', MOISTURE_CANDIDATES, load_moisture_history)
+    return add_today_moisture(moisture_df, today_date, venue_jp,
+                              cushion, moisture_turf, moisture_dirt)
+
+def shutuba_url(race_base, date_str, venue_jp, kaisai_day, race_no):
+    race_id = f"{date_str.split('.')[0]}{VENUE_CODE.get(venue_jp, '05')}01{kaisai_day}{race_no:02d}"
+    return f"{race_base}/race/shutuba.html?race_id={race_id}&rf=race_list"
+
+def read_race_input(race_file, lookback, today_date):
+    """保存済みの過去走データ → ({馬ID: 馬名}, 過去走の範囲を適用したデータ)"""
+    horses = {}
+    with TIMER.span('file_read', race_file):
+        race_df = load_race_cached(race_file)
+    if not race_df.empty:
+        horses = horse_table(race_df)
+        race_df = apply_lookback(race_df, lookback, today_date)
+        print(f"      既存ファイル使用: {len(race_df)}行 / {len(horses)}頭"
+              f"（{lookback_label(lookback)}）")
+    return horses, race_df
+
+def prepare_race(race_no, race_df, moisture_df, venue_jp, cushion, moisture_turf,
+                 moisture_dirt, demo_mode):
+    """芝・ダート判定、データ結合、距離判定、グラフの見出し"""
+    race_surface = detect_surface(race_df)
+    moisture = moisture_dirt if race_surface == 'ダート' else moisture_turf
+    print(f"   馬場: {race_surface} → 含水率: {moisture}%")
+
+    with TIMER.span('merge_data', f"{race_no}R"):
+        merged = merge_data(race_df, moisture_df, surface=race_surface)
+    if not merged.empty:
+        METRICS.set('merge_match_ratio', round(float(merged['cushion'].notna().mean()), 4),
+                    race=race_no)
+
+    target_dist = detect_target_dist(merged)
+    race_label = (
+        f"{venue_jp} {race_no}R {race_surface} {target_dist}m"
+        f"  C={cushion} M={moisture}%"
+    )
+    if demo_mode:
+        race_label += "\n（サンプルデータ含む）"
+    return {'surface': race_surface, 'moisture': moisture, 'merged': merged,
+            'target_dist': target_dist, 'label': race_label}
+
+def race_rows(race, race_no, cushion):
+    """統合CSV用の行（今回の条件の列を追加。類似馬場の列は add_day_neighbors で追加する）"""
+    merged = race['merged']
+    merged['race_no'] = race_no
+    merged['target_cushion']  = cushion
+    merged['target_moisture'] = race['moisture']
+    merged['target_dist']     = race['target_dist']
+    return merged
+
+def add_day_neighbors(rows, race_dfs, moisture_df, venue_jp, indexes=None):
+    """
+    統合CSV用の行（[(芝/ダート, 1レース分の行)]）に類似馬場の列を追加する。
+    1日分の過去走（race_dfs）の ConditionIndex を芝・ダートの含水率ごとに1回だけ作り、
+    各レースの列はその問い合わせで求める。
+    indexes（{芝/ダート: ConditionIndex}）を渡すと作ったインデックスをそこに残し、次の呼び出しで使い回す。
+    """
+    indexes = {} if indexes is None else indexes
+    out = []
+    for surface, df in rows:
+        if surface not in indexes:
+            with TIMER.span('condition_index', surface):
+                indexes[surface] = build_condition_index(race_dfs, moisture_df, surface)
+        out.append(add_condition_neighbors(df, df['target_cushion'].iloc[0],
+                                           df['target_moisture'].iloc[0],
+                                           index=indexes[surface], venue_jp=venue_jp))
+    return out
+
+def save_day_results(out_dir, all_csv_rows, all_race_dfs, moisture_df, races):
+    """統合CSV・馬場適性ランキングの保存と、馬場別集計キューブの更新（all_race_dfs が空なら更新しない）"""
+    csv_path = f"{out_dir}/analysis_result_all.csv"
+    if all_csv_rows:
+        combined = pd.concat(merge_previous_rows(csv_path, all_csv_rows, races),
+                             ignore_index=True)
+
+        # 馬場適性スコア（1日分をまとめて計算）
+        ranking = rank_field(score_field(combined))
+        combined = combined.merge(
+            ranking[['race_no', 'horse_id', 'suitability', 'suitability_rank']],
+            on=['race_no', 'horse_id'], how='left'
+        )
+        rank_path = f"{out_dir}/suitability_ranking.csv"
+        with TIMER.span('file_write', rank_path):
+            ranking.to_csv(rank_path, index=False, encoding='utf-8-sig')
+        print(f"Ranking saved: {rank_path} ({len(ranking)} horses)")
+
+        with TIMER.span('file_write', csv_path):
+            combined.to_csv(csv_path, index=False, encoding='utf-8-sig')
+        print(f"CSV saved: {csv_path} ({len(combined)} rows)")
+
+    # 馬場別集計キューブ（新しい過去走だけ加算）
+    if all_race_dfs:
+        from condition_cube import update_cube, runs_with_conditions, CUBE_FILE
+        runs = runs_with_conditions(pd.concat(all_race_dfs, ignore_index=True), moisture_df)
+        with TIMER.span('file_write', CUBE_FILE):
+            _, added = update_cube(runs)
+        print(f"Cube updated: {CUBE_FILE} (+{added} runs)")
+
+# ============================================================
+# チェックポイント（中断した実行の再開）
+# ============================================================
+CHECKPOINT_FILE   = 'checkpoint.jsonl'
+CHECKPOINT_FORMAT = 2   # 記録の中身の形式。変えたら上げる（古い形式の記録は使わない）
+BABA_MAX_AGE      = 30 * 60   # 馬場情報の記録を使い回す時間（秒）。これより古ければ取り直す
+
+class Checkpoint:
+    """
+    出力フォルダの checkpoint.jsonl に、終わった処理単位を1行ずつ追記する。
+      baba    : 馬場情報の取得結果（fetched = 取得時刻。BABA_MAX_AGE を過ぎたら取り直す）
+      kaisai  : 開催日番号
+      shutuba : 出馬表の馬（race, horses = [[馬ID, 馬名, URL], ...]）
+      horse   : 1頭分の過去走（race, horse_id, name, rows）
+      scrape  : 1レース分の取得・保存（race, horses = [[馬ID, 馬名], ...]）
+      render  : 1レース分のグラフ（race, key = 描画条件と元データの更新時刻）
+    Chrome の異常終了やスリープで止まった実行をやり直すと、記録済みの単位は
+    取得・描画せずに記録（と保存済みのファイル）を使う。最後まで終わったら消す。
+    1行目の条件（記録の形式・競馬場・日付・過去走の範囲・取得先）が違う記録は使わない。
+    """
+    def __init__(self, path, signature, resume=True):
+        self.path = path
+        self.signature = signature
+        self.entries = []
+        if resume and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self.entries.append(json.loads(line))
+                    except ValueError:
+                        continue   # 書き込み途中で止まった最終行
+        if not self.entries or self.entries[0].get('signature') != signature:
+            self.entries = []
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps({'unit': 'run', 'signature': signature,
+                                    'started': datetime.now().isoformat(timespec='seconds')},
+                                   ensure_ascii=False) + '\n')
+        self.resumed = bool(self.entries)
+
+    def record(self, unit, **fields):
+        line = json.dumps(dict(unit=unit, **fields), ensure_ascii=False, default=str)
+        self.entries.append(json.loads(line))   # 読み戻したときと同じ形で持つ
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def find(self, unit, race=None):
+        """最後に記録した unit（race 指定時はそのレースの分）。なければ None"""
+        for e in reversed(self.entries):
+            if e.get('unit') == unit and (race is None or e.get('race') == race):
+                return e
+        return None
+
+    def horses(self, race):
+        """取得済みの馬ID → 過去走の行（race_date は date に戻す）"""
+        done = {}
+        for e in self.entries:
+            if e.get('unit') == 'horse' and e.get('race') == race:
+                done[e['horse_id']] = [dict(r, race_date=datetime.strptime(r['race_date'], '%Y-%m-%d').date())
+                                   for r in e['rows']]
+        return done
+
+    def summary(self):
+        """再開時に表示する内容"""
+        items = [label for unit, label in (('baba', '馬場情報'), ('kaisai', '開催日番号'))
+                 if self.find(unit)]
+        scraped  = sorted({e['race'] for e in self.entries if e.get('unit') == 'scrape'})
+        rendered = sorted({e['race'] for e in self.entries if e.get('unit') == 'render'})
+        if scraped:
+            items.append(f"取得済み {race_range_label(scraped)}")
+        partial = sorted({e['race'] for e in self.entries if e.get('unit') == 'horse'} - set(scraped))
+        for race in partial:
+            shutuba = self.find('shutuba', race)
+            total = f"/{len(shutuba['horses'])}" if shutuba else ''
+            items.append(f"{race}R {len(self.horses(race))}{total}頭")
+        if rendered:
+            items.append(f"描画済み {race_range_label(rendered)}")
+        return ', '.join(items) or '記録なし'
+
+    def finish(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def checkpoint_signature(cfg):
+    """記録を使い回してよい条件（これが変わったら最初から）"""
+    sig = {key: cfg[key] for key in ('競馬場', 'レース日', '過去走の範囲', 'レース情報URL')}
+    return {'format': CHECKPOINT_FORMAT, **sig}
+
+def render_key(race_file, label, lazy_charts, show_density):
+    """グラフの描画条件。元データ（過去走・含水率マスタ）が更新されていたら一致しない"""
+    stamp = file_stamp(race_file_sources(race_file) + MOISTURE_CANDIDATES)
+    return json.dumps([label, lazy_charts, show_density, stamp], ensure_ascii=False)
+
+# ============================================================
+# 処理段階・対象レースの指定（コマンドライン用）
+# ============================================================
+PHASES    = ('scrape', 'merge', 'render')   # 取得 / 結合・CSV / グラフ
+ALL_RACES = list(range(1, 13))
+
+# 前回の perf_report.json がない場合の見積もり（秒）
+ESTIMATE_SEC = {
+    'scrape_baba_info': 12.0,
+    'get_kaisai_day':   8.0,
+    'scrape_one_race':  60.0,
+    'merge_data':       0.05,
+    'draw_graph':       1.5,
+}
+ESTIMATE_HORSES = 16
+
+def parse_races(text):
+    """'9-12' / '1,3,5-7' / 'all' → レース番号のリスト（1〜12）"""
+    text = str(text).strip().lower().replace('r', '')
+    if text in ('', 'all', '全'):
+        return list(ALL_RACES)
+    races = set()
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        lo, _, hi = part.partition('-')
+        try:
+            lo, hi = int(lo), int(hi or lo)
+        except ValueError:
+            raise ValueError(f"レース指定が読めません: {part}")
+        if not (1 <= lo <= hi <= 12):
+            raise ValueError(f"レース番号は1〜12で指定してください: {part}")
+        races.update(range(lo, hi + 1))
+    return sorted(races)
+
+def parse_phases(text):
+    """'scrape,merge' → ('scrape', 'merge')（PHASES の順）"""
+    names = {p.strip().lower() for p in str(text).split(',') if p.strip()}
+    unknown = names - set(PHASES)
+    if unknown:
+        raise ValueError(f"不明な処理段階: {', '.join(sorted(unknown))}（{', '.join(PHASES)}）")
+    if not names:
+        raise ValueError("処理段階を1つ以上指定してください")
+    return tuple(p for p in PHASES if p in names)
+
+def estimate_run(out_dir, venue_jp, phases, races, need_auto, lazy_charts):
+    """
+    実行せずに所要時間を見積もる（--dry-run）。
+    前回の perf_report.json があればその段階ごとの平均、なければ ESTIMATE_SEC を使う。
+    戻り値: [(内容, 秒), ...]
+    """
+    mean = dict(ESTIMATE_SEC)
+    perf_path = f"{out_dir}/perf_report.json"
+    if os.path.exists(perf_path):
+        with open(perf_path, 'r', encoding='utf-8') as f:
+            for stage, st in json.load(f).get('stages', {}).items():
+                mean[stage] = st['mean']
+
+    def horses(race_no):
+        path = race_file_path(venue_jp, race_no)
+        if any(os.path.exists(p) for p in race_file_sources(path)):
+            df = load_race_file(path, write_parquet=False)
+            if 'horse_id' in df.columns:
+                return df['horse_id'].nunique()
+        return ESTIMATE_HORSES
+
+    items = []
+    analyze = 'merge' in phases or 'render' in phases
+    if need_auto and analyze:
+        items.append(('馬場情報の取得', mean['scrape_baba_info']))
+    if 'scrape' in phases:
+        items.append(('開催日番号の取得', mean['get_kaisai_day']))
+        items.append((f"出馬表・戦績の取得 × {len(races)}R", mean['scrape_one_race'] * len(races)))
+    if analyze:
+        items.append((f"データ結合 × {len(races)}R", mean['merge_data'] * len(races)))
+    if 'render' in phases:
+        charts = len(races) if lazy_charts else sum(1 + horses(r) for r in races)
+        items.append((f"グラフ描画 × {charts}枚", mean['draw_graph'] * charts))
+    return items
+
+def race_range_label(races):
+    """[9, 10, 11, 12] → '9R-12R'、[1, 3] → '1R,3R'"""
+    if races == list(range(races[0], races[-1] + 1)):
+        return f"{races[0]}R-{races[-1]}R" if len(races) > 1 else f"{races[0]}R"
+    return ','.join(f"{r}R" for r in races)
+
+def merge_previous_rows(csv_path, new_rows, races):
+    """
+    一部のレースだけ処理した場合、前回の統合CSVから対象外レースの行を引き継ぐ。
+    （馬場適性スコアは付け直すので前回の列は落とす）
+    """
+    if set(races) == set(ALL_RACES) or not os.path.exists(csv_path):
+        return new_rows
+    prev = ensure_horse_ids(pd.read_csv(csv_path))
+    if 'race_no' not in prev.columns:
+        return new_rows
+    prev = prev[~prev['race_no'].isin(races)]
+    prev = prev.drop(columns=['suitability', 'suitability_rank'], errors='ignore')
+    if prev.empty:
+        return new_rows
+    print(f"   前回のCSVから {prev['race_no'].nunique()}R分 {len(prev)}行を引き継ぎ")
+    return [prev] + new_rows
+
 # ============================================================
 # メイン処理
 # ============================================================
-def main():
-    cfg = load_settings()
+def main(cfg=None, phases=None, races=None, dry_run=False, resume=True):
+    """
+    cfg を渡した場合は settings.txt の代わりにその設定で実行する。
+    phases : 実行する処理段階（PHASES の部分集合）。省略時は設定の スクレイピング に従う
+    races  : 対象レース番号のリスト（省略時 1〜12R）
+    dry_run: True なら実行せずに所要時間の見積もりだけ表示する
+    resume : False なら前回中断したときのチェックポイントを使わずに最初から実行する
+    """
+    cfg = load_settings() if cfg is None else cfg
     venue_jp = cfg['競馬場']
     date_str = cfg['レース日']
     demo_mode = cfg['デモモード'].strip().lower() in ('true','1','yes','はい')
     scraping  = cfg['スクレイピング'].strip().lower() in ('true','1','yes','はい')
+    lazy_charts = cfg['個別グラフ遅延生成'].strip().lower() in ('true','1','yes','はい')
+    show_density = cfg['好走密度表示'].strip().lower() in ('true','1','yes','はい')
+    lookback     = parse_lookback(cfg['過去走の範囲'])
+    race_base    = cfg['レース情報URL'].rstrip('/')
+    baba_base    = cfg['馬場情報URL'].rstrip('/')
+    if phases is None:
+        phases = PHASES if scraping else PHASES[1:]
+    scraping = 'scrape' in phases
+    analyze  = 'merge' in phases or 'render' in phases
+    races    = sorted(races) if races else list(ALL_RACES)
+    TIMER.reset()
+    METRICS.reset()
+    MONITOR.memory_cap_mb = parse_setting_number(cfg['メモリ上限MB'], 'メモリ上限MB', 0.0)
+    MONITOR.start()
+    BROWSER.reset(parse_browser_profile(cfg['ブラウザプロファイル'] or '標準'))
 
     print(f"\n{'='*60}")
     print(f"Horse Racing Analysis System")
-    print(f"   {venue_jp}  {date_str}  1R-12R")
+    print(f"   {venue_jp}  {date_str}  {race_range_label(races)}  過去走: {lookback_label(lookback)}")
+    print(f"   処理段階: {' → '.join(phases)}")
+    if scraping or needs_baba_scrape(cfg):
+        print(f"   ブラウザ: {BROWSER_PROFILES[BROWSER.profile]}")
     print(f"{'='*60}")
 
-    os.makedirs('./data', exist_ok=True)
-
     parts      = date_str.split('.')
-    date_slug  = f"{parts[0]}_{int(parts[1]):02d}_{int(parts[2]):02d}"
+    date_slug  = date_slug_of(date_str)
     venue_slug = safe_name(venue_jp)
-    out_dir    = f"./output/{date_slug}_{venue_slug}"
-    os.makedirs(out_dir, exist_ok=True)
+    out_dir    = output_dir(venue_jp, date_str)
     print(f"Output: {out_dir}/")
 
     # ── 含水率・クッション値の決定 ──────────────────────────
-    cushion_cfg       = cfg['クッション値'].strip()
-    moisture_turf_cfg = cfg['芝含水率'].strip()
-    moisture_dirt_cfg = cfg['ダート含水率'].strip()
-
-    cushion       = None
-    moisture_turf = None
-    moisture_dirt = None
-
-    # autoが1つでもあればJRAサイトから自動取得
-    need_auto = any(
-        v.lower() == 'auto'
-        for v in [cushion_cfg, moisture_turf_cfg, moisture_dirt_cfg]
-    )
-
-    # 含水率のauto取得はスクレイピングフラグに関係なく常に実行
-    if need_auto:
-        print("\nJRAサイトから馬場情報を自動取得中...")
-        baba = scrape_baba_info(venue_jp)
-        if cushion_cfg.lower() == 'auto':
-            cushion = baba.get('cushion')
-            if cushion is None:
-                print("   クッション値: 自動取得失敗")
-        if moisture_turf_cfg.lower() == 'auto':
-            moisture_turf = baba.get('moisture_turf')
-            if moisture_turf is None:
-                print("   芝含水率: 自動取得失敗")
-        if moisture_dirt_cfg.lower() == 'auto':
-            moisture_dirt = baba.get('moisture_dirt')
-            if moisture_dirt is None:
-                print("   ダート含水率: 自動取得失敗")
-
-    # 手動値で補完
-    if cushion is None:
-        try:
-            cushion = float(cushion_cfg)
-        except Exception:
-            cushion = 10.0
-            print(f"   クッション値: 手動値なし → デフォルト {cushion} を使用")
-    if moisture_turf is None:
-        try:
-            moisture_turf = float(moisture_turf_cfg)
-        except Exception:
-            moisture_turf = 14.7
-            print(f"   芝含水率: 手動値なし → デフォルト {moisture_turf}% を使用")
-    if moisture_dirt is None:
-        try:
-            moisture_dirt = float(moisture_dirt_cfg)
-        except Exception:
-            moisture_dirt = 18.0
-            print(f"   ダート含水率: 手動値なし → デフォルト {moisture_dirt}% を使用")
-
-    print(f"\n使用する馬場情報:")
-    print(f"   クッション値  : {cushion}")
-    print(f"   芝含水率      : {moisture_turf}%")
-    print(f"   ダート含水率  : {moisture_dirt}%")
+    need_auto = needs_baba_scrape(cfg)
+
+    if dry_run:
+        MONITOR.stop()
+        items = estimate_run(out_dir, venue_jp, phases, races, need_auto, lazy_charts)
+        print(f"\n実行せずに見積もり（--dry-run）:")
+        for label, sec in items:
+            print(f"   {label:<28} {sec:8.1f}s")
+        print(f"   {'合計':<28} {sum(s for _, s in items):8.1f}s")
+        return items
+
+    # ここから先はファイルを書く（--dry-run はフォルダも作らない）
+    os.makedirs('./data', exist_ok=True)
+    os.makedirs(out_dir, exist_ok=True)
+    FETCH_POLICY.reset(rate=parse_setting_number(cfg['取得レート'], '取得レート', 1.0, above=True),
+                       log_path=(f"{out_dir}/fetch_log.jsonl"
+                                 if scraping or need_auto else None))
+    checkpoint = Checkpoint(f"{out_dir}/{CHECKPOINT_FILE}", checkpoint_signature(cfg), resume)
+    if checkpoint.resumed:
+        print(f"チェックポイントから再開: {checkpoint.summary()}")
+
+    # 含水率のauto取得はスクレイピングフラグに関係なく常に実行（結合・描画しない場合は不要）
+    baba = None
+    if analyze and need_auto:
+        saved = checkpoint.find('baba')
+        # 当日の馬場は散水・降雨で変わるので、古い記録は使わずに取り直す
+        if saved and time.time() - saved.get('fetched', 0) <= BABA_MAX_AGE:
+            baba = saved['values']
+            print("\n馬場情報: チェックポイントの値を使用")
+        else:
+            baba = fetch_baba(cfg)
+            if any(v is not None for v in (baba or {}).values()):
+                checkpoint.record('baba', values=baba, fetched=time.time())
+    cushion, moisture_turf, moisture_dirt = resolve_track_values(cfg, fetch=analyze, baba=baba)
 
-    # ── 含水率マスタ読み込み ─────────────────────────────────
-    moisture_df = load_moisture_history()
+    # ── 含水率マスタ読み込み（今日の芝・ダートデータを追記）──────
     today_date  = datetime(*[int(x) for x in date_str.split('.')]).date()
-
-    # 今日の芝・ダートデータを追記
-    new_rows = []
-    for surf, mval in [('芝', moisture_turf), ('ダート', moisture_dirt)]:
-        has = False
-        if not moisture_df.empty:
-            has = any(
-                str(r['date']) == str(today_date) and
-                str(r.get('venue','')) == venue_jp and
-                str(r.get('surface','')) == surf
-                for _, r in moisture_df.iterrows()
-            )
-        if not has:
-            new_rows.append({
-                'date': today_date, 'venue': venue_jp,
-                'cushion': cushion, 'moisture': mval, 'surface': surf
-            })
-    if new_rows:
-        moisture_df = pd.concat(
-            [moisture_df, pd.DataFrame(new_rows)], ignore_index=True
-        )
+    moisture_df = load_day_moisture(venue_jp, today_date, cushion, moisture_turf, moisture_dirt)
 
     # ── 開催日番号取得 ────────────────────────────────────────
-    year_int  = int(parts[0])
-    month_int = int(parts[1])
-    day_int   = int(parts[2])
-    vcode     = VENUE_CODE.get(venue_jp, '05')
-    kaisai_day = get_kaisai_day(year_int, month_int, day_int, venue_jp)
+    # 開催日番号はURL組み立てにのみ使うので、スクレイピングしない場合は取得しない
+    kaisai_day = '01'
+    if scraping:
+        saved = checkpoint.find('kaisai')
+        if saved:
+            kaisai_day = saved['value']
+        else:
+            with TIMER.span('get_kaisai_day', date_str):
+                kaisai_day = get_kaisai_day(*[int(x) for x in parts], venue_jp, race_base)
+            checkpoint.record('kaisai', value=kaisai_day)
 
-    all_csv_rows = []
+    all_csv_rows  = []
+    all_race_dfs  = []
+    race_surfaces = {}
 
     # ── 1R〜12R ループ ────────────────────────────────────────
-    for race_no in range(1, 13):
+    for race_no in races:
         print(f"\n{'─'*50}")
         print(f"{venue_jp} {race_no}R 処理中...")
 
-        rnum     = f"{race_no:02d}"
-        race_id  = f"{parts[0]}{vcode}01{kaisai_day}{rnum}"
-        race_url = (
-            f"https://race.netkeiba.com/race/shutuba.html"
-            f"?race_id={race_id}&rf=race_list"
-        )
+        race_url = shutuba_url(race_base, date_str, venue_jp, kaisai_day, race_no)
         print(f"   URL: {race_url}")
 
-        race_file = f"./data/race_data_{venue_slug}_{race_no}R.xlsx"
-        if scraping:
-            horse_names, race_df = scrape_one_race(
-                race_url, venue_jp, race_no, date_str
-            )
+        race_file = race_file_path(venue_jp, race_no)
+        scraped = checkpoint.find('scrape', race_no) if scraping else None
+        if scraped:
+            # 記録した行から取得直後と同じデータを作る（保存ファイルがなければ書き直す）
+            horses     = {hid: name for hid, name in scraped['horses']}
+            saved_rows = checkpoint.horses(race_no)
+            race_df = pd.DataFrame([r for h in horses for r in saved_rows.get(h, [])])
+            print(f"   取得済み（チェックポイント）: {len(race_df)}行 / {len(horses)}頭")
+            if not os.path.exists(race_file):
+                with TIMER.span('file_write', race_file):
+                    save_race_file(race_df, race_file)
+        elif scraping:
+            with TIMER.span('scrape_one_race', f"{race_no}R"):
+                horses, race_df = scrape_one_race(
+                    race_url, venue_jp, race_no, date_str, lookback, checkpoint
+                )
             if not race_df.empty:
-                race_df.to_excel(race_file, index=False)
+                with TIMER.span('file_write', race_file):
+                    save_race_file(race_df, race_file)
+                # 取得できなかった馬がいれば、次回の再開でその馬だけ取り直す
+                if len(checkpoint.horses(race_no)) == len(horses):
+                    checkpoint.record('scrape', race=race_no,
+                                      horses=[[hid, name] for hid, name in horses.items()])
         else:
-            horse_names = []
-            race_df = pd.DataFrame()
-            if os.path.exists(race_file):
-                race_df = pd.read_excel(race_file)
-                horse_names = (
-                    race_df['horse_name'].unique().tolist()
-                    if 'horse_name' in race_df.columns else []
-                )
-                print(f"      既存ファイル使用: {len(race_df)}行 / {len(horse_names)}頭")
+            horses, race_df = read_race_input(race_file, lookback, today_date)
 
         if race_df.empty:
             print(f"      {race_no}Rはデータなし（全頭0走 - 新馬戦の可能性）")
             continue
+        all_race_dfs.append(race_df)
+        if not analyze:
+            print(f"   {race_no}R 取得のみ完了")
+            continue
 
-        # 芝・ダート判定
-        race_surface = '芝'
-        if 'surface' in race_df.columns:
-            mode = race_df['surface'].mode()
-            if not mode.empty:
-                race_surface = mode.iloc[0]
-
-        moisture = moisture_dirt if race_surface == 'ダート' else moisture_turf
-        print(f"   馬場: {race_surface} → 含水率: {moisture}%")
-
-        # データ結合
-        merged = merge_data(race_df, moisture_df, surface=race_surface)
-
-        # 距離取得
-        if not merged.empty and 'distance' in merged.columns:
-            mode_d = merged['distance'].dropna().mode()
-            target_dist = int(mode_d[0]) if not mode_d.empty else 1600
-        else:
-            target_dist = 1600
-
-        race_label = (
-            f"{venue_jp} {race_no}R {race_surface} {target_dist}m"
-            f"  C={cushion} M={moisture}%"
-        )
-        if demo_mode:
-            race_label += "\n（サンプルデータ含む）"
+        race = prepare_race(race_no, race_df, moisture_df, venue_jp,
+                            cushion, moisture_turf, moisture_dirt, demo_mode)
+        race_surfaces[race_no] = race['surface']
 
         # グラフ出力
-        draw_graph(
-            merged, f"{out_dir}/{race_no:02d}R_all.png",
-            race_label, cushion, moisture, target_dist,
-            demo_overlay=True, demo_mode=demo_mode
-        )
-        for hname in horse_names:
-            h_df = (
-                merged[merged['horse_name'] == hname].copy()
-                if not merged.empty else pd.DataFrame()
-            )
-            draw_graph(
-                h_df, f"{out_dir}/{race_no:02d}R_{safe_name(hname)}.png",
-                f"{race_label}\n【{hname}】",
-                cushion, moisture, target_dist,
-                highlight=hname, demo_overlay=False, demo_mode=False
-            )
+        if 'render' in phases:
+            key = render_key(race_file, race['label'], lazy_charts, show_density)
+            rendered = checkpoint.find('render', race_no)
+            if (rendered and rendered['key'] == key
+                    and os.path.exists(f"{out_dir}/{race_no:02d}R_all.png")):
+                print(f"   グラフは描画済み（チェックポイント）")
+            else:
+                render_race(out_dir, race_no, race['merged'], horses, race['label'],
+                            cushion, race['moisture'], race['target_dist'],
+                            demo_mode, lazy_charts, show_density)
+                checkpoint.record('render', race=race_no, key=key)
 
-        if not merged.empty:
-            merged['race_no'] = race_no
-            all_csv_rows.append(merged)
+        if not race['merged'].empty and 'merge' in phases:
+            all_csv_rows.append((race['surface'], race_rows(race, race_no, cushion)))
 
         print(f"   {race_no}R 完了")
 
-    # 統合CSV保存
+    # 統合CSV・ランキング・馬場別集計キューブ
     print(f"\n{'='*60}")
-    if all_csv_rows:
-        combined = pd.concat(all_csv_rows, ignore_index=True)
-        csv_path = f"{out_dir}/analysis_result_all.csv"
-        combined.to_csv(csv_path, index=False, encoding='utf-8-sig')
-        print(f"CSV saved: {csv_path} ({len(combined)} rows)")
+    if 'merge' in phases:
+        all_csv_rows = add_day_neighbors(all_csv_rows, all_race_dfs, moisture_df, venue_jp)
+        save_day_results(out_dir, all_csv_rows, all_race_dfs, moisture_df, races)
+    checkpoint.finish()
+
+    # 処理時間レポート
+    perf_path = f"{out_dir}/perf_report.json"
+    MONITOR.stop()
+    rep = TIMER.save(perf_path, {'resources': MONITOR.report(),
+                                 'fetch_policy': FETCH_POLICY.report(),
+                                 'browser': BROWSER.report()})
+    print(f"Perf report: {perf_path} (total {rep['wall_sec']:.1f}s, "
+          f"peak {rep['resources']['peak_mb']['total_mb']:.0f}MB)")
+    for item in rep['slowest'][:3]:
+        print(f"   {item['stage']:<18} {item['sec']:7.2f}s  {item['item']}")
+
+    # メトリクス
+    fetch_sec = sum(rep['stages'].get(s, {}).get('total', 0) for s in ('page_get', 'sleep'))
+    pages = METRICS.total('pages_fetched_total')
+    if pages and fetch_sec:
+        METRICS.set('pages_per_second', round(pages / fetch_sec, 4))
+    METRICS.set('run_seconds', round(rep['wall_sec'], 3))
+    run_labels = {'venue': venue_slug, 'date': date_slug}
+    METRICS.write_textfile(f"{out_dir}/metrics.prom", run_labels)
+    textfile_dir = cfg['メトリクス出力先'].strip()
+    if textfile_dir:
+        os.makedirs(textfile_dir, exist_ok=True)
+        METRICS.write_textfile(os.path.join(textfile_dir, f"keiba_{venue_slug}.prom"), run_labels)
+    METRICS.append_jsonl('./output/metrics.jsonl', **run_labels)
+    history = BROWSER.save_history()
+    if history:
+        print(f"Browser: {BROWSER_STATS_FILE}（これまでの累計）")
+        for profile, h in history.items():
+            print(f"   {BROWSER_PROFILES.get(profile, profile)}: {h['pages']} pages, "
+                  f"{h['kb_per_page']}KB/page, {h['sec_per_page']}s/page")
+    print(f"Metrics: {out_dir}/metrics.prom, ./output/metrics.jsonl "
+          f"({pages} pages, {METRICS.total('retries_total')} retries)")
 
     print(f"\nDone! Output: {out_dir}/")
     print(f"{'='*60}\n")
+    return {'cushion': cushion, 'moisture_turf': moisture_turf,
+            'moisture_dirt': moisture_dirt, 'surfaces': race_surfaces}
+
+# ============================================================
+# ウォッチモード（当日の馬場情報の更新を追いかける）
+# ============================================================
+WATCH_INTERVAL = 600   # 馬場情報の確認間隔（秒）
+WATCH_KEYS = {         # 設定項目 → (scrape_baba_info のキー, 影響する馬場。None = 全レース)
+    'クッション値': ('cushion',       None),
+    '芝含水率':     ('moisture_turf', '芝'),
+    'ダート含水率': ('moisture_dirt', 'ダート'),
+}
+
+def affected_races(changed, surfaces):
+    """変わった設定項目から、描き直すレース番号を求める"""
+    races = set()
+    for key in changed:
+        surface = WATCH_KEYS[key][1]
+        races.update(r for r, s in surfaces.items() if surface is None or s == surface)
+    return sorted(races)
+
+def watch(cfg, phases=None, races=None, interval=WATCH_INTERVAL, max_polls=None):
+    """
+    1回通常どおり実行したあと、馬場情報ページを interval 秒ごとに確認し（BabaWatcher）、
+    auto の項目（クッション値 / 芝含水率 / ダート含水率）が変わったら
+    影響するレースだけ結合・描画し直して、統合CSV・ランキングのそのレースの行を差し替える。
+    main() は再実行しない（計測・取得ポリシーはそのまま、過去走は増えないのでキューブも更新しない）。
+    過去走データ・含水率マスタ・類似馬場のインデックス・好走密度はメモリに保持したまま使い回す。
+    """
+    result = main(cfg, phases=phases, races=races)
+    auto = [k for k in WATCH_KEYS if cfg[k].strip().lower() == 'auto']
+    if not auto:
+        print("ウォッチモード: auto の項目がないため終了します")
+        return
+    current = {k: result[WATCH_KEYS[k][0]] for k in WATCH_KEYS}
+    surfaces = dict(result['surfaces'])
+    redo_phases = [p for p in (phases or PHASES) if p in ('merge', 'render')]
+    print(f"ウォッチモード: {', '.join(auto)} を {interval:.0f}秒ごとに確認（終了: Ctrl+C）")
+
+    # 描き直しに使う入力（1回目の実行で読み込んだものをメモリから取り出す）
+    venue_jp, date_str = cfg['競馬場'], cfg['レース日']
+    on = lambda key: cfg[key].strip().lower() in ('true','1','yes','はい')
+    today_date = datetime(*[int(x) for x in date_str.split('.')]).date()
+    out_dir    = output_dir(venue_jp, date_str)
+    lookback   = parse_lookback(cfg['過去走の範囲'])
+    inputs = {r: read_race_input(race_file_path(venue_jp, r), lookback, today_date)
+              for r in surfaces}
+    race_dfs = [df for _, df in inputs.values() if not df.empty]
+    indexes = {}   # 過去走の馬場は当日の値で変わらないので、類似馬場のインデックスは作り直さない
+    watcher = BabaWatcher(venue_jp, cfg['馬場情報URL'])
+
+    polls = 0
+    try:
+        while max_polls is None or polls < max_polls:
+            time.sleep(interval)
+            polls += 1
+            stamp = datetime.now().strftime('%H:%M:%S')
+            baba = watcher.poll()
+            latest = dict(current)
+            for key in auto:
+                value = baba.get(WATCH_KEYS[key][0])
+                if value is not None:
+                    latest[key] = value
+            changed = [k for k in auto if latest[k] != current[k]]
+            if not changed:
+                print(f"[{stamp}] 変化なし")
+                continue
+            redo = affected_races(changed, surfaces)
+            print(f"[{stamp}] " + ', '.join(f"{k} {current[k]} → {latest[k]}" for k in changed)
+                  + f" → {race_range_label(redo) if redo else '対象レースなし'}")
+            current = latest
+            if not redo:
+                continue
+
+            t = time.perf_counter()
+            cushion, moisture_turf, moisture_dirt = (
+                current['クッション値'], current['芝含水率'], current['ダート含水率'])
+            moisture_df = load_day_moisture(venue_jp, today_date, cushion,
+                                            moisture_turf, moisture_dirt)
+            rows = []
+            for race_no in redo:
+                horses, race_df = inputs[race_no]
+                race = prepare_race(race_no, race_df, moisture_df, venue_jp, cushion,
+                                    moisture_turf, moisture_dirt, on('デモモード'))
+                if 'render' in redo_phases:
+                    render_race(out_dir, race_no, race['merged'], horses, race['label'],
+                                cushion, race['moisture'], race['target_dist'],
+                                on('デモモード'), on('個別グラフ遅延生成'), on('好走密度表示'))
+                if 'merge' in redo_phases and not race['merged'].empty:
+                    rows.append((race['surface'], race_rows(race, race_no, cushion)))
+            if rows:
+                rows = add_day_neighbors(rows, race_dfs, moisture_df, venue_jp, indexes)
+                save_day_results(out_dir, rows, [], moisture_df, redo)
+            print(f"[{datetime.now():%H:%M:%S}] {race_range_label(redo)} 更新完了 "
+                  f"({time.perf_counter() - t:.1f}s)")
+    except KeyboardInterrupt:
+        print("\nウォッチモードを終了しました")
+    finally:
+        watcher.close()
+
+def parse_args(argv=None):
+    """コマンドライン引数 → (cfg, args)。指定しない項目は settings.txt の値"""
+    import argparse
+
+    def typed(fn):
+        """ValueError のメッセージをそのまま argparse のエラーとして表示する"""
+        def convert(text):
+            try:
+                return fn(text)
+            except ValueError as e:
+                raise argparse.ArgumentTypeError(str(e))
+        return convert
+
+    parser = argparse.ArgumentParser(
+        description='1日分（1〜12R）の過去走取得・結合・グラフ出力',
+        epilog='例: python main_analysis.py --races 9-12 --phases merge,render --cushion 9.8')
+    parser.add_argument('--phases', type=typed(parse_phases), default=None,
+                        help=f"実行する処理段階 {','.join(PHASES)}（既定: 設定の スクレイピング に従う）")
+    parser.add_argument('--races', type=typed(parse_races), default=None,
+                        help='対象レース（例: 9-12, 1,3,5-7。既定: 全レース）')
+    parser.add_argument('--venue', help='競馬場（例: 東京）')
+    parser.add_argument('--date', help='レース日（例: 2026.2.15）')
+    parser.add_argument('--cushion', help='クッション値（数値 または auto）')
+    parser.add_argument('--turf-moisture', help='芝含水率（数値 または auto）')
+    parser.add_argument('--dirt-moisture', help='ダート含水率（数値 または auto）')
+    parser.add_argument('--lookback', help='過去走の範囲（例: 7, 365日, 全走）')
+    parser.add_argument('--set', action='append', default=[], metavar='キー=値',
+                        help='settings.txt の任意の項目を上書き（複数可）')
+    parser.add_argument('--browser', type=typed(parse_browser_profile), default=None,
+                        help='Chrome のプロファイル（標準 / 軽量）')
+    parser.add_argument('--fresh', action='store_true',
+                        help='中断した実行のチェックポイントを使わずに最初から実行する')
+    parser.add_argument('--dry-run', action='store_true', help='実行せずに所要時間を見積もる')
+    parser.add_argument('--watch', action='store_true',
+                        help='実行後も馬場情報を確認し続け、変わったレースだけ描き直す')
+    parser.add_argument('--interval', type=float, default=WATCH_INTERVAL,
+                        help=f"--watch の確認間隔（秒、既定 {WATCH_INTERVAL}）")
+    args = parser.parse_args(argv)
+
+    cfg = load_settings()
+    overrides = {
+        '競馬場': args.venue, 'レース日': args.date, 'クッション値': args.cushion,
+        '芝含水率': args.turf_moisture, 'ダート含水率': args.dirt_moisture,
+        '過去走の範囲': args.lookback,
+        'ブラウザプロファイル': args.browser and BROWSER_PROFILES[args.browser],
+    }
+    for item in args.set:
+        key, sep, val = item.partition('=')
+        if not sep or key.strip() not in cfg:
+            parser.error(f"--set の項目が不明です: {item}")
+        overrides[key.strip()] = val.strip()
+    cfg.update({k: str(v) for k, v in overrides.items() if v is not None})
+    if args.venue and args.venue not in VENUE_CODE:
+        parser.error(f"不明な競馬場: {args.venue}")
+    return cfg, args
 
 if __name__ == '__main__':
-    main()
+    cfg, args = parse_args()
+    if args.watch and not args.dry_run:
+        watch(cfg, phases=args.phases, races=args.races, interval=args.interval)
+    else:
+        main(cfg, phases=args.phases, races=args.races, dry_run=args.dry_run,
+             resume=not args.fresh)
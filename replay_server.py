@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+replay_server.py
+netkeiba / JRA の代わりに、レース一覧・出馬表・馬の戦績・馬場情報のページを返す
+ローカルサーバーです。スクレイピング処理をネット接続なしで計測・確認できます。
+
+  - 録画フォルダ（--record-dir）に同じURLのHTMLがあればそれを返す
+  - なければ合成ページを返す（同じURLなら毎回同じ内容）
+  - --latency / --jitter で応答遅延、--fail-rate で失敗応答を混ぜられる
+
+使い方:
+  python replay_server.py [--port 8503] [--latency 0.3] [--fail-rate 0.05]
+  settings.txt の レース情報URL / 馬場情報URL を http://127.0.0.1:8503 にして
+  main_analysis.py を実行します。
+  統計: http://127.0.0.1:8503/__stats
+
+録画フォルダのファイル名は URL のパス+クエリを quote したもの + .html
+  例: %2Frace%2Fshutuba.html%3Frace_id%3D202605010112%26rf%3Drace_list.html
+"""
+
+import os, json, time, random, argparse, threading
+from datetime import date, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs, quote
+
+from main_analysis import VENUE_CODE, VENUE_LIST
+
+KANA = 'アイウカキクサシスタチツナニヌハヒフマミムラリルレロワン'
+
+# ============================================================
+# 合成ページ
+# ============================================================
+def page(title, body):
+    return (f'<html><head><meta charset="utf-8"><title>{title}</title></head>'
+            f'<body>{body}</body></html>')
+
+def race_list_page(kaisai_date, rng):
+    """開催日の全場 1R〜12R のリンク（race_id = 年+場+回+日目+R）"""
+    year = kaisai_date[:4]
+    links = []
+    for code in VENUE_CODE.values():
+        kai, day = rng.randint(1, 5), rng.randint(1, 8)
+        for r in range(1, 13):
+            rid = f"{year}{code}{kai:02d}{day:02d}{r:02d}"
+            links.append(f'<a href="/race/result.html?race_id={rid}&rf=race_list">{r}R</a>')
+    return page('race_list', '<br>'.join(links))
+
+def horse_name(rng):
+    return ''.join(rng.choice(KANA) for _ in range(rng.randint(4, 8)))
+
+def shutuba_page(race_id, rng, n_horses, host):
+    rows = []
+    for i in range(1, n_horses + 1):
+        hid = f"{race_id}{i:02d}"
+        rows.append(f'<tr><td>{i}</td><td class="HorseName">'
+                    f'<a href="http://{host}/horse/{hid}/">{horse_name(rng)}</a></td></tr>')
+    return page('shutuba', f'<table class="Shutuba_Table"><tbody>{"".join(rows)}</tbody></table>')
+
+def horse_page(rng, n_runs, today):
+    """戦績表（新しい順）。列の位置は scrape_one_race の読み取り位置に合わせる"""
+    rows, d = [], today
+    for i in range(n_runs):
+        d -= timedelta(days=rng.randint(21, 70))
+        surface = rng.choice(['芝', 'ダ'])
+        cells = [
+            d.strftime('%Y/%m/%d'), f"{rng.randint(1, 5)}{rng.choice(VENUE_LIST)}{rng.randint(1, 8)}",
+            '晴', str(rng.randint(1, 12)), f"リプレイ{i}S",
+            f"{surface}{rng.choice([1200, 1400, 1600, 1800, 2000, 2400])}",
+            str(rng.randint(8, 18)), str(rng.randint(1, 8)), str(rng.randint(1, 18)),
+            f"{rng.uniform(1.5, 99):.1f}", str(rng.randint(1, 18)), str(rng.randint(1, 18)),
+        ]
+        rows.append('<tr>' + ''.join(f'<td>{c}</td>' for c in cells) + '</tr>')
+    return page('horse', f'<table class="db_h_race_results"><tbody>{"".join(rows)}</tbody></table>')
+
+def baba_page(rng):
+    return page('baba', (
+        f'<div id="cushion_data"><div style="left: 46%;">{rng.uniform(8.0, 11.5):.1f}</div></div>'
+        f'<table><tr id="turf_line"><th>芝</th><td class="gm">{rng.uniform(9, 20):.1f}%</td>'
+        f'<td>{rng.uniform(9, 20):.1f}%</td></tr>'
+        f'<tr id="dirt_line"><th>ダート</th><td class="gm">{rng.uniform(4, 16):.1f}%</td>'
+        f'<td>{rng.uniform(4, 16):.1f}%</td></tr></table>'))
+
+# ============================================================
+# サーバー
+# ============================================================
+class ReplayState:
+    """応答の設定と統計（スレッド間で共有）"""
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'failures': 0, 'recorded': 0, 'by_kind': {}}
+        self.fail_rng = random.Random(args.seed)
+
+    def count(self, kind, failed=False, recorded=False):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['failures'] += int(failed)
+            self.stats['recorded'] += int(recorded)
+            self.stats['by_kind'][kind] = self.stats['by_kind'].get(kind, 0) + 1
+
+    def should_fail(self):
+        with self.lock:
+            return self.fail_rng.random() < self.args.fail_rate
+
+def classify(path):
+    if path.startswith('/top/race_list'):
+        return 'race_list'
+    if path.startswith('/race/shutuba'):
+        return 'shutuba'
+    if path.startswith('/horse/'):
+        return 'horse'
+    if path.startswith('/keiba/baba'):
+        return 'baba'
+    return 'other'
+
+def make_handler(state):
+    args = state.args
+
+    class ReplayHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            if parts.path == '/__stats':
+                with state.lock:
+                    body = json.dumps(state.stats, ensure_ascii=False).encode('utf-8')
+                return self._send(200, 'application/json', body)
+
+            kind = classify(parts.path)
+            delay = args.latency + random.uniform(0, args.jitter)
+            if delay > 0:
+                time.sleep(delay)
+            if kind != 'other' and state.should_fail():
+                state.count(kind, failed=True)
+                return self._send(args.fail_status, 'text/plain; charset=utf-8',
+                                  b'injected failure')
+
+            # 録画済みページ
+            if args.record_dir:
+                rec = os.path.join(args.record_dir, quote(self.path, safe='') + '.html')
+                if os.path.isfile(rec):
+                    with open(rec, 'rb') as f:
+                        state.count(kind, recorded=True)
+                        return self._send(200, 'text/html; charset=utf-8', f.read())
+
+            # 合成ページ（URLごとに固定の乱数）
+            rng = random.Random(f"{args.seed}:{self.path}")
+            query = parse_qs(parts.query)
+            if kind == 'race_list':
+                html = race_list_page(query.get('kaisai_date', ['20260215'])[0], rng)
+            elif kind == 'shutuba':
+                html = shutuba_page(query.get('race_id', ['000000000000'])[0], rng,
+                                    args.horses, self.headers.get('Host', 'localhost'))
+            elif kind == 'horse':
+                html = horse_page(rng, args.runs, args.today)
+            elif kind == 'baba':
+                html = baba_page(rng)
+            else:
+                state.count(kind)
+                return self._send(404, 'text/plain; charset=utf-8', b'not found')
+            state.count(kind)
+            self._send(200, 'text/html; charset=utf-8', html.encode('utf-8'))
+
+        def _send(self, status, ctype, data):
+            self.send_response(status)
+            self.send_header('Content-Type', ctype)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, fmt, *args_):
+            pass
+
+    return ReplayHandler
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='netkeiba / JRA の代替ローカルサーバー')
+    parser.add_argument('--port', type=int, default=8503)
+    parser.add_argument('--latency', type=float, default=0.0, help='応答遅延（秒）')
+    parser.add_argument('--jitter', type=float, default=0.0, help='遅延のばらつき（0〜秒）')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='失敗応答の割合 0〜1')
+    parser.add_argument('--fail-status', type=int, default=503)
+    parser.add_argument('--record-dir', default=None, help='録画済みHTMLのフォルダ')
+    parser.add_argument('--horses', type=int, default=16, help='出馬表の頭数')
+    parser.add_argument('--runs', type=int, default=20, help='戦績の走数')
+    parser.add_argument('--today', default=None, help='戦績の基準日 YYYY-MM-DD')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    args.today = date.fromisoformat(args.today) if args.today else date.today()
+    return args
+
+def serve(args):
+    """サーバーを作って返す（serve_forever は呼び出し側で）"""
+    return ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(ReplayState(args)))
+
+def main():
+    args = parse_args()
+    server = serve(args)
+    print(f"リプレイサーバー: http://127.0.0.1:{args.port}/  "
+          f"遅延 {args.latency}+{args.jitter}s / 失敗率 {args.fail_rate:.0%}（終了: Ctrl+C）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
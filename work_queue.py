@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+work_queue.py
+1日分の処理をジョブに分けて SQLite のキューファイルに登録し、
+複数のワーカー（プロセス / 別のPC）で分担して実行します。
+
+ジョブ:
+  kaisai    開催日番号の取得（スクレイピングする場合）
+  baba      馬場情報の取得（auto の項目がある場合）
+  scrape    各レースの出馬表・戦績の取得 → ./data/race_data_*.xlsx
+  render    各レースの結合・グラフ出力（依存: baba, そのレースの scrape）
+  finalize  統合CSV・ランキング・キューブ（依存: 全レースの render）
+
+ワーカーはジョブを一定時間の「リース」付きで取り出し、実行中は延長します。
+ワーカーが落ちてリースが切れたジョブは別のワーカーが取り直し、
+失敗したジョブは待ち時間を伸ばしながら max_attempts 回まで再実行します。
+ジョブの結果はキューファイルに、データ・グラフは ./data と ./output に書きます。
+取得先ホストごとの取得レート（settings.txt の 取得レート）とサーキットブレーカーの状態も
+キューファイルに置き、全ワーカーの合計がその上限に収まるようにします。
+
+使い方:
+  python work_queue.py enqueue --races 9-12 --cushion 9.8   # main_analysis.py と同じ引数
+  python work_queue.py worker --processes 4                 # このPCで4プロセス
+  python work_queue.py status
+  python work_queue.py retry                                # 失敗したジョブをやり直す
+
+別のPCと分担する場合は、キューファイル（--db）と作業フォルダ（data / output /
+含水率.xlsx）を共有フォルダに置き、各PCでそのフォルダから worker を起動します。
+（ネットワークドライブでは WAL が使えないため、通常のジャーナルで書き込みます）
+"""
+
+import io, os, json, time, socket, sqlite3, argparse, threading, multiprocessing
+from contextlib import contextmanager, redirect_stdout, nullcontext
+from datetime import datetime
+
+import pandas as pd
+
+import main_analysis as ma
+
+QUEUE_FILE   = './data/work_queue.db'
+LEASE_SEC    = 300    # リースの長さ（実行中は LEASE_SEC/3 ごとに延長）
+MAX_ATTEMPTS = 3
+RETRY_BASE   = 10     # 再実行までの待ち時間（秒）= RETRY_BASE * 2^(試行回数-1)
+POLL_SEC     = 2.0    # 実行できるジョブがないときの待ち時間
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS days (
+    id       INTEGER PRIMARY KEY,
+    cfg      TEXT NOT NULL,
+    phases   TEXT NOT NULL,
+    races    TEXT NOT NULL,
+    created  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    id           INTEGER PRIMARY KEY,
+    day_id       INTEGER NOT NULL REFERENCES days(id),
+    kind         TEXT NOT NULL,
+    race_no      INTEGER,
+    deps         TEXT NOT NULL DEFAULT '[]',
+    state        TEXT NOT NULL DEFAULT 'pending',   -- pending / leased / done / failed
+    attempts     INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    not_before   REAL NOT NULL DEFAULT 0,
+    owner        TEXT,
+    lease_until  REAL,
+    result       TEXT,
+    error        TEXT,
+    updated      REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs(state, not_before);
+"""
+
+def flag(cfg, key):
+    return cfg[key].strip().lower() in ('true', '1', 'yes', 'はい')
+
+# ============================================================
+# キュー
+# ============================================================
+class WorkQueue:
+    def __init__(self, path=QUEUE_FILE):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        """書き込みロックを先に取る（複数ワーカーが同じジョブを取らないように）"""
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.conn
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    # ── 登録 ──────────────────────────────────────────────
+    def enqueue_day(self, cfg, phases, races, max_attempts=MAX_ATTEMPTS):
+        """1日分のジョブを依存関係つきで登録する。戻り値: day_id"""
+        now = time.time()
+        analyze = 'merge' in phases or 'render' in phases
+        with self.transaction() as db:
+            day_id = db.execute(
+                'INSERT INTO days (cfg, phases, races, created) VALUES (?, ?, ?, ?)',
+                (json.dumps(cfg, ensure_ascii=False), json.dumps(list(phases)),
+                 json.dumps(races), now)).lastrowid
+
+            def add(kind, race_no=None, deps=()):
+                return db.execute(
+                    'INSERT INTO jobs (day_id, kind, race_no, deps, max_attempts, updated) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (day_id, kind, race_no, json.dumps(list(deps)), max_attempts, now)).lastrowid
+
+            kaisai = [add('kaisai')] if 'scrape' in phases else []
+            baba   = [add('baba')] if analyze and ma.needs_baba_scrape(cfg) else []
+            renders = []
+            for race_no in races:
+                scrape = [add('scrape', race_no, kaisai)] if 'scrape' in phases else []
+                if analyze:
+                    renders.append(add('render', race_no, baba + scrape))
+            if 'merge' in phases and renders:
+                add('finalize', None, renders)
+        return day_id
+
+    # ── 取り出し・完了 ────────────────────────────────────
+    def claim(self, owner, lease=LEASE_SEC):
+        """
+        実行できるジョブ（依存ジョブがすべて done）を1件リースして返す。なければ None。
+        リース切れのジョブは取り直しの対象に戻す。
+        """
+        now = time.time()
+        with self.transaction() as db:
+            db.execute("UPDATE jobs SET state = 'pending', owner = NULL, error = ? "
+                       "WHERE state = 'leased' AND lease_until < ? AND attempts < max_attempts",
+                       ('リース切れ（ワーカー停止？）', now))
+            db.execute("UPDATE jobs SET state = 'failed', owner = NULL, error = ? "
+                       "WHERE state = 'leased' AND lease_until < ? AND attempts >= max_attempts",
+                       ('リース切れ（再実行回数の上限）', now))
+            states = dict(db.execute('SELECT id, state FROM jobs WHERE day_id IN '
+                                     "(SELECT day_id FROM jobs WHERE state = 'pending')"))
+            rows = db.execute("SELECT * FROM jobs WHERE state = 'pending' AND not_before <= ? "
+                              'ORDER BY id', (now,)).fetchall()
+            for row in rows:
+                dep_ids = json.loads(row['deps'])
+                deps = [states.get(d) for d in dep_ids]
+                if 'failed' in deps:
+                    db.execute("UPDATE jobs SET state = 'failed', error = ?, updated = ? "
+                               'WHERE id = ?', ('依存ジョブが失敗', now, row['id']))
+                    states[row['id']] = 'failed'
+                    continue
+                if any(d != 'done' for d in deps):
+                    continue
+                db.execute("UPDATE jobs SET state = 'leased', owner = ?, lease_until = ?, "
+                           'attempts = attempts + 1, updated = ? WHERE id = ?',
+                           (owner, now + lease, now, row['id']))
+                job = dict(row, attempts=row['attempts'] + 1, owner=owner)
+                day = db.execute('SELECT * FROM days WHERE id = ?', (row['day_id'],)).fetchone()
+                job['cfg']    = json.loads(day['cfg'])
+                job['phases'] = tuple(json.loads(day['phases']))
+                job['races']  = json.loads(day['races'])
+                job['dep_results'] = {
+                    r['id']: dict(r) for r in db.execute(
+                        'SELECT id, kind, race_no, result FROM jobs WHERE id IN '
+                        f"({','.join('?' * len(dep_ids))})", dep_ids)
+                } if dep_ids else {}
+                return job
+        return None
+
+    def extend(self, job, lease=LEASE_SEC):
+        with self.transaction() as db:
+            return db.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? "
+                              "AND state = 'leased'",
+                              (time.time() + lease, job['id'], job['owner'])).rowcount == 1
+
+    def complete(self, job, result):
+        """完了を記録する。リースを失っていた（別のワーカーが取り直した）場合は False"""
+        with self.transaction() as db:
+            return db.execute(
+                "UPDATE jobs SET state = 'done', result = ?, error = NULL, owner = NULL, "
+                "updated = ? WHERE id = ? AND owner = ? AND state = 'leased'",
+                (json.dumps(result, ensure_ascii=False), time.time(), job['id'], job['owner'])
+            ).rowcount == 1
+
+    def fail(self, job, error):
+        """失敗を記録する。上限に達していなければ待ち時間のあと再実行する"""
+        now = time.time()
+        final = job['attempts'] >= job['max_attempts']
+        with self.transaction() as db:
+            db.execute(
+                'UPDATE jobs SET state = ?, error = ?, owner = NULL, not_before = ?, updated = ? '
+                "WHERE id = ? AND owner = ? AND state = 'leased'",
+                ('failed' if final else 'pending', error,
+                 now + RETRY_BASE * 2 ** (job['attempts'] - 1), now, job['id'], job['owner']))
+        return final
+
+    def retry_failed(self):
+        with self.transaction() as db:
+            return db.execute("UPDATE jobs SET state = 'pending', attempts = 0, not_before = 0, "
+                              "error = NULL WHERE state = 'failed'").rowcount
+
+    def has_open(self):
+        """未完了（pending / leased）のジョブがあるか"""
+        return self.conn.execute("SELECT 1 FROM jobs WHERE state IN ('pending', 'leased') "
+                                 'LIMIT 1').fetchone() is not None
+
+    def summary(self):
+        return self.conn.execute(
+            'SELECT day_id, kind, state, COUNT(*) AS n FROM jobs '
+            'GROUP BY day_id, kind, state ORDER BY day_id, kind, state').fetchall()
+
+    def failures(self):
+        return self.conn.execute("SELECT id, day_id, kind, race_no, attempts, error FROM jobs "
+                                 "WHERE state = 'failed' OR (state = 'pending' AND error "
+                                 'IS NOT NULL) ORDER BY id').fetchall()
+
+@contextmanager
+def keep_lease(queue_path, job, lease):
+    """実行中はリースを延長し続ける（別の接続を使う）"""
+    stop = threading.Event()
+
+    def loop():
+        q = WorkQueue(queue_path)
+        while not stop.wait(lease / 3):
+            if not q.extend(job, lease):
+                print(f"   ジョブ {job['id']} のリースを失いました")
+                return
+
+    t = threading.Thread(target=loop, daemon=True)
+    t.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        t.join()
+
+# ============================================================
+# ジョブの実行
+# ============================================================
+def dep_result(job, kind):
+    for dep in job['dep_results'].values():
+        if dep['kind'] == kind and dep['result']:
+            return json.loads(dep['result'])
+    return None
+
+def track_values(job):
+    """baba ジョブの結果（なければ設定値）→ (クッション値, 芝含水率, ダート含水率)"""
+    baba = dep_result(job, 'baba')
+    if baba is not None:
+        return baba['cushion'], baba['moisture_turf'], baba['moisture_dirt']
+    return ma.resolve_track_values(job['cfg'], fetch=False)
+
+def run_job(job):
+    cfg, kind, race_no = job['cfg'], job['kind'], job['race_no']
+    venue_jp, date_str = cfg['競馬場'], cfg['レース日']
+    race_base = cfg['レース情報URL'].rstrip('/')
+    lookback  = ma.parse_lookback(cfg['過去走の範囲'])
+    today     = datetime(*[int(x) for x in date_str.split('.')]).date()
+    out_dir   = ma.output_dir(venue_jp, date_str)
+    os.makedirs(out_dir, exist_ok=True)
+    # 取得ポリシーの状態（ホストごとのバケット・ブレーカー）は work() でキューファイルに置き、全ワーカーで共有
+    ma.FETCH_POLICY.configure(rate=ma.parse_setting_number(cfg.get('取得レート'), '取得レート', 1.0,
+                                                           above=True))
+    ma.BROWSER.profile = ma.parse_browser_profile(cfg.get('ブラウザプロファイル') or '標準')
+
+    if kind == 'kaisai':
+        y, m, d = [int(x) for x in date_str.split('.')]
+        return {'kaisai_day': ma.get_kaisai_day(y, m, d, venue_jp, race_base)}
+
+    if kind == 'baba':
+        c, t, d = ma.resolve_track_values(cfg, fetch=True)
+        return {'cushion': c, 'moisture_turf': t, 'moisture_dirt': d}
+
+    if kind == 'scrape':
+        kaisai_day = (dep_result(job, 'kaisai') or {}).get('kaisai_day', '01')
+        url = ma.shutuba_url(race_base, date_str, venue_jp, kaisai_day, race_no)
+        horses, race_df = ma.scrape_one_race(url, venue_jp, race_no, date_str, lookback)
+        if not race_df.empty:
+            ma.save_race_file(race_df, ma.race_file_path(venue_jp, race_no))
+        return {'horses': len(horses), 'rows': len(race_df)}
+
+    cushion, moisture_turf, moisture_dirt = track_values(job)
+    moisture_df = ma.load_day_moisture(venue_jp, today, cushion, moisture_turf, moisture_dirt)
+
+    if kind == 'render':
+        horses, race_df = ma.read_race_input(ma.race_file_path(venue_jp, race_no),
+                                             lookback, today)
+        if race_df.empty:
+            return {'rows': 0}
+        race = ma.prepare_race(race_no, race_df, moisture_df, venue_jp, cushion,
+                               moisture_turf, moisture_dirt, flag(cfg, 'デモモード'))
+        if 'render' in job['phases']:
+            ma.render_race(out_dir, race_no, race['merged'], horses, race['label'],
+                           cushion, race['moisture'], race['target_dist'],
+                           flag(cfg, 'デモモード'), flag(cfg, '個別グラフ遅延生成'),
+                           flag(cfg, '好走密度表示'))
+        result = {'surface': race['surface'], 'rows': len(race['merged'])}
+        if 'merge' in job['phases'] and not race['merged'].empty:
+            result['rows_csv'] = ma.race_rows(race, race_no, cushion).to_csv(index=False)
+        return result
+
+    if kind == 'finalize':
+        results = [json.loads(dep['result']) for _, dep in sorted(job['dep_results'].items())
+                   if dep['result']]
+        rows = [(r['surface'], pd.read_csv(io.StringIO(r['rows_csv'])))
+                for r in results if 'rows_csv' in r]
+        race_dfs = []
+        for r in job['races']:
+            _, race_df = ma.read_race_input(ma.race_file_path(venue_jp, r), lookback, today)
+            if not race_df.empty:
+                race_dfs.append(race_df)
+        # 類似馬場の列は全レースの過去走で作った1つのインデックスから求める
+        rows = ma.add_day_neighbors(rows, race_dfs, moisture_df, venue_jp)
+        ma.save_day_results(out_dir, rows, race_dfs, moisture_df, job['races'])
+        return {'races': len(rows)}
+
+    raise ValueError(f"不明なジョブ: {kind}")
+
+def job_label(job):
+    race = f" {job['race_no']}R" if job['race_no'] else ''
+    return f"#{job['id']} {job['kind']}{race}（{job['attempts']}回目）"
+
+def work(queue_path=QUEUE_FILE, lease=LEASE_SEC, wait=False, quiet=False):
+    """ジョブがなくなるまで（wait=True なら止めるまで）取り出して実行する"""
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    queue = WorkQueue(queue_path)
+    # 取得レート・ブレーカーはホストごとに全ワーカーで1つ（キューファイルの fetch_hosts 表）
+    ma.FETCH_POLICY.configure(shared=queue_path)
+    done = 0
+    while True:
+        job = queue.claim(owner, lease)
+        if job is None:
+            if not wait and not queue.has_open():
+                break
+            time.sleep(POLL_SEC)
+            continue
+        print(f"[{owner}] {job_label(job)} 開始")
+        t = time.perf_counter()
+        try:
+            with keep_lease(queue_path, job, lease), \
+                 (redirect_stdout(io.StringIO()) if quiet else nullcontext()):
+                result = run_job(job)
+        except Exception as e:
+            final = queue.fail(job, f"{type(e).__name__}: {e}")
+            print(f"[{owner}] {job_label(job)} 失敗: {type(e).__name__}: {e}"
+                  + ('（打ち切り）' if final else '（あとで再実行）'))
+            continue
+        if queue.complete(job, result):
+            done += 1
+            print(f"[{owner}] {job_label(job)} 完了 {time.perf_counter() - t:.1f}s")
+        else:
+            print(f"[{owner}] {job_label(job)} はリース切れのため結果を破棄")
+    print(f"[{owner}] 終了（{done}件完了）")
+    return done
+
+# ============================================================
+# コマンド
+# ============================================================
+def print_status(queue):
+    current = None
+    for row in queue.summary():
+        if row['day_id'] != current:
+            current = row['day_id']
+            print(f"\nday {current}")
+        print(f"   {row['kind']:<9} {row['state']:<8} {row['n']:4d}")
+    failures = queue.failures()
+    if failures:
+        print("\n失敗・再実行待ち:")
+        for f in failures:
+            race = f" {f['race_no']}R" if f['race_no'] else ''
+            print(f"   #{f['id']} day {f['day_id']} {f['kind']}{race} "
+                  f"（{f['attempts']}回）: {f['error']}")
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite のワークキューで1日分の処理を分担する')
+    parser.add_argument('--db', default=QUEUE_FILE, help=f"キューファイル（既定 {QUEUE_FILE}）")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('enqueue', help='1日分のジョブを登録（以降の引数は main_analysis.py と同じ）',
+                   add_help=False)
+    w = sub.add_parser('worker', help='ジョブを実行する')
+    w.add_argument('--processes', type=int, default=1, help='このPCで起動するワーカー数')
+    w.add_argument('--lease', type=float, default=LEASE_SEC, help='リースの長さ（秒）')
+    w.add_argument('--wait', action='store_true', help='ジョブがなくなっても待ち続ける')
+    w.add_argument('--quiet', action='store_true', help='ジョブ内の表示を抑える')
+    sub.add_parser('status', help='ジョブの状態を表示')
+    sub.add_parser('retry', help='失敗したジョブを未実行に戻す')
+    args, rest = parser.parse_known_args()
+
+    if args.command == 'enqueue':
+        cfg, margs = ma.parse_args(rest)
+        scraping = flag(cfg, 'スクレイピング')
+        phases = margs.phases or (ma.PHASES if scraping else ma.PHASES[1:])
+        races = margs.races or list(ma.ALL_RACES)
+        day_id = WorkQueue(args.db).enqueue_day(cfg, phases, races)
+        print(f"day {day_id}: {cfg['競馬場']} {cfg['レース日']} {ma.race_range_label(races)} "
+              f"（{' → '.join(phases)}）を {args.db} に登録しました")
+        return
+    if rest:
+        parser.error(f"不明な引数: {' '.join(rest)}")
+    if args.command == 'status':
+        print_status(WorkQueue(args.db))
+    elif args.command == 'retry':
+        print(f"{WorkQueue(args.db).retry_failed()}件を未実行に戻しました")
+    elif args.processes <= 1:
+        work(args.db, args.lease, args.wait, args.quiet)
+    else:
+        procs = [multiprocessing.Process(target=work,
+                                         args=(args.db, args.lease, args.wait, args.quiet))
+                 for _ in range(args.processes)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+
+if __name__ == '__main__':
+    main()